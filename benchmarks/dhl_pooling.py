@@ -0,0 +1,116 @@
+"""
+Measures DHL calls made through a pooled, keep-alive session against one-shot
+requests that close their connection, as make_call used to send them.
+
+Calls go to a local stub server standing in for the XML-PI endpoint, which
+answers every request with the tracking response from the test fixtures, so
+the timings are dominated by connection handling rather than by DHL. The stub
+adds a delay per new connection to stand in for the TCP and TLS handshakes.
+
+Run from the repository root:
+
+    python benchmarks/dhl_pooling.py [calls] [threads] [handshake_ms]
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import requests
+
+from postal.executor import SharedExecutor
+from postal.sessions import pooled_session
+from postal.tests.fixtures.dhl import tracking_response
+
+
+REQUEST = (
+    '<?xml version="1.0" encoding="UTF-8"?><req:KnownTrackingRequest '
+    'xmlns:req="http://www.dhl.com"><AWBNumber>9679741411</AWBNumber>'
+    '</req:KnownTrackingRequest>')
+
+
+class XmlPiStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, delayed ACKs
+    # would stall every response on a kept-alive connection.
+    disable_nagle_algorithm = True
+    handshake = 0.0
+    connections = 0
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        XmlPiStub.connections += 1
+        time.sleep(self.handshake)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = tracking_response.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def one_shot(url):
+    response = requests.post(url, data=REQUEST, headers={
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Connection': 'Close'})
+    response.raise_for_status()
+    return response.text
+
+
+def run(call, calls, threads):
+    XmlPiStub.connections = 0
+    executor = SharedExecutor(max_workers=threads)
+    start = time.time()
+    try:
+        executor.map('DHL', call, range(calls))
+    finally:
+        executor.shutdown()
+    return time.time() - start, XmlPiStub.connections
+
+
+def main(calls=200, threads=10, handshake_ms=20):
+    XmlPiStub.handshake = handshake_ms / 1000.0
+    server = StubServer(('127.0.0.1', 0), XmlPiStub)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%s/XMLShippingServlet' % server.server_port
+    session = pooled_session(pool_size=threads)
+
+    def pooled(_):
+        response = session.post(url, data=REQUEST, headers={
+            'Content-Type': 'application/x-www-form-urlencoded'})
+        response.raise_for_status()
+        return response.text
+
+    try:
+        for name, call in (
+                ('one-shot', lambda _: one_shot(url)), ('pooled', pooled)):
+            elapsed, connections = run(call, calls, threads)
+            print '%-9s %d calls on %d threads: %.3fs (%.1f ms/call), ' \
+                  '%d connections' % (
+                      name, calls, threads, elapsed,
+                      elapsed * 1000 / calls, connections)
+    finally:
+        # Closing the pooled connections lets the stub's handlers finish.
+        session.close()
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
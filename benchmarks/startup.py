@@ -0,0 +1,91 @@
+"""
+Measures how long constructing Postal and building its carriers' clients
+takes with the WSDL cache disabled, with an empty (cold) cache, and with a
+warmed cache. Clients are built on first use, so this times both building
+every client and building only those used for rating.
+
+Run from the repository root:
+
+    python benchmarks/startup.py [repetitions]
+
+USPS is left out since its WSDL is fetched from Endicia rather than bundled.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from postal import Address, Postal, base_postal_configuration
+from postal.carriers.dhl import DHLApi
+from postal.carriers.fedex import FedExApi
+from postal.carriers.ups import UPSApi
+
+
+def configuration(wsdl_cache):
+    config = dict(base_postal_configuration)
+    config.update({
+        'enabled_carriers': [FedExApi, UPSApi, DHLApi],
+        'carrier_country': {},
+        'wsdl_cache': wsdl_cache,
+        'shipper_address': Address(
+            street_lines=['1 Main St'], city='Houston', country='US',
+            subdivision='TX', postal_code='77092'),
+        'carrier_inits': {
+            'FedEx': {
+                'key': 'key', 'account_number': '1', 'password': 'password',
+                'meter_number': '1'},
+            'UPS': {
+                'username': 'user', 'password': 'password',
+                'access_license_number': '1', 'shipper_number': '1',
+                'test': True},
+            'DHL': {
+                'account_number': '1', 'region_code': 'AM',
+                'company_name': 'Company', 'site_id': 'site',
+                'password': 'password'}}})
+    return config
+
+
+RATING_CLIENTS = {
+    'FedEx': ['rates_client'],
+    'UPS': ['_RateWS', '_TNTWS'],
+    'DHL': []}
+
+
+def construct(wsdl_cache, rating_only):
+    start = time.time()
+    postal = Postal(configuration(wsdl_cache))
+    for name, carrier in postal.carriers.items():
+        if rating_only:
+            carrier.prewarm(RATING_CLIENTS[name], background=False)
+        else:
+            carrier.prewarm(background=False)
+    return time.time() - start
+
+
+def main(repetitions=5):
+    for rating_only in (False, True):
+        directory = tempfile.mkdtemp()
+        try:
+            disabled = [construct(False, rating_only)
+                        for _ in range(repetitions)]
+            cold = []
+            for index in range(repetitions):
+                cold.append(construct(
+                    os.path.join(directory, str(index)), rating_only))
+            warm = [construct(os.path.join(directory, '0'), rating_only)
+                    for _ in range(repetitions)]
+        finally:
+            shutil.rmtree(directory)
+        print 'Rating clients only:' if rating_only else 'All clients:'
+        for name, timings in (
+                ('no cache', disabled), ('cold cache', cold),
+                ('warm cache', warm)):
+            print '  %-12s best %.3fs  mean %.3fs' % (
+                name, min(timings), sum(timings) / len(timings))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,7 +1,7 @@
 import logging
 from .configuration_base import base_postal_configuration
 from .data import Address, Request, Package, Declaration, Shipment
-from .postal import Postal
+from .postal import Postal, warm_wsdl_cache
 
 logger = logging.getLogger('pycountry.db')
 logger.addHandler(logging.NullHandler())
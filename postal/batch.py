@@ -0,0 +1,283 @@
+"""
+Shipping many requests at once, for end of day label runs.
+
+ship_many() hands each (service, request) pair to its carrier through the
+shared executor, with no more than a set number of shipments in flight for
+each carrier, since carriers throttle differently, and yields each result as
+soon as it's in.
+
+A ShipmentJournal records each shipment as it starts and finishes, so that a
+run that stopped part way can be started again with the same journal and
+jobs. Shipments the journal has as finished are reported from the journal
+instead of being shipped again. Shipments that started but never finished
+are reported with a ShipmentInDoubtError, since the carrier may or may not
+have made them, and someone has to check before shipping them again.
+
+Labels are handed to a LabelSink as each shipment finishes, so that a long
+run doesn't hold every label in memory. Results carry what the sink returned
+for each label (a path, for DirectorySink) in its place.
+"""
+from collections import deque, OrderedDict
+from threading import RLock
+import json
+import os
+import sys
+import tempfile
+
+from concurrent import futures
+
+from .cache import from_jsonable, to_jsonable
+from .data import Shipment, digest
+from .exceptions import AddressError, CarrierError, NotSupportedError, \
+    PartialShipmentError, PostalError, ShipmentInDoubtError
+
+
+# Errors for which the carrier is known to have refused the shipment, so it
+# can safely be tried again. Anything else (a timeout waiting on the reply,
+# say) may have happened after the carrier made the shipment, and a
+# PartialShipmentError means some of it was made.
+REFUSALS = (AddressError, CarrierError, NotSupportedError)
+
+
+def job_key(index, service, request):
+    """
+    The default key for a job in the journal: its position in the run along
+    with what it ships, so that a run resumed with different jobs doesn't
+    mistake them for the ones it already shipped.
+    """
+    return '%s-%s' % (index, digest([
+        service.carrier.name, service.service_id,
+        request.fingerprint()])[:16])
+
+
+class LabelSink(object):
+    """
+    Somewhere to keep labels as shipments finish.
+    """
+    def put(self, key, index, label):
+        """
+        Stores the label for the package at index in the shipment for the job
+        with key, and returns a reference to it to stand in for the label.
+        """
+        raise NotImplementedError
+
+
+class DirectorySink(LabelSink):
+    """
+    Writes each label to a file of its own in directory, named for the job
+    and package, and returns its path.
+    """
+    def __init__(self, directory, extension=''):
+        self.directory = directory
+        self.extension = extension
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def put(self, key, index, label):
+        if isinstance(label, unicode):
+            label = label.encode('utf8')
+        path = os.path.join(
+            self.directory, '%s-%s%s' % (key, index, self.extension))
+        # Write to a temporary file first, so that a crash never leaves half
+        # a label behind under the real name.
+        handle, temp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, 'wb') as label_file:
+            label_file.write(label)
+        os.rename(temp_path, path)
+        return path
+
+
+class ShipmentJournal(object):
+    """
+    An append only log of the shipments made by ship_many(), kept in a file
+    at path with one JSON record a line. Each record is written through to
+    disk before the shipment it describes moves on.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = RLock()
+        self.entries = {}
+        complete = True
+        if os.path.exists(path):
+            with open(path, 'rb') as journal_file:
+                for line in journal_file:
+                    complete = line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A record cut short by a crash.
+                        continue
+                    self.entries[record['key']] = record
+        self._file = open(path, 'ab')
+        if not complete:
+            self._file.write('\n')
+
+    def get(self, key):
+        """
+        The latest record for key, or None.
+        """
+        with self._lock:
+            return self.entries.get(key)
+
+    def write(self, key, state, **fields):
+        fields.update({'key': key, 'state': state})
+        line = json.dumps(fields, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.entries[key] = fields
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def _record(request, shipped):
+    """
+    What the journal keeps of a shipment, with its packages listed in the
+    order of the request's.
+    """
+    shipment = shipped['shipment']
+    return to_jsonable({
+        'tracking_number': shipment.tracking_number,
+        'transaction_id': shipment.transaction_id,
+        'price': shipped['price'],
+        'packages': [
+            shipped['packages'].get(package) for package in request.packages]})
+
+
+def _resumed(service, request, record):
+    data = from_jsonable(record['shipment'])
+    packages = OrderedDict()
+    for package, details in zip(request.packages, data['packages']):
+        if details is not None:
+            packages[package] = details
+    return {
+        'shipment': {
+            'shipment': Shipment(
+                service.carrier, data['tracking_number'],
+                transaction_id=data['transaction_id']),
+            'price': data['price'],
+            'packages': packages},
+        'error': None,
+        'resumed': True}
+
+
+def _ship(service, request, key, journal, sink):
+    entry = {'shipment': None, 'error': None, 'resumed': False}
+    if journal is not None:
+        journal.write(key, 'started')
+    try:
+        entry['shipment'] = service.ship(request)
+        if sink is not None:
+            for index, package in enumerate(request.packages):
+                details = entry['shipment']['packages'].get(package)
+                if details and details.get('label') is not None:
+                    details['label'] = sink.put(key, index, details['label'])
+        if journal is not None:
+            journal.write(
+                key, 'shipped', shipment=_record(request, entry['shipment']))
+    except Exception as err:
+        if not hasattr(err, 'traceback'):
+            err.traceback = sys.exc_info()[2]
+        entry['error'] = err
+        if (journal is not None and entry['shipment'] is None and
+                isinstance(err, REFUSALS) and
+                not isinstance(err, PartialShipmentError)):
+            journal.write(key, 'failed', error=unicode(err))
+    return entry
+
+
+def ship_many(executor, jobs, journal=None, sink=None, carrier_limits=None,
+              default_limit=4, window=100, key=job_key):
+    """
+    Ships each (service, request) pair in jobs, yielding
+    (index, service, request, entry) for each as it finishes, where index is
+    the job's position in jobs and entry is shaped like so:
+
+    {
+        'shipment' -> dict|None = what service.ship() returned, with labels
+                                  replaced by the sink's references, or None
+                                  if nothing was shipped,
+        'error' -> Exception|None = the problem that occurred, if any,
+        'resumed' -> bool = whether the shipment came from the journal
+    }
+
+    carrier_limits:{string -> int} = the most shipments in flight for each
+        carrier, by name
+    default_limit:int|None = the limit for carriers not in carrier_limits
+    window:int = the most jobs read ahead of those finished, so jobs may be
+        a long or lazily built iterable
+    key:function = gives the journal key for (index, service, request)
+
+    Failures are reported in their entry rather than raised. A journal needs
+    a sink, since labels aren't kept in it.
+    """
+    if journal is not None and sink is None:
+        raise ValueError("A journal needs a sink to keep labels in.")
+    carrier_limits = carrier_limits or {}
+    source = enumerate(jobs)
+    exhausted = False
+    waiting = OrderedDict()
+    held = 0
+    running = {}
+    pending = {}
+
+    while True:
+        while not exhausted and held + len(pending) < window:
+            try:
+                index, (service, request) = next(source)
+            except StopIteration:
+                exhausted = True
+                break
+            job = key(index, service, request)
+            record = journal.get(job) if journal is not None else None
+            state = record and record['state']
+            if state == 'shipped':
+                yield index, service, request, _resumed(
+                    service, request, record)
+                continue
+            if state == 'started':
+                yield index, service, request, {
+                    'shipment': None, 'resumed': True,
+                    'error': ShipmentInDoubtError(
+                        "Job %s started but never finished, so it may "
+                        "already have shipped." % job)}
+                continue
+            waiting.setdefault(service.carrier.name, deque()).append(
+                (index, service, request, job))
+            held += 1
+
+        for name, queue in waiting.items():
+            limit = carrier_limits.get(name, default_limit)
+            while queue and (limit is None or running.get(name, 0) < limit):
+                index, service, request, job = queue.popleft()
+                held -= 1
+                future = executor.submit_for(
+                    name, _ship, service, request, job, journal, sink)
+                pending[future] = index, service, request
+                running[name] = running.get(name, 0) + 1
+
+        if not pending:
+            if exhausted:
+                return
+            continue
+        done, _ = futures.wait(
+            list(pending), return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            index, service, request = pending.pop(future)
+            running[service.carrier.name] -= 1
+            if future.cancelled():
+                entry = {'shipment': None, 'resumed': False,
+                         'error': PostalError("The shipment was cancelled.")}
+            else:
+                entry = future.result()
+            yield index, service, request, entry
@@ -0,0 +1,225 @@
+"""
+Circuit breakers for the calls Postal makes to carriers.
+
+A carrier that's down makes every call to it wait out the socket timeout.
+Each carrier can be given a 'circuit_breaker' in its carrier_inits:
+
+    'circuit_breaker': {
+        'window': 20,          # recent calls the error rate is taken over
+        'min_calls': 5,        # calls needed in the window before tripping
+        'error_rate': 0.5,     # fraction of failed calls that trips it
+        'cooldown': 30,        # seconds to stay open before trying again
+        'half_open_calls': 1}  # trial calls that must succeed to close it
+
+The breaker starts closed, letting calls through and watching how they end.
+Only calls that never got an answer (connection errors, timeouts, server
+errors) count as failures; a carrier rejecting a request is still up. Once
+error_rate of the calls in the window have failed, the breaker opens and
+calls fail right away with a CarrierUnavailableError, and
+Postal.request_carrier_options() leaves the carrier out. After cooldown it
+goes half open and lets half_open_calls calls through: if they succeed it
+closes again, and if one fails it opens for another cooldown.
+
+Breakers are shared by every carrier built from equivalent settings, like
+rate limiters are.
+"""
+from collections import deque
+from contextlib import contextmanager
+from threading import RLock
+import time
+
+from .exceptions import CarrierUnavailableError, RateLimitedError
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class Call(object):
+    """
+    One call through a breaker. Code making the call marks it failed if the
+    carrier never answered.
+    """
+    def __init__(self, probe=False):
+        self.probe = probe
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+class CircuitBreaker(object):
+    """
+    name:string = the carrier guarded, for error messages
+    window:int = the number of recent calls the error rate is taken over
+    min_calls:int = the fewest calls in the window that can trip the breaker
+    error_rate:float = the fraction of failed calls in the window that trips
+        the breaker
+    cooldown:float = seconds the breaker stays open
+    half_open_calls:int = trial calls let through when half open, all of
+        which must succeed to close the breaker
+    """
+    def __init__(self, name, window=20, min_calls=5, error_rate=0.5,
+                 cooldown=30, half_open_calls=1):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.half_open_calls = half_open_calls
+        self._lock = RLock()
+        self._outcomes = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = None
+        self._probes = 0
+        self._probe_successes = 0
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and \
+                    time.time() >= self._opened_at + self.cooldown:
+                self._state = HALF_OPEN
+                self._probes = 0
+                self._probe_successes = 0
+            return self._state
+
+    def available(self):
+        """
+        Whether a call made now would be let through.
+        """
+        with self._lock:
+            state = self.state
+            return state == CLOSED or (
+                state == HALF_OPEN and self._probes < self.half_open_calls)
+
+    def allow(self):
+        """
+        Returns a Call if one may be made now, or raises a
+        CarrierUnavailableError.
+        """
+        with self._lock:
+            state = self.state
+            if state == CLOSED:
+                return Call()
+            if state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return Call(probe=True)
+            self.rejected += 1
+            retry_after = None
+            if state == OPEN:
+                retry_after = self._opened_at + self.cooldown - time.time()
+        raise CarrierUnavailableError(
+            "%s is unavailable after repeated failures." % self.name,
+            retry_after=retry_after)
+
+    def record(self, call, succeeded):
+        """
+        Notes how call ended: succeeded is True or False, or None for calls
+        that never reached the carrier.
+        """
+        with self._lock:
+            if call.probe:
+                if self._state != HALF_OPEN:
+                    return
+                self._probes -= 1
+                if succeeded:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._state = CLOSED
+                        self._outcomes.clear()
+                elif succeeded is not None:
+                    self._open()
+                return
+            if self._state != CLOSED or succeeded is None:
+                return
+            self._outcomes.append(succeeded)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and \
+                    failures >= self.error_rate * len(self._outcomes):
+                self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.time()
+        self.trips += 1
+
+    def reset(self):
+        """
+        Closes the breaker and forgets recent calls.
+        """
+        with self._lock:
+            self._state = CLOSED
+            self._outcomes.clear()
+
+    @contextmanager
+    def call(self):
+        """
+        Guards a call for as long as the block runs, yielding the Call to
+        mark failed if the carrier doesn't answer.
+        """
+        call = self.allow()
+        try:
+            yield call
+        except RateLimitedError:
+            self.record(call, None)
+            raise
+        except BaseException:
+            self.record(call, not call.failed)
+            raise
+        self.record(call, not call.failed)
+
+    def stats(self):
+        """
+        Returns the breaker's state and the calls it's based on.
+        """
+        with self._lock:
+            state = self.state
+            calls = len(self._outcomes)
+            failures = self._outcomes.count(False)
+            retry_after = None
+            if state == OPEN:
+                retry_after = self._opened_at + self.cooldown - time.time()
+            return {
+                'state': state,
+                'calls': calls,
+                'failures': failures,
+                'error_rate': float(failures) / calls if calls else 0.0,
+                'opened_at': self._opened_at,
+                'retry_after': retry_after,
+                'trips': self.trips,
+                'rejected': self.rejected}
+
+
+@contextmanager
+def unguarded():
+    """
+    Stands in for CircuitBreaker.call() where there's no breaker.
+    """
+    yield Call()
+
+
+_breakers = {}
+_breakers_lock = RLock()
+
+
+def breaker_from_configuration(name, settings):
+    """
+    Gets the CircuitBreaker for carrier name described by its
+    'circuit_breaker' in carrier_inits, or None if it has none. Carriers
+    with the same name and equivalent settings share a CircuitBreaker.
+    """
+    if not settings:
+        return None
+    options = {
+        key: settings[key] for key in (
+            'window', 'min_calls', 'error_rate', 'cooldown',
+            'half_open_calls')
+        if key in settings}
+    signature = (name,) + tuple(sorted(options.items()))
+    with _breakers_lock:
+        if signature not in _breakers:
+            _breakers[signature] = CircuitBreaker(name, **options)
+        return _breakers[signature]
@@ -0,0 +1,708 @@
+"""
+Caching for Postal.
+
+Carriers keep the rates they get from upstream in a cache so that repeated
+lookups for the same request (pricing each service individually, for instance)
+don't each cost a web request. Caches are bounded, evict entries once they fill
+up, and expire entries once their time to live has passed.
+
+Two backends are provided. MemoryCache keeps entries in the current process,
+spread over several stripes, each with its own lock, so that the threads used
+by Postal.options() don't all queue up behind a single lock. SqliteCache keeps
+entries in a local sqlite file so that every worker process on a machine can
+reuse quotes fetched by the others.
+
+Lookups that miss the cache at the same time for the same key are coalesced
+by SingleFlight, so that only one of them calls upstream.
+
+Parsed WSDL definitions are also cached, on disk, by WsdlCache, since parsing
+the bundled WSDL files is most of the cost of constructing carriers.
+"""
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, tzinfo
+from decimal import Decimal
+from threading import RLock, local
+import gc
+import hashlib
+import heapq
+import json
+import os
+import cPickle as pickle
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+
+from concurrent import futures
+from money import Money
+from suds.cache import ObjectCache
+
+
+LRU = 'lru'
+LFU = 'lfu'
+
+
+class CacheBackend(object):
+    """
+    Interface for rate cache backends. Keys are strings or other hashable
+    values with a stable str(), and values are whatever the carriers store.
+    get() returns default when there is no live entry.
+    """
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+class _FixedOffset(tzinfo):
+    """
+    A timezone with a constant offset from UTC, used to restore the offset of
+    cached datetimes.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def utcoffset(self, dt):
+        return timedelta(seconds=self.seconds)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return None
+
+    def __repr__(self):
+        return '<UTC%+d seconds>' % self.seconds
+
+
+def to_jsonable(value):
+    """
+    Converts value into something the json module can write, tagging the
+    types JSON can't represent so that they can be restored exactly.
+    """
+    if isinstance(value, Money):
+        return {'$m': [str(value.amount), value.currency.code]}
+    if isinstance(value, Decimal):
+        return {'$d': str(value)}
+    if isinstance(value, datetime):
+        offset = value.utcoffset()
+        if offset is not None:
+            offset = offset.days * 86400 + offset.seconds
+        return {'$t': [value.replace(tzinfo=None).isoformat(), offset]}
+    if isinstance(value, date):
+        return {'$D': value.isoformat()}
+    if isinstance(value, tuple):
+        return {'$u': [to_jsonable(item) for item in value]}
+    if isinstance(value, list):
+        return [to_jsonable(item) for item in value]
+    if isinstance(value, dict):
+        for key in value:
+            if not isinstance(key, basestring):
+                raise TypeError("Can't serialize a dictionary key of %r." % key)
+        return {'$o': {key: to_jsonable(item) for key, item in value.items()}}
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return value
+    raise TypeError("Can't serialize %r for the cache." % value)
+
+
+def from_jsonable(value):
+    """
+    Restores a value to_jsonable() converted, once read back with the json
+    module.
+    """
+    if isinstance(value, list):
+        return [from_jsonable(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    tag, data = value.items()[0]
+    if tag == '$o':
+        return {key: from_jsonable(item) for key, item in data.items()}
+    if tag == '$m':
+        return Money(Decimal(data[0]), data[1])
+    if tag == '$d':
+        return Decimal(data)
+    if tag == '$t':
+        if '.' in data[0]:
+            result = datetime.strptime(data[0], '%Y-%m-%dT%H:%M:%S.%f')
+        else:
+            result = datetime.strptime(data[0], '%Y-%m-%dT%H:%M:%S')
+        if data[1] is not None:
+            result = result.replace(tzinfo=_FixedOffset(data[1]))
+        return result
+    if tag == '$D':
+        return datetime.strptime(data, '%Y-%m-%d').date()
+    if tag == '$u':
+        return tuple(from_jsonable(item) for item in data)
+    raise ValueError("Unknown tag in cached value: %s" % tag)
+
+
+def dumps(value):
+    """
+    Serializes a cache entry into a compact byte string. Money, Decimal and
+    datetime values come back from loads() exactly as they went in.
+    """
+    return zlib.compress(json.dumps(to_jsonable(value), separators=(',', ':')))
+
+
+def loads(data):
+    return from_jsonable(json.loads(zlib.decompress(data)))
+
+
+class _Stripe(object):
+    """
+    One independently locked slice of a MemoryCache.
+
+    Entries are stored as [expires, value, uses] lists, where expires is a
+    timestamp or None for entries that never expire. The OrderedDict keeps
+    entries in order of last use, oldest first. For LFU eviction, entries
+    are also filed by their number of uses, each group in order of last use,
+    so that the entry to drop is always at the front of the lowest group.
+    Expiring entries are kept in a heap by expiry time, so that expired ones
+    can be found without looking at the rest, either to make room or, in
+    stripes with no max_size, on every set(). Every step of get() and set()
+    takes constant or logarithmic time, however full the stripe is.
+    """
+    def __init__(self, max_size, eviction):
+        self.max_size = max_size
+        self.eviction = eviction
+        self.lock = RLock()
+        self.entries = OrderedDict()
+        # uses -> OrderedDict of the keys used that often, for LFU.
+        self.frequencies = {}
+        self.min_uses = 0
+        # (expires, key), including stale pairs for keys since deleted or
+        # given another expiry, which are skipped.
+        self.expiries = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _file(self, key, uses):
+        if self.eviction == LFU:
+            self.frequencies.setdefault(uses, OrderedDict())[key] = None
+
+    def _unfile(self, key, uses):
+        if self.eviction == LFU:
+            group = self.frequencies[uses]
+            del group[key]
+            if not group:
+                del self.frequencies[uses]
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self._unfile(key, entry[2])
+        return entry
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] is not None and entry[0] <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._remove(key)
+            if self.eviction == LFU and entry[2] == self.min_uses and \
+                    entry[2] not in self.frequencies:
+                self.min_uses += 1
+            entry[2] += 1
+            # Reinsert to mark it as the most recently used.
+            self.entries[key] = entry
+            self._file(key, entry[2])
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, expires, now):
+        with self.lock:
+            if self.max_size is None:
+                # Nothing is ever evicted to make room, so expired entries
+                # have to go as they come due instead.
+                self._drop_expired(now)
+            uses = 0
+            if key in self.entries:
+                uses = self._remove(key)[2]
+            elif self.max_size is not None and \
+                    len(self.entries) >= self.max_size:
+                self.evict(now)
+            self.entries[key] = [expires, value, uses]
+            self._file(key, uses)
+            if uses < self.min_uses or len(self.entries) == 1:
+                self.min_uses = uses
+            if expires is not None:
+                heapq.heappush(self.expiries, (expires, key))
+                if len(self.expiries) > 2 * len(self.entries) + 64:
+                    self._compact()
+
+    def _compact(self):
+        self.expiries = [
+            (entry[0], key) for key, entry in self.entries.items()
+            if entry[0] is not None]
+        heapq.heapify(self.expiries)
+
+    def _drop_expired(self, now):
+        """
+        Drops every expired entry, returning how many there were.
+        """
+        dropped = 0
+        while self.expiries and self.expiries[0][0] <= now:
+            expires, key = heapq.heappop(self.expiries)
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == expires:
+                self._remove(key)
+                dropped += 1
+        self.expirations += dropped
+        return dropped
+
+    def evict(self, now):
+        """
+        Make room for one more entry. Anything expired goes first, and only
+        if there is nothing expired is a live entry dropped.
+        """
+        if self._drop_expired(now):
+            return
+        if self.eviction == LFU:
+            if self.min_uses not in self.frequencies:
+                # Its last entries were deleted or expired.
+                self.min_uses = min(self.frequencies)
+            # Ties go to the least recently used entry, at the front.
+            key = next(iter(self.frequencies[self.min_uses]))
+            self._remove(key)
+        else:
+            self.entries.popitem(last=False)
+        self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.frequencies.clear()
+            self.min_uses = 0
+            self.expiries = []
+
+
+class MemoryCache(CacheBackend):
+    """
+    A bounded, thread safe, in-process cache with per-entry time to live.
+
+    max_size:int|None = the most entries held at once, or None for no limit
+    eviction:string = 'lru' to drop the least recently used entry when full,
+        or 'lfu' to drop the least frequently used one
+    stripes:int = the number of independently locked stripes entries are
+        spread over
+    """
+    def __init__(self, max_size=10000, eviction=LRU, stripes=16):
+        if eviction not in (LRU, LFU):
+            raise ValueError("Unknown eviction policy: %s" % eviction)
+        if max_size is not None and max_size < 1:
+            raise ValueError("max_size must be at least 1, or None.")
+        stripes = max(1, int(stripes))
+        if max_size is not None:
+            stripes = max(1, min(stripes, max_size))
+        self.max_size = max_size
+        self.eviction = eviction
+        self._stripes = []
+        for index in range(stripes):
+            if max_size is None:
+                stripe_size = None
+            else:
+                # Spread any remainder over the first few stripes.
+                stripe_size = max_size // stripes + (index < max_size % stripes)
+            self._stripes.append(_Stripe(stripe_size, eviction))
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get(self, key, default=None):
+        value = self._stripe(key).get(key, time.time())
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value under key. ttl is the number of seconds the entry stays
+        valid, or None for an entry that only leaves by eviction.
+        """
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        self._stripe(key).set(key, value, expires, now)
+
+    def delete(self, key):
+        return self._stripe(key).delete(key)
+
+    def clear(self):
+        for stripe in self._stripes:
+            stripe.clear()
+
+    def __len__(self):
+        return sum(len(stripe.entries) for stripe in self._stripes)
+
+    def stats(self):
+        """
+        Returns counters for how the cache has been used so far.
+        """
+        result = {'size': 0, 'hits': 0, 'misses': 0, 'evictions': 0,
+                  'expirations': 0}
+        for stripe in self._stripes:
+            with stripe.lock:
+                result['size'] += len(stripe.entries)
+                result['hits'] += stripe.hits
+                result['misses'] += stripe.misses
+                result['evictions'] += stripe.evictions
+                result['expirations'] += stripe.expirations
+        result['max_size'] = self.max_size
+        return result
+
+
+class SqliteCache(CacheBackend):
+    """
+    A cache kept in a local sqlite file, shared by every process that opens
+    the same path. Entries are serialized with dumps().
+
+    path:string = location of the database file
+    max_size:int|None = the most entries held at once, or None for no limit
+    eviction:string = 'lru' or 'lfu', as for MemoryCache
+    timeout:float = seconds to wait on another process holding the database
+        lock
+    trim_interval:int = number of writes between checks of the cache size
+    """
+    def __init__(self, path, max_size=10000, eviction=LRU, timeout=5.0,
+                 trim_interval=64):
+        if eviction not in (LRU, LFU):
+            raise ValueError("Unknown eviction policy: %s" % eviction)
+        if max_size is not None and max_size < 1:
+            raise ValueError("max_size must be at least 1, or None.")
+        self.path = path
+        self.max_size = max_size
+        self.eviction = eviction
+        self.timeout = timeout
+        self.trim_interval = trim_interval
+        self._local = local()
+        self._lock = RLock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _connection(self):
+        # Connections can't be shared between threads, nor carried over a
+        # fork, so each thread of each process opens its own.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS rate_cache ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL, '
+                'used REAL NOT NULL, uses INTEGER NOT NULL DEFAULT 0)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def get(self, key, default=None):
+        key = str(key)
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT value, expires FROM rate_cache WHERE key = ?',
+            (key,)).fetchone()
+        now = time.time()
+        if row is None:
+            self._count('misses')
+            return default
+        if row[1] is not None and row[1] <= now:
+            connection.execute(
+                'DELETE FROM rate_cache WHERE key = ? AND expires <= ?',
+                (key, now))
+            self._count('expirations')
+            self._count('misses')
+            return default
+        connection.execute(
+            'UPDATE rate_cache SET used = ?, uses = uses + 1 WHERE key = ?',
+            (now, key))
+        self._count('hits')
+        return loads(str(row[0]))
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO rate_cache (key, value, expires, used, uses) '
+            'VALUES (?, ?, ?, ?, COALESCE('
+            '(SELECT uses FROM rate_cache WHERE key = ?), 0))',
+            (str(key), sqlite3.Binary(dumps(value)), expires, now, str(key)))
+        with self._lock:
+            self._writes += 1
+            trim = not self._writes % self.trim_interval
+        if trim:
+            self.trim()
+
+    def trim(self):
+        """
+        Removes expired entries and, if the cache is still over its maximum
+        size, the least recently or least frequently used entries.
+        """
+        connection = self._connection()
+        cursor = connection.execute(
+            'DELETE FROM rate_cache WHERE expires <= ?', (time.time(),))
+        self._count('expirations', max(cursor.rowcount, 0))
+        if self.max_size is None:
+            return
+        excess = connection.execute(
+            'SELECT COUNT(*) FROM rate_cache').fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+        order = 'uses, used, rowid' if self.eviction == LFU else 'used, rowid'
+        cursor = connection.execute(
+            'DELETE FROM rate_cache WHERE key IN (SELECT key FROM rate_cache '
+            'ORDER BY %s LIMIT ?)' % order, (excess,))
+        self._count('evictions', max(cursor.rowcount, 0))
+
+    def delete(self, key):
+        cursor = self._connection().execute(
+            'DELETE FROM rate_cache WHERE key = ?', (str(key),))
+        return cursor.rowcount > 0
+
+    def clear(self):
+        self._connection().execute('DELETE FROM rate_cache')
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM rate_cache').fetchone()[0]
+
+    def stats(self):
+        """
+        Returns counters for how this process has used the cache so far. The
+        size is shared by all processes.
+        """
+        with self._lock:
+            result = {'hits': self.hits, 'misses': self.misses,
+                      'evictions': self.evictions,
+                      'expirations': self.expirations}
+        result['size'] = len(self)
+        result['max_size'] = self.max_size
+        return result
+
+
+BACKENDS = {
+    'memory': MemoryCache,
+    'sqlite': SqliteCache}
+
+_caches = {}
+_caches_lock = RLock()
+
+
+def cache_from_configuration(settings):
+    """
+    Gets the cache described by the 'cache' section of a postal configuration.
+    Carriers built from equivalent settings share a single cache.
+
+    The backend setting can be the name of one of the BACKENDS or an
+    already constructed CacheBackend.
+    """
+    settings = settings or {}
+    backend = settings.get('backend', 'memory')
+    if isinstance(backend, CacheBackend):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError("Unknown cache backend: %s" % backend)
+    options = {
+        'max_size': settings.get('max_size', 10000),
+        'eviction': settings.get('eviction', LRU)}
+    if backend == 'memory':
+        options['stripes'] = settings.get('stripes', 16)
+    else:
+        options['path'] = settings['path']
+    signature = (backend,) + tuple(sorted(options.items()))
+    with _caches_lock:
+        if signature not in _caches:
+            _caches[signature] = BACKENDS[backend](**options)
+        return _caches[signature]
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key. The first caller for a key
+    makes the call, and any others arriving while it's in flight wait for it
+    and share its result or error rather than making the call themselves.
+    Nothing is remembered once the call lands; that's the cache's job.
+    """
+    def __init__(self):
+        self._lock = RLock()
+        self._flights = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._flights.get(key)
+            if future is None:
+                future = self._flights[key] = futures.Future()
+                self.calls += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException:
+            info = sys.exc_info()
+            self._land(key)
+            future.set_exception_info(info[1], info[2])
+            raise info[0], info[1], info[2]
+        self._land(key)
+        future.set_result(result)
+        return result
+
+    def _land(self, key):
+        with self._lock:
+            del self._flights[key]
+
+    def stats(self):
+        """
+        Returns how many calls were made, how many callers shared a call
+        already in flight instead (the calls saved), and how many calls are
+        in flight now.
+        """
+        with self._lock:
+            return {'calls': self.calls, 'shared': self.shared,
+                    'in_flight': len(self._flights)}
+
+
+class WsdlCache(ObjectCache):
+    """
+    Keeps parsed WSDL definitions on disk so that building a suds client
+    doesn't have to parse the WSDL and schema files again. Use it with
+    cachingpolicy=1.
+
+    Entries are written to a temporary file and then renamed into place, so
+    processes warming the cache at the same time never read partial entries.
+    """
+    def get(self, id):
+        handle = self.getf(id)
+        if handle is None:
+            return None
+        # Definitions unpickle into a great many small objects, which sets
+        # off the garbage collector over and over for nothing.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            with handle:
+                return pickle.load(handle)
+        except Exception:
+            self.purge(id)
+        finally:
+            if collecting:
+                gc.enable()
+
+    def open(self, fn, *args):
+        """
+        Opens cache files as FileCache does, except that files opened for
+        writing are written beside fn and only renamed to it once closed.
+        """
+        if args and 'w' in args[0]:
+            self.mktmp()
+            return _AtomicFile(fn)
+        return ObjectCache.open(self, fn, *args)
+
+
+class _AtomicFile(object):
+    """
+    A file written under a temporary name, which takes the name path when
+    it's closed, unless a write to it failed.
+    """
+    def __init__(self, path):
+        self.path = path
+        handle, self.temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path))
+        self.file = os.fdopen(handle, 'wb')
+        self.failed = False
+
+    def write(self, data):
+        try:
+            self.file.write(data)
+        except Exception:
+            self.failed = True
+            raise
+
+    def close(self):
+        try:
+            self.file.close()
+        except Exception:
+            self.failed = True
+            raise
+        finally:
+            if self.failed:
+                os.remove(self.temp_path)
+            else:
+                os.rename(self.temp_path, self.path)
+
+
+_wsdl_caches = {}
+_wsdl_digests = {}
+
+
+def wsdl_digest(directory):
+    """
+    A digest of the contents of every file in directory, along with the
+    Python version, since cached definitions are pickled.
+    """
+    with _caches_lock:
+        if directory in _wsdl_digests:
+            return _wsdl_digests[directory]
+    result = hashlib.sha1('%s.%s' % sys.version_info[:2])
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        result.update(name)
+        with open(path, 'rb') as wsdl_file:
+            result.update(hashlib.sha1(wsdl_file.read()).hexdigest())
+    with _caches_lock:
+        _wsdl_digests[directory] = result.hexdigest()
+        return _wsdl_digests[directory]
+
+
+def wsdl_cache(directory, location=None):
+    """
+    Gets the WsdlCache for the WSDL files in directory. Entries live under
+    location, in a folder named for the digest of the files, so that any
+    change to them is picked up on the next start.
+    """
+    location = location or os.path.join(
+        tempfile.gettempdir(), 'postal-wsdl')
+    location = os.path.join(location, wsdl_digest(directory))
+    with _caches_lock:
+        if location not in _wsdl_caches:
+            _wsdl_caches[location] = WsdlCache(location)
+        return _wsdl_caches[location]
@@ -3,20 +3,18 @@ from xml.etree.ElementTree import iterparse
 
 from StringIO import StringIO
 
-from concurrent import futures
 from dateutil import parser
 
 from postal.data import Address, country_map
-from suds.client import Client, TypeNotFound
+from suds.client import TypeNotFound
 from money import Money
 
-from postal.carriers.base import Carrier, ClearEmpty, PostalLogger
+from postal.carriers.base import Carrier, ClearEmpty, PostalLogger, lazy_client
 from postal.exceptions import CarrierError, AddressError, PostalError, SoftCarrierError
 from datetime import datetime
 from postal.data import Package
 from copy import deepcopy
 
-from postal.postal import ThreadPoolExecutorStackTraced
 from postal.data import Shipment
 from collections import OrderedDict
 from decimal import Decimal
@@ -36,6 +34,9 @@ class AramexApi(Carrier):
     Implements calls to the aramex api.
     """
     name = 'Aramex'
+    # Aramex doesn't document a limit on the waybills in one TrackShipments
+    # call, so this keeps to a modest number.
+    track_batch_size = 50
 
     _code_to_description = {
         'PDX': 'Priority document express',
@@ -95,16 +96,14 @@ class AramexApi(Carrier):
         'City name is invalid': 'ERR52-b'
     }
 
-    _rate_client = None
     _priority_letter_limit = 1.10231
     carrier_error = None
-    _ship_client = None
-    _track_client = None
+
+    wsdl_files = ('rates.wsdl', 'shipping.wsdl', 'tracking.wsdl')
 
     def create_client(self, wsdl_name):
-        client = Client(
-            self.service_url(wsdl_name), plugins=[ClearEmpty(), self.log_service],
-            timeout=self.postal_configuration.get('timeout', None))
+        client = self.soap_client(
+            wsdl_name, plugins=[ClearEmpty(), self.log_service])
 
         return client
 
@@ -124,23 +123,17 @@ class AramexApi(Carrier):
         self.version = 1
         self.test = True
 
-    @property
+    @lazy_client
     def rates_client(self):
-        if not self._rate_client:
-            self._rate_client = self.create_client('rates.wsdl')
-        return self._rate_client
+        return self.create_client('rates.wsdl')
 
-    @property
+    @lazy_client
     def ship_client(self):
-        if not self._ship_client:
-            self._ship_client = self.create_client('shipping.wsdl')
-        return self._ship_client
+        return self.create_client('shipping.wsdl')
 
-    @property
+    @lazy_client
     def track_client(self):
-        if not self._track_client:
-            self._track_client = self.create_client('tracking.wsdl')
-        return self._track_client
+        return self.create_client('tracking.wsdl')
 
     def requested_shipment_details(self, request):
         api_request = self.rates_client.factory.create('RateCalculatorRequest')
@@ -370,18 +363,85 @@ class AramexApi(Carrier):
             if err.message == u'<NonExistingWaybills/> not mapped to message part':
                 raise SoftCarrierError(u"NonExistingWaybills")
             return False
-        response = self.log_service.last_received_reply
-        it = iterparse(StringIO(response.encode('utf-8')))
-        for _, el in it:
-            if '}' in el.tag:
-                el.tag = el.tag.split('}', 1)[1]  # strip all namespaces
-        response = it.root
-        result = response.find('Body').find(
-            'ShipmentTrackingResponse').find('TrackingResults').find(
+        response = self.tracking_results(
+            self.log_service.last_received_reply)
+        result = response.find(
                 'KeyValueOfstringArrayOfTrackingResultmFAkxlpY'
         ).find(
             'Value'
         ).find('TrackingResult')
+        return self.tracking_result(result)
+
+    def track_batch(self, identifiers):
+        try:
+            response = self.tracking_reply(identifiers)
+        except Exception as err:
+            return {identifier: err for identifier in identifiers}
+        results = {}
+        for entry in response.findall(
+                'KeyValueOfstringArrayOfTrackingResultmFAkxlpY'):
+            identifier = entry.findtext('Key')
+            try:
+                results[identifier] = self.tracking_result(
+                    entry.find('Value').find('TrackingResult'))
+            except Exception as err:
+                results[identifier] = err
+        for identifier in identifiers:
+            # Numbers Aramex doesn't know are listed in NonExistingWaybills.
+            results.setdefault(
+                identifier, SoftCarrierError(u"NonExistingWaybills"))
+        return results
+
+    def track_events(self, identifier):
+        response = self.tracking_reply([identifier], last_only=False)
+        for entry in response.findall(
+                'KeyValueOfstringArrayOfTrackingResultmFAkxlpY'):
+            if entry.findtext('Key') == identifier:
+                events = [self.tracking_result(result) for result in
+                          entry.find('Value').findall('TrackingResult')]
+                return sorted(events, key=lambda event: event['event_time'])
+        raise SoftCarrierError(u"NonExistingWaybills")
+
+    def tracking_reply(self, identifiers, last_only=True):
+        """
+        Calls TrackShipments for identifiers and returns the TrackingResults
+        element of the reply. With last_only unset, each shipment's whole
+        history comes back rather than its latest update.
+        """
+        client_info = self.client_info
+        transaction = self.track_client.factory.create('Transaction')
+        tracking_numbers = self.track_client.factory.create('ns1:ArrayOfstring')
+        tracking_numbers.string.extend(identifiers)
+        self.log_service.last_received_reply = None
+        try:
+            self.service_call(
+                self.track_client.service.TrackShipments,
+                client_info, transaction, tracking_numbers, last_only)
+        except Exception:
+            # Aramex's wsdl can't describe the reply (see track()), but the
+            # raw XML is still there to read if the call made it that far.
+            if self.log_service.last_received_reply is None:
+                raise
+        return self.tracking_results(self.log_service.last_received_reply)
+
+    @staticmethod
+    def tracking_results(reply):
+        """
+        Finds the TrackingResults in the raw XML of a TrackShipments reply.
+        """
+        it = iterparse(StringIO(reply.encode('utf-8')))
+        for _, el in it:
+            if '}' in el.tag:
+                el.tag = el.tag.split('}', 1)[1]  # strip all namespaces
+        return it.root.find('Body').find(
+            'ShipmentTrackingResponse').find('TrackingResults')
+
+    @staticmethod
+    def tracking_result(result):
+        """
+        Converts one TrackingResult element into the dictionary track()
+        returns.
+        """
         event_code = result.findtext('UpdateCode')
         try:
             city, country = result.findtext('UpdateLocation').split(', ')
@@ -407,13 +467,8 @@ class AramexApi(Carrier):
         AramexApi.carrier_error = None
         request, ship = request_info
         requests = self.get_requests((request, ship), service=service)
-        with ThreadPoolExecutorStackTraced(max_workers=len(requests)) as executor:
-            futures_with_service = {
-                executor.submit(self.get_request_rate, api_request, ship): service for api_request in requests
-            }
-            results = []
-            for future in futures.as_completed(futures_with_service):
-                results.append(future.result())
+        results = self.executor.map(
+            self.name, self.get_request_rate, requests, [ship] * len(requests))
 
         if AramexApi.carrier_error:
             if ship:
@@ -8,15 +8,18 @@ instantiated by Carrier classes to describe a method by which a package may
 be sent.
 """
 from base64 import b64encode
+from collections import OrderedDict
 import sys
 import logging
-from threading import RLock
+from threading import RLock, Thread, local
 from io import BytesIO
-from datetime import datetime, timedelta
+from datetime import datetime
 import inspect
 import os
 from pprint import pformat
 import re
+import socket
+import time
 from itertools import izip_longest
 
 from reportlab.lib import colors
@@ -28,10 +31,21 @@ from reportlab.lib.units import inch
 from reportlab.platypus import Table, TableStyle, SimpleDocTemplate, Image
 from reportlab.platypus.para import Paragraph
 
+from requests.exceptions import ConnectionError as RequestsConnectionError, \
+    HTTPError, Timeout
+from suds.cache import NoCache
+from suds.client import Client
 from suds.plugin import MessagePlugin
+from suds.transport import TransportError
 
+from ..breakers import breaker_from_configuration, unguarded
+from ..cache import MemoryCache, SingleFlight, cache_from_configuration, \
+    wsdl_cache
 from ..exceptions import CarrierError, PostalError
-from postal.data import PackageType
+from ..executor import executor_from_configuration
+from ..limits import limiter_from_configuration, unlimited
+from ..sessions import SessionTransport, session_from_configuration
+from postal.data import PackageType, Request
 from postal.exceptions import NotSupportedError
 
 
@@ -72,6 +86,13 @@ class PostalLogger(object):
         # finding a way to use custom log levels with Django
         self.logger.info(message)
 
+    def debugging(self):
+        """
+        Whether debug() messages are logged anywhere, so that callers can skip
+        formatting messages that would be thrown away.
+        """
+        return self.logger.isEnabledFor(logging.INFO)
+
     def debug_header(self, title):
         self.debug((" %s: %s " % (self.carrier_name, title)).center(50, "="))
 
@@ -110,11 +131,27 @@ class ClearEmpty(MessagePlugin):
 
 class LoggingWebServicePlugin(MessagePlugin):
     """
-    Adds logged messages to recent transmissions.
+    Adds logged messages to recent transmissions. They're kept for each
+    thread, so that calls made at once don't see each other's messages.
     """
     def __init__(self):
-        self.last_sent_message = None
-        self.last_received_reply = None
+        self._recent = local()
+
+    @property
+    def last_sent_message(self):
+        return getattr(self._recent, 'sent', None)
+
+    @last_sent_message.setter
+    def last_sent_message(self, message):
+        self._recent.sent = message
+
+    @property
+    def last_received_reply(self):
+        return getattr(self._recent, 'received', None)
+
+    @last_received_reply.setter
+    def last_received_reply(self, reply):
+        self._recent.received = reply
 
     def sending(self, context):
         if context.envelope:
@@ -131,6 +168,80 @@ class LoggingWebServicePlugin(MessagePlugin):
         return self.last_received_reply
 
 
+class RateGranularity(object):
+    """
+    Decides which parts of a request a carrier's rates are fetched and cached
+    for. Rates for a request made of several parts are the rates of its parts
+    combined, so parts shared with earlier requests come from the cache.
+    """
+    name = None
+
+    def parts(self, request):
+        """
+        Returns the requests to rate in place of request.
+        """
+        raise NotImplementedError
+
+
+class PerRequest(RateGranularity):
+    """
+    Rates each request as a whole. Use this for carriers whose rates for a
+    shipment aren't the sum of the rates for its packages.
+    """
+    name = 'request'
+
+    def parts(self, request):
+        return [request]
+
+
+class PerPackage(RateGranularity):
+    """
+    Rates each package of a request as a shipment of its own.
+    """
+    name = 'package'
+
+    def parts(self, request):
+        if len(request.packages) == 1:
+            return [request]
+        return [
+            Request(request.origin, request.destination, [package],
+                    request.ship_datetime, request.extra_params)
+            for package in request.packages]
+
+
+RATE_GRANULARITIES = {
+    policy.name: policy for policy in (PerRequest, PerPackage)}
+
+
+class lazy_client(object):
+    """
+    Decorator for carrier methods that build a suds client. The client is
+    built the first time the attribute is read and kept on the carrier after
+    that, so carriers only pay for the clients they actually use. Building is
+    done under the carrier's client lock, so concurrent first reads build the
+    client only once.
+    """
+    def __init__(self, build):
+        self.build = build
+        self.attribute = '_lazy_%s' % build.__name__
+        self.__doc__ = build.__doc__
+
+    def __get__(self, carrier, owner):
+        if carrier is None:
+            return self
+        try:
+            return carrier.__dict__[self.attribute]
+        except KeyError:
+            pass
+        with carrier._client_lock:
+            if self.attribute not in carrier.__dict__:
+                carrier.__dict__[self.attribute] = self.build(carrier)
+            return carrier.__dict__[self.attribute]
+
+    def __set__(self, carrier, client):
+        carrier.__dict__[self.attribute] = client
+
+
 class Carrier(object):
     name = 'Undefined Carrier'
     # If a carrier provides Address Validation Services, this should be set
@@ -153,7 +264,47 @@ class Carrier(object):
     # You will have to handle these carriers differently to clean up after
     # them.
     atomic_multiship = True
-    cache = {}
+    # Rate cache used when the postal configuration doesn't describe one.
+    # Carrier instances replace this with the cache from their configuration.
+    cache = MemoryCache()
+    # Coalesces concurrent lookups of the same uncached rates, for every
+    # carrier, since cache keys already include the carrier.
+    flights = SingleFlight()
+    # WSDL files bundled with this carrier, under wsdl/<carrier name>.
+    wsdl_files = ()
+    # Options in carrier_inits that every carrier understands, which are set
+    # as attributes rather than passed to the carrier's constructor.
+    generic_options = (
+        'soft_timeout', 'timeout', 'rate_granularity', 'ship_concurrency',
+        'track_concurrency', 'rate_limit', 'circuit_breaker')
+    # Seconds Postal.options() waits on this carrier before giving up on it,
+    # or None to wait as long as the overall deadline allows.
+    soft_timeout = None
+    # Seconds each HTTP call to this carrier may take, or None to use the
+    # 'timeout' of the postal configuration.
+    timeout = None
+    # Seconds each HTTP call may take when neither this carrier's 'timeout'
+    # nor the postal configuration's is set, or None for no limit.
+    default_timeout = None
+    # How rates are fetched and cached: the name of one of the
+    # RATE_GRANULARITIES, or a RateGranularity.
+    rate_granularity = 'request'
+    # The most packages of a shipment labelled at once, for carriers that
+    # make a call for each.
+    ship_concurrency = 4
+    # The most identifiers track_batch() takes in one call upstream, and the
+    # most of those calls track_many() makes at once.
+    track_batch_size = 1
+    track_concurrency = 8
+    # Limits on calls to this carrier, as described in postal.limits, or None
+    # for no limits.
+    rate_limit = None
+    # Settings for the circuit breaker around calls to this carrier, as
+    # described in postal.breakers, or None for no breaker.
+    circuit_breaker = None
+    # Seconds a cached rate stays valid when the configuration doesn't set a
+    # time to live for this carrier.
+    default_cache_ttl = 1800
 
     # Master dictionary of primarily supported Service Codes. Preferably, this
     # should contain all service codes, but it may only contain ones that are
@@ -197,12 +348,126 @@ class Carrier(object):
 
     def __init__(self, postal_configuration):
         self.postal_configuration = postal_configuration
+        self._client_lock = RLock()
         self.logger = PostalLogger(carrier_name=self.name)
         # Add this to any suds clients as a plugin and then use
         # last_sent() and last_received() on it to grab recent messages.
         self.log_service = LoggingWebServicePlugin()
         if not postal_configuration:
             raise PostalError("Postal Configuration not set.")
+        if 'cache' in postal_configuration:
+            self.cache = cache_from_configuration(
+                postal_configuration['cache'])
+
+    @classmethod
+    def from_configuration(cls, postal_configuration):
+        """
+        Builds the carrier from its entry in the carrier_inits of
+        postal_configuration.
+        """
+        options = dict(postal_configuration['carrier_inits'][cls.name])
+        generic = {key: options.pop(key) for key in cls.generic_options
+                   if key in options}
+        carrier = cls(postal_configuration=postal_configuration, **options)
+        for key, value in generic.items():
+            setattr(carrier, key, value)
+        return carrier
+
+    @property
+    def executor(self):
+        """
+        The shared executor that concurrent calls to the carrier should be
+        submitted to.
+        """
+        return executor_from_configuration(
+            self.postal_configuration.get('executor'))
+
+    @property
+    def call_timeout(self):
+        """
+        Seconds each HTTP call to the carrier may take.
+        """
+        if self.timeout is not None:
+            return self.timeout
+        timeout = self.postal_configuration.get('timeout')
+        if timeout is not None:
+            return timeout
+        return self.default_timeout
+
+    @property
+    def limiter(self):
+        """
+        The Limiter calls to the carrier wait on, or None if it has no
+        rate_limit.
+        """
+        return limiter_from_configuration(self.name, self.rate_limit)
+
+    def throttle(self, max_wait=None):
+        """
+        Returns a context manager to make each call to the carrier in, which
+        waits for room under its rate_limit first. A max_wait overrides the
+        rate_limit's own, so 0 fails fast.
+        """
+        limiter = self.limiter
+        if limiter is None:
+            return unlimited()
+        if max_wait is None:
+            max_wait = self.rate_limit.get('max_wait')
+        return limiter.limit(max_wait)
+
+    @property
+    def breaker(self):
+        """
+        The CircuitBreaker calls to the carrier go through, or None if it has
+        no circuit_breaker.
+        """
+        return breaker_from_configuration(self.name, self.circuit_breaker)
+
+    def available(self):
+        """
+        Whether calls to the carrier are being let through, which they aren't
+        while its circuit breaker is open.
+        """
+        breaker = self.breaker
+        return breaker is None or breaker.available()
+
+    def circuit(self):
+        """
+        Returns a context manager to make each call to the carrier in, which
+        raises a CarrierUnavailableError instead while its circuit breaker is
+        open. It yields a breakers.Call, to be marked failed when the carrier
+        doesn't answer.
+        """
+        breaker = self.breaker
+        if breaker is None:
+            return unguarded()
+        return breaker.call()
+
+    @staticmethod
+    def unanswered(err):
+        """
+        Whether err, raised by a call to the carrier, means the carrier never
+        answered, which counts against its circuit breaker: the connection
+        failed or timed out, or the carrier's server failed. A reply that
+        came back but couldn't be read still means the carrier is up.
+        """
+        if isinstance(err, HTTPError):
+            return err.response is not None and err.response.status_code >= 500
+        return isinstance(
+            err, (RequestsConnectionError, Timeout, TransportError,
+                  socket.error))
+
+    def transport(self):
+        """
+        A suds transport for this carrier's clients, which makes calls over
+        the connections pooled for the postal configuration.
+        """
+        session = session_from_configuration(
+            self.postal_configuration.get('http_pool'))
+        options = {}
+        if self.call_timeout is not None:
+            options['timeout'] = self.call_timeout
+        return SessionTransport(session, **options)
 
     def __eq__(self, other):
         if not isinstance(other, Carrier):
@@ -216,58 +481,243 @@ class Carrier(object):
         return hash(self.name)
 
     def service_call(self, func, *args, **kwargs):
-        try:
-            return func(*args, **kwargs)
-        except Exception as err:
-            if hasattr(err, 'document'):
-                raise CarrierError(u"{}".format(err.document))
-            else:
+        with self.circuit() as call, self.throttle():
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                if self.unanswered(err):
+                    call.fail()
+                if hasattr(err, 'document'):
+                    raise CarrierError(u"{}".format(err.document))
                 raise CarrierError(repr(err))
-        finally:
-            self.log_transmission(func.client)
+            finally:
+                self.log_transmission(func.client)
 
     @classmethod
-    def service_url(cls, wsdl_name):
+    def wsdl_directory(cls):
         base_path = os.path.split(os.path.abspath(
             inspect.getfile(inspect.currentframe())))[0]
-        base_path = os.path.join(base_path, 'wsdl', cls.name.lower())
-        full_path = os.path.join(base_path, wsdl_name)
+        return os.path.join(base_path, 'wsdl', cls.name.lower())
+
+    @classmethod
+    def service_url(cls, wsdl_name):
+        full_path = os.path.join(cls.wsdl_directory(), wsdl_name)
         return "file://%s" % full_path
 
+    @classmethod
+    def wsdl_cache_options(cls, postal_configuration=None):
+        """
+        Client options that keep parsed copies of this carrier's WSDL files
+        in the WSDL cache, as set by the 'wsdl_cache' configuration key.
+        """
+        location = (postal_configuration or {}).get('wsdl_cache')
+        if location is False:
+            return {'cache': NoCache()}
+        return {
+            'cache': wsdl_cache(cls.wsdl_directory(), location),
+            'cachingpolicy': 1}
+
+    def soap_client(self, wsdl_name, **kwargs):
+        """
+        Builds a suds client for one of the WSDL files bundled with this
+        carrier.
+        """
+        kwargs.setdefault('transport', self.transport())
+        kwargs.update(self.wsdl_cache_options(self.postal_configuration))
+        return Client(self.service_url(wsdl_name), **kwargs)
+
+    @classmethod
+    def lazy_clients(cls):
+        """
+        Names of the clients this carrier builds on first use.
+        """
+        return sorted(
+            name for name in dir(cls)
+            if isinstance(getattr(cls, name), lazy_client))
+
+    def prewarm(self, clients=None, background=True):
+        """
+        Builds the named lazy clients, or all of them, ahead of their first
+        use. With background set, they're built in a daemon thread, which is
+        returned.
+        """
+        clients = self.lazy_clients() if clients is None else clients
+
+        def build():
+            for name in clients:
+                try:
+                    getattr(self, name)
+                except Exception:
+                    self.logger.exception(
+                        "While prewarming the %s client" % name)
+
+        if not background:
+            return build()
+        thread = Thread(target=build, name='%s prewarm' % self.name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @classmethod
+    def warm_wsdl_cache(cls, postal_configuration=None):
+        """
+        Parses each of the carrier's wsdl_files into the WSDL cache, so that
+        the next carrier constructed doesn't have to.
+        """
+        options = cls.wsdl_cache_options(postal_configuration)
+        for wsdl_name in cls.wsdl_files:
+            Client(cls.service_url(wsdl_name), **options)
+
+    def rate_signature(self, request):
+        """
+        The parts of request that can change the rates this carrier returns.
+        Carriers should narrow this to the fields they actually send upstream,
+        so that requests differing only in other fields share cached rates.
+        """
+        return {
+            'origin': self.get_origin(request),
+            'destination': request.destination,
+            'packages': request.packages,
+            'ship_datetime': request.ship_datetime,
+            'extra_params': request.extra_params}
+
     @staticmethod
-    def cache_key(request, provider=''):
-        _cache_key = str(provider)
-        _cache_key += str(request.destination.cache_hash())
-        for package in request.packages:
-            _cache_key += str(package.cache_hash())
-        for key in request.extra_params:
-            _cache_key += '{key}:{value}'.format(
-                key=key,
-                value=request.extra_params[key]
-            )
-        return hash(_cache_key)
+    def rate_address(address):
+        """
+        The parts of an address used for rating, as opposed to those only
+        printed on labels.
+        """
+        return [address.street_lines, address.city, address.subdivision,
+                address.postal_code, address.country.alpha2,
+                address.residential]
+
+    def cache_key(self, request, provider=''):
+        """
+        A key for the rates of request that's the same in every process.
+        """
+        provider = provider or self.name
+        fingerprint = request.fingerprint(
+            (provider, id(self)), lambda: self.rate_signature(request))
+        return '%s:%s' % (provider, fingerprint)
+
+    def cache_ttl(self):
+        """
+        Number of seconds rates from this carrier should stay in the cache.
+        """
+        ttls = self.postal_configuration.get('cache', {}).get('ttl', {})
+        return ttls.get(self.name, ttls.get('default', self.default_cache_ttl))
 
     def cache_results(self, request, response_dict, provider=''):
         """
         Avoid looking up information on an object more than we must.
         """
-        # For now, we make this in-process.
-        self.cache.update({
-            self.cache_key(request, provider): {
-                'response': response_dict,
-                'timestamp': datetime.now()
-            }
-        })
+        self.cache.set(
+            self.cache_key(request, provider), response_dict,
+            ttl=self.cache_ttl())
+
+    def cached_call(self, request, provider, fetch):
+        """
+        Returns the cached rates for request, or calls fetch() to get them and
+        caches them. Concurrent callers missing the cache for the same request
+        share a single call to fetch(), and its error if it fails.
+
+        The rates are also kept on the request for as long as they'd stay in
+        the cache, so that pricing each of its services individually doesn't
+        go back to the cache each time.
+        """
+        key = self.cache_key(request, provider)
+        rates = getattr(request, '_rates', None)
+        if rates is not None and key in rates:
+            expires, result = rates[key]
+            if expires > time.time():
+                return result
+        ttl = self.cache_ttl()
+        result = self.cache.get(key)
+        if result is None:
+            def load():
+                # A call for the same key may have landed since the lookup
+                # above.
+                result = self.cache.get(key)
+                if result is None:
+                    result = fetch()
+                    self.cache.set(key, result, ttl=ttl)
+                return result
+            result = self.flights.do(key, load)
+        if rates is not None:
+            rates[key] = (time.time() + ttl, result)
+        return result
+
+    def granularity(self):
+        """
+        The RateGranularity used for this carrier's rates.
+        """
+        if isinstance(self.rate_granularity, RateGranularity):
+            return self.rate_granularity
+        try:
+            return RATE_GRANULARITIES[self.rate_granularity]()
+        except KeyError:
+            raise PostalError(
+                "Unknown rate granularity: %s" % self.rate_granularity)
+
+    def granular_rates(self, request, provider, fetch):
+        """
+        Returns the rates for request, keyed by service ID. fetch(part) gets
+        the rates for each part of request the carrier's granularity splits it
+        into. Rates for each part are cached on their own, and parts not in
+        the cache are fetched concurrently.
+        """
+        parts = self.granularity().parts(request)
+        if len(parts) == 1:
+            return self.cached_call(
+                parts[0], provider, lambda: fetch(parts[0]))
+
+        def part_rates(part):
+            return self.cached_call(part, provider, lambda: fetch(part))
+
+        def combined():
+            return self.combine_rates(
+                request, self.executor.map(self.name, part_rates, parts))
+        return self.cached_call(
+            request, '%s-%s' % (provider, self.granularity().name), combined)
+
+    @staticmethod
+    def total_price(prices):
+        """
+        Gets the total price from a set of prices.
+        """
+        total = sum([price['total'] for price in prices])
+        base_price = sum([price['base_price'] for price in prices])
+        fees = total - base_price
+        return {
+            'total': total,
+            'base_price': base_price,
+            'fees': fees,
+        }
+
+    def combine_rates(self, request, tables):
+        """
+        Merges the rates for the parts of request in tables into the rates
+        for the whole of it. Only services available for every part are kept,
+        their prices added up and the latest delivery estimate used.
+        """
+        if not tables:
+            return {}
+        services = set.intersection(*[set(table) for table in tables])
+        combined = {}
+        for service_id in services:
+            rates = [table[service_id] for table in tables]
+            datetimes = [rate['delivery_datetime'] for rate in rates
+                         if rate['delivery_datetime'] is not None]
+            combined[service_id] = {
+                'price': self.total_price([rate['price'] for rate in rates]),
+                'delivery_datetime': max(datetimes) if datetimes else None}
+        return combined
 
     def get_from_cache(self, request, provider=''):
-        time_to_fetch = datetime.now() - timedelta(minutes=30)
-        _cache_key = self.cache_key(request, provider)
-        if _cache_key in self.cache:
-            if self.cache[_cache_key]['timestamp'] > time_to_fetch:
-                return self.cache[_cache_key]['response']
-            else:
-                del self.cache[_cache_key]
-        return False
+        response = self.cache.get(self.cache_key(request, provider))
+        if response is None:
+            return False
+        return response
 
     def get_all_services(self):
         """
@@ -378,6 +828,78 @@ class Carrier(object):
         """
         raise NotImplementedError
 
+    def track_events(self, identifier):
+        """
+        Returns every event in a shipment's history, oldest first, each shaped
+        like what track() returns. Carriers that can only tell the latest
+        event return just that one.
+        """
+        return [self.track(identifier)]
+
+    def track_batch(self, identifiers):
+        """
+        Tracks several shipments, returning a dictionary of each identifier to
+        what track() returns for it, or to the error tracking it raised.
+        Carriers whose APIs take several identifiers in one call should
+        override this and set track_batch_size.
+        """
+        results = {}
+        for identifier in identifiers:
+            try:
+                results[identifier] = self.track(identifier)
+            except Exception as err:
+                if not hasattr(err, 'traceback'):
+                    err.traceback = sys.exc_info()[2]
+                results[identifier] = err
+        return results
+
+    def track_many(self, identifiers):
+        """
+        Tracks each of identifiers, packing up to track_batch_size of them
+        into each call to track_batch(), and making up to track_concurrency of
+        those calls at once.
+
+        returns:
+        OrderedDict{
+            identifier:string -> {
+                'tracking' -> dict|None = what track() returns
+                                          or None if unsuccessful,
+                'error' -> Exception|None = the problem that occurred
+                                            or None if successful
+            },
+            ... = in the order of identifiers, each once
+        }
+        """
+        identifiers = list(OrderedDict.fromkeys(identifiers))
+        size = max(self.track_batch_size, 1)
+        batches = [identifiers[start:start + size]
+                   for start in range(0, len(identifiers), size)]
+
+        def track_batch(batch):
+            try:
+                return self.track_batch(batch)
+            except Exception as err:
+                if not hasattr(err, 'traceback'):
+                    err.traceback = sys.exc_info()[2]
+                return {identifier: err for identifier in batch}
+
+        results = {}
+        for batch_results in self.executor.map(
+                self.name, track_batch, batches,
+                limit=self.track_concurrency):
+            results.update(batch_results)
+        entries = OrderedDict()
+        for identifier in identifiers:
+            result = results.get(identifier)
+            if result is None:
+                result = CarrierError(
+                    "%s sent nothing back for %s." % (self.name, identifier))
+            if isinstance(result, Exception):
+                entries[identifier] = {'tracking': None, 'error': result}
+            else:
+                entries[identifier] = {'tracking': result, 'error': None}
+        return entries
+
     def get_all_package_types(self, generics=True):
         """
         Returns all package types supported by this carrier.
@@ -404,9 +926,14 @@ class Carrier(object):
         """
         Log last send/receive action from a SUDs client.
         """
+        sent = self.log_service.last_sent()
+        received = self.log_service.last_received()
         with self.logger.lock:
-            self.logger.sent(self.log_service.last_sent())
-            self.logger.received(self.log_service.last_received())
+            if sent is not None:
+                self.logger.sent(sent)
+            # Calls that never got an answer have no reply to log.
+            if received is not None:
+                self.logger.received(received)
 
     def expected_package_type(self, request, package):
         """
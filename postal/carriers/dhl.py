@@ -34,13 +34,14 @@ from dateutil.relativedelta import relativedelta
 
 from money import Money
 from postal.data import Address, country_map
-from requests import post, RequestException
+from requests import RequestException
 
 import pycountry
 
 from .base import Carrier, PostalLogger
 from .templates.constructor import load_template, populate_template
 from ..exceptions import CarrierError, NotSupportedError, SoftCarrierError
+from ..sessions import session_from_configuration
 from ..data import Shipment, TWOPLACES, sigfig
 
 class DHLApi(Carrier):
@@ -109,23 +110,30 @@ class DHLApi(Carrier):
         else:
             self.rates_url = rates_url
 
+        # Calls go over the connections pooled for the postal configuration,
+        # like the SOAP carriers' do.
+        self.session = session_from_configuration(
+            postal_configuration.get('http_pool'))
+
     def make_call(self, call, rates=False):
         headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Connection": "Close"}
+            "Content-Type": "application/x-www-form-urlencoded"}
         call = u'%s' % call
         call = call.encode('utf-8')
         if rates:
             url = self.rates_url
         else:
             url = self.url
-        try:
-            response = post(
-                url, data=call, headers=headers,
-                timeout=self.postal_configuration['timeout'])
-            response.raise_for_status()
-        except RequestException as err:
-            raise CarrierError("%s" % err)
+        with self.circuit() as outcome, self.throttle():
+            try:
+                response = self.session.post(
+                    url, data=call, headers=headers,
+                    timeout=self.call_timeout)
+                response.raise_for_status()
+            except RequestException as err:
+                if self.unanswered(err):
+                    outcome.fail()
+                raise CarrierError("%s" % err)
 
         with self.logger.lock:
             self.logger.sent(call)
@@ -225,19 +233,41 @@ class DHLApi(Carrier):
                 continue
         return response_dict
 
-    def get_services(self, request):
+    def rate_signature(self, request):
+        origin = self.get_origin(request)
+        ship_datetime = request.ship_datetime
+        return {
+            'origin': [origin.country.alpha2, origin.postal_code, origin.city],
+            'destination': [
+                request.destination.country.alpha2,
+                request.destination.postal_code, request.destination.city],
+            'pieces': [
+                [package.length, package.width, package.height,
+                 package.weight, package.declarations]
+                for package in request.packages],
+            'documents_only': request.documents_only(),
+            'ship_datetime': ship_datetime and ship_datetime.strftime(
+                '%Y-%m-%d %H:%M'),
+            'retail_rate': bool(request.extra_params.get('retail_rate'))}
+
+    def rate_table(self, request):
+        """
+        DHL's rates for request, keyed by service code, as cached.
+        """
         self._ensure_supported(request)
+        return self.granular_rates(request, 'dhl', self.fetch_rates)
 
-        response_dict = self.get_from_cache(request, 'dhl')
-        if not response_dict:
-            rate_request = self.rates_request(request)
+    def fetch_rates(self, request):
+        rate_request = self.rates_request(request)
 
-            with self.logger.lock:
-                self.logger.debug_with_header('GetServicesRequest', request)
+        with self.logger.lock:
+            self.logger.debug_with_header('GetServicesRequest', request)
+
+        response = self.make_call(rate_request, rates=True)[0][1]
+        return self.response_to_dict(response.findall('QtdShp'))
 
-            response = self.make_call(rate_request, rates=True)[0][1]
-            response_dict = self.response_to_dict(response.findall('QtdShp'))
-            self.cache_results(request, response_dict, 'dhl')
+    def get_services(self, request):
+        response_dict = self.rate_table(request)
 
         result = {
             self.get_service(key): {
@@ -530,67 +560,82 @@ class DHLApi(Carrier):
         return Money(charge, currency)
 
     def track(self, identifier):
+        events = self.track_events(identifier)
+        if events:
+            return events[-1]
+        return {
+            'delivered': False,
+            'finalized': False,
+            'status_code': u'',
+            'description': u'',
+            'event_time': None,
+            'location': False
+        }
+
+    def track_events(self, identifier):
         track_request = self.track_request(identifier)
         with self.logger.lock:
             self.logger.debug_with_header('Tracking', identifier)
 
         response = self.make_call(track_request)
 
-        result = {
+        if response.find('AWBInfo').find('ShipmentInfo') is not None:
+            # Events come oldest first, since we ask for ALL_CHECK_POINTS.
+            return [
+                self.tracking_event(details) for details in response.find(
+                    'AWBInfo').find('ShipmentInfo').findall('ShipmentEvent')]
+        condition = response.find('AWBInfo').find('Status').find('Condition')
+        conditionCode = condition.findtext('ConditionCode')
+        conditionData = condition.findtext('ConditionData')
+        if conditionCode == '209':
+            raise SoftCarrierError(u"{}".format(conditionData))
+        return [{
             'delivered': False,
             'finalized': False,
-            'status_code': u'',
-            'description': u'',
+            'status_code': u'{}'.format(conditionCode),
+            'description': u'{}'.format(conditionData),
             'event_time': None,
             'location': False
-        }
+        }]
 
-        if response.find('AWBInfo').find('ShipmentInfo') is not None:
-            events = response.find('AWBInfo').find('ShipmentInfo').findall('ShipmentEvent')
-            if len(events):
-                details = events[-1]
-                event = details.find('ServiceEvent')
-                event_code = event.findtext('EventCode')
-                event_time = parser.parse(details.findtext('Date') + ' ' + details.findtext('Time'))
-                result = {
-                    'delivered': event_code == 'OK',
-                    'finalized': event_code in ['OK'],
-                    'status_code': u'{}'.format(event_code),
-                    'description': u'{}'.format(event.findtext('Description')),
-                    'event_time': event_time
-                }
-                street = [' ']
-                city_country = details.find('ServiceArea').findtext('Description').split('-')
-                if len(city_country) == 3:
-                    city, place, country = city_country
-                    city = "{city} - {place}".format(city=city, place=place)
-                else:
-                    city, country = city_country
-                try:
-                    country = country_map[country.lower()].alpha2
-                except KeyError:
-                    try:
-                        country = pycountry.countries.get(alpha3=country).alpha2
-                    except KeyError:
-                        # By some reason DHL returns NGR code for Nigeria instead NGA
-                        if country == "NGR":
-                            country = pycountry.countries.get(alpha3="NGA")
-                        else:
-                            with self.logger.lock:
-                                self.logger.error("Unknown country received during tracking: {}".format(country))
-                result['location'] = Address(
-                    street_lines=street,
-                    city=u'{}'.format(city),
-                    country=country,
-                )
+    def tracking_event(self, details):
+        """
+        Converts a ShipmentEvent into the dictionary track() returns.
+        """
+        event = details.find('ServiceEvent')
+        event_code = event.findtext('EventCode')
+        event_time = parser.parse(details.findtext('Date') + ' ' + details.findtext('Time'))
+        result = {
+            'delivered': event_code == 'OK',
+            'finalized': event_code in ['OK'],
+            'status_code': u'{}'.format(event_code),
+            'description': u'{}'.format(event.findtext('Description')),
+            'event_time': event_time
+        }
+        street = [' ']
+        city_country = details.find('ServiceArea').findtext('Description').split('-')
+        if len(city_country) == 3:
+            city, place, country = city_country
+            city = "{city} - {place}".format(city=city, place=place)
         else:
-            condition = response.find('AWBInfo').find('Status').find('Condition')
-            conditionCode = condition.findtext('ConditionCode')
-            conditionData = condition.findtext('ConditionData')
-            if conditionCode == '209':
-                raise SoftCarrierError(u"{}".format(conditionData))
-            result['status_code'] = u'{}'.format(conditionCode)
-            result['description'] = u'{}'.format(conditionData)
+            city, country = city_country
+        try:
+            country = country_map[country.lower()].alpha2
+        except KeyError:
+            try:
+                country = pycountry.countries.get(alpha3=country).alpha2
+            except KeyError:
+                # By some reason DHL returns NGR code for Nigeria instead NGA
+                if country == "NGR":
+                    country = pycountry.countries.get(alpha3="NGA")
+                else:
+                    with self.logger.lock:
+                        self.logger.error("Unknown country received during tracking: {}".format(country))
+        result['location'] = Address(
+            street_lines=street,
+            city=u'{}'.format(city),
+            country=country,
+        )
         return result
 
     def ship(self, service, request):
@@ -639,25 +684,17 @@ class DHLApi(Carrier):
 
         return shipment_dict
 
-    def delivery_datetime(self, service, request):
-        self._ensure_supported(request)
-        data = self.get_from_cache(request, 'dhl')
-        if not data:
-            self.get_services(request)
-        data = self.get_from_cache(request, 'dhl').get(service.service_id, None)
+    def service_rate(self, service, request):
+        data = self.rate_table(request).get(service.service_id, None)
         if not data:
             raise NotSupportedError("DHL does not support shipment of that package(s).")
-        return data['delivery_datetime']
+        return data
+
+    def delivery_datetime(self, service, request):
+        return self.service_rate(service, request)['delivery_datetime']
 
     def quote(self, service, request):
-        self._ensure_supported(request)
-        data = self.get_from_cache(request, 'dhl')
-        if not data:
-            self.get_services(request)
-        data = self.get_from_cache(request, 'dhl').get(service.service_id, None)
-        if not data:
-            raise NotSupportedError("DHL does not support shipment of that package(s).")
-        return data['price']
+        return self.service_rate(service, request)['price']
 
 
 # DHL product code (
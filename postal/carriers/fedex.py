@@ -6,16 +6,16 @@ from collections import OrderedDict
 from datetime import datetime
 from math import ceil
 from pprint import pformat
+import sys
 import warnings
 from PyPDF2.utils import PdfReadWarning
 from decimal import Decimal
 from money import Money
 from PyPDF2 import PdfFileReader, PdfFileWriter
-from suds.client import Client
 
-from .base import Carrier, ClearEmpty, PY3, PostalLogger
+from .base import Carrier, ClearEmpty, PY3, PostalLogger, lazy_client
 from ..exceptions import CarrierError, NotSupportedError, PostalError, \
-    AddressError, SoftCarrierError
+    AddressError, SoftCarrierError, PartialShipmentError
 from ..data import Address, Shipment, Declaration
 
 from io import BytesIO
@@ -30,6 +30,8 @@ class FedExApi(Carrier):
     """
     name = 'FedEx'
     address_validation = True
+    # TrackRequest takes up to 30 SelectionDetails.
+    track_batch_size = 30
     _code_to_description = {
         'FIRST_OVERNIGHT': 'First Overnight',
         'PRIORITY_OVERNIGHT': 'Priority Overnight',
@@ -97,10 +99,14 @@ class FedExApi(Carrier):
         'INTERNATIONAL_PRIORITY': (1, 3),
         'EUROPE_FIRST_INTERNATIONAL_PRIORITY': (1, 1)}
 
+    wsdl_files = (
+        'RateService_v14.wsdl', 'AddressValidationService_v2.wsdl',
+        'ShipService_v13.wsdl', 'UploadDocumentService_v1.wsdl',
+        'TrackService_v12.wsdl')
+
     def create_client(self, wsdl_name):
-        client = Client(
-            self.service_url(wsdl_name), plugins=[ClearEmpty(), self.log_service],
-            timeout=self.postal_configuration.get('timeout', None))
+        client = self.soap_client(
+            wsdl_name, plugins=[ClearEmpty(), self.log_service])
         location = ''
         for service in client.wsdl.services:
             for port in service.ports:
@@ -122,18 +128,30 @@ class FedExApi(Carrier):
         self.meter_number = meter_number
         self.test = test
 
-        self.rates_client = self.create_client('RateService_v14.wsdl')
 
-        self.address_client = self.create_client('AddressValidationService_v2.wsdl')
+    @lazy_client
+    def rates_client(self):
+        return self.create_client('RateService_v14.wsdl')
+
+    @lazy_client
+    def address_client(self):
+        return self.create_client('AddressValidationService_v2.wsdl')
 
-        self.ship_client = self.create_client('ShipService_v13.wsdl')
+    @lazy_client
+    def ship_client(self):
+        return self.create_client('ShipService_v13.wsdl')
 
-        self.upload_client = self.create_client('UploadDocumentService_v1.wsdl')
+    @lazy_client
+    def upload_client(self):
+        return self.create_client('UploadDocumentService_v1.wsdl')
 
-        self.tracking_client = self.create_client('TrackService_v12.wsdl')
+    @lazy_client
+    def tracking_client(self):
+        return self.create_client('TrackService_v12.wsdl')
 
-        self.contact_type = (
-            self.rates_client.factory.create('Party').__class__)
+    @property
+    def contact_type(self):
+        return self.rates_client.factory.create('Party').__class__
 
     def authentication(self, client):
         auth = client.factory.create('WebAuthenticationDetail')
@@ -440,20 +458,68 @@ class FedExApi(Carrier):
         package_details[package] = {
             'tracking_number': str(master_tracking_id.TrackingNumber),
             'label': self.decode_label(detail.Label.Parts[0].Image)}
-        for sequence_num, package in enumerate(request.packages[1:]):
-            sequence_num += 2
+
+        def ship_child(sequence_num, package):
             requested_shipment = self.requested_shipment(
                 service, request, package, sequence_num=sequence_num,
                 tracking_number=master_tracking_id)
-            result = self.service_call(
-                self.ship_client.service.processShipment, auth, client_detail,
-                transaction_detail, version_id, requested_shipment)
-
-            detail = result.CompletedShipmentDetail.CompletedPackageDetails[0]
+            try:
+                return self.service_call(
+                    self.ship_client.service.processShipment, auth,
+                    client_detail, transaction_detail, version_id,
+                    requested_shipment), None
+            except Exception as err:
+                if not hasattr(err, 'traceback'):
+                    err.traceback = sys.exc_info()[2]
+                return None, err
+
+        # Children only depend on the master's tracking number, so they're
+        # shipped concurrently once it's known. Every child's outcome is
+        # collected, so that labels bought alongside a failed one are still
+        # reported.
+        children = request.packages[1:]
+        outcomes = self.executor.map(
+            self.name, ship_child, range(2, len(children) + 2), children,
+            limit=self.ship_concurrency)
+        results = []
+        errors = []
+        for package, (child, err) in zip(children, outcomes):
+            if err is not None:
+                errors.append(err)
+                package_details[package] = {
+                    'label': None, 'tracking_number': None}
+                continue
+            results.append(child)
+            detail = child.CompletedShipmentDetail.CompletedPackageDetails[0]
             package_details[package] = {
                 'tracking_number': str(
                     detail.TrackingIds[0].TrackingNumber),
                 'label': self.decode_label(detail.Label.Parts[0].Image)}
+        if errors:
+            tracking_number = str(master_tracking_id.TrackingNumber)
+            shipment_dict = {
+                'shipment': Shipment(self, tracking_number),
+                'packages': package_details,
+                'price': None,
+                'alerts': alerts + [str(err) for err in errors]}
+            with self.logger.lock:
+                self.logger.shipment_response(shipment_dict)
+            err = PartialShipmentError(
+                "FedEx shipped %s of %s packages under tracking number %s "
+                "before failing: %s" % (
+                    len(request.packages) - len(errors),
+                    len(request.packages), tracking_number, errors[0]),
+                shipment=shipment_dict)
+            # Points at the child that failed, not at this raise.
+            err.traceback = errors[0].traceback
+            raise err
+        if results:
+            # The rating for the whole shipment comes back with whichever
+            # package FedEx processed last, which needn't be the last one
+            # sent.
+            rated = [child for child in results if hasattr(
+                child.CompletedShipmentDetail, 'ShipmentRating')]
+            result = rated[-1] if rated else results[-1]
         tracking_number = str(master_tracking_id.TrackingNumber)
 
         try:
@@ -681,35 +747,53 @@ class FedExApi(Carrier):
         special_services.SpecialServiceTypes = ['SIGNATURE_OPTION']
         special_services.SignatureOptionDetail.OptionType = sig.upper()
 
-    def get_services(self, request):
+    def rate_signature(self, request):
+        extra_params = request.extra_params
+        return {
+            'origin': self.rate_address(self.get_origin(request)),
+            'destination': self.rate_address(request.destination),
+            'packages': request.packages,
+            'ship_datetime': request.ship_datetime,
+            'extra_params': {
+                key: extra_params.get(key) for key in (
+                    'saturday_delivery', 'signature_required', 'retail_rate',
+                    'fedex_duties_account', 'duties_address')}}
+
+    def rate_table(self, request):
         """
-        Get available services for shipping a package.
+        FedEx's rates for request, keyed by service code, as cached.
         """
-        result = self.get_from_cache(request, 'fedex')
-        if not result:
-            self._ensure_supported(request)
-            auth = self.authentication(self.rates_client)
-            client = self.user_client(self.rates_client)
-            transaction_detail = self.transaction_detail(self.rates_client)
-            version = self.rates_version_id()
-            return_transit = False
-            codes = []
-            variable_options = []
-            requested_shipment = self.requested_shipment_rate(request)
+        return self.granular_rates(request, 'fedex', self.fetch_rates)
 
-            with self.logger.lock:
-                self.logger.debug_with_header('GetServicesRequest', request)
+    def fetch_rates(self, request):
+        self._ensure_supported(request)
+        auth = self.authentication(self.rates_client)
+        client = self.user_client(self.rates_client)
+        transaction_detail = self.transaction_detail(self.rates_client)
+        version = self.rates_version_id()
+        return_transit = False
+        codes = []
+        variable_options = []
+        requested_shipment = self.requested_shipment_rate(request)
 
-            try:
-                response = self.service_call(
-                    self.rates_client.service.getRates,
-                    auth, client, transaction_detail, version, return_transit,
-                    codes, variable_options, requested_shipment)
-            finally:
-                self.log_transmission(self.rates_client)
+        with self.logger.lock:
+            self.logger.debug_with_header('GetServicesRequest', request)
+
+        try:
+            response = self.service_call(
+                self.rates_client.service.getRates,
+                auth, client, transaction_detail, version, return_transit,
+                codes, variable_options, requested_shipment)
+        finally:
+            self.log_transmission(self.rates_client)
 
-            result = self.rate_response_dict(request, response)
-            self.cache_results(request, result, 'fedex')
+        return self.rate_response_dict(request, response)
+
+    def get_services(self, request):
+        """
+        Get available services for shipping a package.
+        """
+        result = self.rate_table(request)
 
         final = {
             self.get_service(key): {
@@ -723,14 +807,18 @@ class FedExApi(Carrier):
 
         return final
 
+    def tracking_selection(self, identifier):
+        selection_details = self.tracking_client.factory.create('TrackSelectionDetail')
+        selection_details.PackageIdentifier.Type = 'TRACKING_NUMBER_OR_DOORTAG'
+        selection_details.PackageIdentifier.Value = identifier
+        return selection_details
+
     def track(self, identifier):
         auth = self.authentication(self.tracking_client)
         client = self.user_client(self.tracking_client)
         transaction_detail = self.transaction_detail(self.tracking_client)
         version = self.tracking_version_id()
-        selection_details = self.tracking_client.factory.create('TrackSelectionDetail')
-        selection_details.PackageIdentifier.Type = 'TRACKING_NUMBER_OR_DOORTAG'
-        selection_details.PackageIdentifier.Value = identifier
+        selection_details = self.tracking_selection(identifier)
 
         response = self.call_tracking_api(auth,
                                           client,
@@ -739,7 +827,6 @@ class FedExApi(Carrier):
                                           selection_details,
                                           identifier)
 
-        result = {}
         if response.CompletedTrackDetails[0].DuplicateWaybill:
             # Sometimes fedex returns that airway bill is duplicated.
             # Update selections detail with tacking number unique ID
@@ -752,7 +839,94 @@ class FedExApi(Carrier):
                                               version,
                                               selection_details,
                                               identifier)
+        return self.tracking_result(
+            response.CompletedTrackDetails[0].TrackDetails[0])
+
+    def track_batch(self, identifiers):
+        auth = self.authentication(self.tracking_client)
+        client = self.user_client(self.tracking_client)
+        transaction_detail = self.transaction_detail(self.tracking_client)
+        version = self.tracking_version_id()
+        response = self.call_tracking_api(
+            auth, client, transaction_detail, version,
+            [self.tracking_selection(identifier) for identifier in identifiers],
+            ', '.join(identifiers))
+        # FedEx answers each selection in turn.
+        results = {}
+        for identifier, completed in zip(
+                identifiers, response.CompletedTrackDetails):
+            try:
+                if completed.DuplicateWaybill:
+                    # Needs a second call with the unique identifier, which
+                    # track() knows how to make.
+                    results[identifier] = self.track(identifier)
+                else:
+                    results[identifier] = self.tracking_result(
+                        completed.TrackDetails[0])
+            except Exception as err:
+                if not hasattr(err, 'traceback'):
+                    err.traceback = sys.exc_info()[2]
+                results[identifier] = err
+        return results
+
+    def track_events(self, identifier):
+        auth = self.authentication(self.tracking_client)
+        client = self.user_client(self.tracking_client)
+        transaction_detail = self.transaction_detail(self.tracking_client)
+        version = self.tracking_version_id()
+        selection_details = self.tracking_selection(identifier)
+        options = ['INCLUDE_DETAILED_SCANS']
+
+        response = self.call_tracking_api(
+            auth, client, transaction_detail, version, selection_details,
+            identifier, ProcessingOptions=options)
+        if response.CompletedTrackDetails[0].DuplicateWaybill:
+            # See track().
+            selection_details.TrackingNumberUniqueIdentifier = response.CompletedTrackDetails[0].TrackDetails[0].TrackingNumberUniqueIdentifier
+            response = self.call_tracking_api(
+                auth, client, transaction_detail, version, selection_details,
+                identifier, ProcessingOptions=options)
         track_details = response.CompletedTrackDetails[0].TrackDetails[0]
+        if hasattr(track_details, 'Notification'):
+            if track_details.Notification.Code == '9040':
+                raise SoftCarrierError(u"{}".format(track_details.Notification.Message))
+        # FedEx lists events newest first.
+        return [self.tracking_event(event)
+                for event in reversed(getattr(track_details, 'Events', []))]
+
+    @staticmethod
+    def tracking_event(event):
+        """
+        Converts one of FedEx's TrackEvents into the dictionary track()
+        returns.
+        """
+        code = getattr(event, 'EventType', u'')
+        result = {
+            'delivered': code == 'DL',
+            'finalized': code in ['DL', 'CA', 'DE'],
+            'status_code': u'{}'.format(code),
+            'description': u'{}'.format(getattr(event, 'EventDescription', u'')),
+            'event_time': getattr(event, 'Timestamp', None),
+            'location': False}
+        address = getattr(event, 'Address', None)
+        city = getattr(address, 'City', '')
+        country_code = getattr(address, 'CountryCode', '')
+        if city and country_code:
+            result['location'] = Address(
+                street_lines=[' '],
+                city=u'{}'.format(city),
+                subdivision=u'{}'.format(address.StateOrProvinceCode)
+                if hasattr(address, 'StateOrProvinceCode') else False,
+                country=u'{}'.format(country_code),
+            )
+        return result
+
+    def tracking_result(self, track_details):
+        """
+        Converts one of FedEx's TrackDetails into the dictionary track()
+        returns.
+        """
+        result = {}
         try:
             details = track_details.StatusDetail
         except AttributeError:
@@ -816,28 +990,19 @@ class FedExApi(Carrier):
             result['event_time'] = None
         return result
 
-    def delivery_datetime(self, service, request):
+    def service_rate(self, service, request):
         self._ensure_supported(request)
-        data = self.get_from_cache(request, 'fedex')
-        if not data:
-            self.get_services(request)
-        data = self.get_from_cache(request, 'fedex').get(service.service_id, None)
+        data = self.rate_table(request).get(service.service_id, None)
         if not data:
             raise NotSupportedError(
-                "FedEx does not support shipment of that package on this service."
-            )
-        return data['delivery_datetime']
+                "FedEx does not support shipment of that package on this service.")
+        return data
+
+    def delivery_datetime(self, service, request):
+        return self.service_rate(service, request)['delivery_datetime']
 
     def quote(self, service, request):
-        self._ensure_supported(request)
-        data = self.get_from_cache(request, 'fedex')
-        if not data:
-            self.get_services(request)
-        data = self.get_from_cache(request, 'fedex').get(service.service_id, None)
-        if not data:
-            raise NotSupportedError(
-                "FedEx does not support shipment of that package on this service.")
-        return data['price']
+        return self.service_rate(service, request)['price']
 
     def _ensure_supported(self, request):
         if request.destination.subdivision and \
@@ -846,15 +1011,18 @@ class FedExApi(Carrier):
                 'FedEx requires the use of ISO_3166-2 state/province codes, '
                 'not names.')
 
-    def call_tracking_api(self, auth, client, transaction_detail, version, selection_details, identifier):
+    def call_tracking_api(self, auth, client, transaction_detail, version, selection_details, identifier,
+                          **kwargs):
         """
         Actually call the tracking API.
         :param auth: suds WebAuthenticationDetail object with authorization credentials
         :param client: suds ClientDetail object with account number and meter number
         :param transaction_detail: suds TransactionDetail object
         :param version: suds VersionId object with used API version
-        :param selection_details: suds TrackSelectionDetail object with data for tracking shipment
-        :param identifier: Tracking number of the shipment
+        :param selection_details: suds TrackSelectionDetail object with data for tracking shipment,
+            or a list of them to track several shipments at once
+        :param identifier: Tracking number of the shipment, or numbers for logging
+        :param kwargs: any other parts of the TrackRequest, like ProcessingOptions
         :return: suds Reply object with data returned by tracking API
         """
         with self.logger.lock:
@@ -863,7 +1031,8 @@ class FedExApi(Carrier):
         try:
             response = self.service_call(
                 self.tracking_client.service.track,
-                auth, client, transaction_detail, version, selection_details
+                auth, client, transaction_detail, version, selection_details,
+                **kwargs
             )
         finally:
             self.log_transmission(self.rates_client)
@@ -1,5 +1,3 @@
-import inspect
-import os
 import sys
 
 from base64 import b64decode
@@ -7,28 +5,25 @@ from collections import OrderedDict
 from datetime import datetime
 from math import ceil
 from pprint import pformat
-from Queue import Queue
-from threading import Thread
 from io import BytesIO
 
 
 import PIL.Image
-import suds.cache
 
 try:
     import money
 except ImportError:
     import Money as money
 
-from suds.client import Client
 from suds.plugin import MessagePlugin
 from suds.sax.element import Element
 from suds import WebFault
 
-from .base import Carrier, PostalLogger
+from .base import Carrier, PostalLogger, lazy_client
 
-from ..data import Address, Shipment, country_map
-from ..exceptions import CarrierError, NotSupportedError, AddressError, SoftCarrierError
+from ..data import Address, Shipment, country_map, digest
+from ..exceptions import CarrierError, NotSupportedError, AddressError, SoftCarrierError, \
+    PostalError, RateLimitedError
 import pycountry
 
 __author__ = 'Nathan Everitt'
@@ -227,25 +222,14 @@ class UPSApi(Carrier):
         '96': (1, 3),  # Worldwide Express Freight
     }
 
-    @staticmethod
-    def _get_directory_of(frame):
-        return os.path.split((os.path.abspath(inspect.getfile(frame))))[0]
-
-    @classmethod
-    def _get_path(cls, name):
-        return 'file://' + os.path.join(
-            cls._get_directory_of(inspect.currentframe()),
-            'wsdl', 'ups', name)
+    wsdl_files = (
+        'RateWS.wsdl', 'XAV.wsdl', 'TNTWS.wsdl', 'Ship.wsdl', 'Track.wsdl',
+        'PaperlessDocumentAPI.wsdl')
 
     def _create_client(self, name, plugins=None):
         if not plugins:
             plugins = []
-        client = Client(
-            self._get_path(name),
-            cache=suds.cache.NoCache(),
-            plugins=plugins + [self.log_service],
-            timeout=self.postal_configuration.get('timeout', None))
-        return client
+        return self.soap_client(name, plugins=plugins + [self.log_service])
 
     def __init__(
             self, username, password, access_license_number, shipper_number,
@@ -259,56 +243,69 @@ class UPSApi(Carrier):
         else:
             self.paperless = False
 
-        authentication = AuthenticationPlugin(
+        self.test = test
+        self._authentication = AuthenticationPlugin(
             username, password, access_license_number)
 
-        self._RateWS = self._create_client(
+    @lazy_client
+    def _RateWS(self):
+        return self._create_client(
             'RateWS.wsdl',
             plugins=[
-                authentication, FixBrokenNamespace('RateRequest', self.common),
+                self._authentication,
+                FixBrokenNamespace('RateRequest', self.common),
                 FixMissingTags('RateRequest', self.rates),
             ]
         )
 
-        self._XAV = self._create_client(
+    @lazy_client
+    def _XAV(self):
+        return self._create_client(
             'XAV.wsdl',
             plugins=[
-                authentication, FixBrokenNamespace('XAVRequest', self.common),
+                self._authentication,
+                FixBrokenNamespace('XAVRequest', self.common),
             ]
         )
 
-        self._TNTWS = self._create_client(
+    @lazy_client
+    def _TNTWS(self):
+        return self._create_client(
             'TNTWS.wsdl',
             plugins=[
-                authentication,
+                self._authentication,
                 FixBrokenNamespace('TimeInTransitRequest', self.common),
             ]
         )
 
-        self._Ship = self._create_client(
+    @lazy_client
+    def _Ship(self):
+        client = self._create_client(
             'Ship.wsdl',
             plugins=[
-                authentication, FixBrokenNamespace(
+                self._authentication, FixBrokenNamespace(
                     'ShipmentRequest', self.common),
                 FixMissingTags('ShipmentRequest', self.shipment),
             ]
         )
-
-        self._Track = self._create_client(
-            'Track.wsdl',
-            plugins=[
-                authentication
-            ]
-        )
-
-        self._PaperlessDocumentAPI = self._create_client(
-            'PaperlessDocumentAPI.wsdl', plugins=[authentication])
-
-        if not test:
-            self._Ship.set_options(
+        if not self.test:
+            client.set_options(
                 location='https://onlinetools.ups.com/webservices/Ship')
-            self._PaperlessDocumentAPI.set_options(location=
+        return client
+
+    @lazy_client
+    def _Track(self):
+        return self._create_client(
+            'Track.wsdl', plugins=[self._authentication])
+
+    @lazy_client
+    def _PaperlessDocumentAPI(self):
+        client = self._create_client(
+            'PaperlessDocumentAPI.wsdl', plugins=[self._authentication])
+        if not self.test:
+            client.set_options(location=
                 'https://filexfer.ups.com/webservices/PaperlessDocumentAPI')
+        return client
 
     def _convert_webfault(self, webfault):
         error = webfault.fault.detail.Errors.ErrorDetail.PrimaryErrorCode
@@ -354,6 +351,10 @@ class UPSApi(Carrier):
         elif code == '120802':
             result = NotSupportedError('UPS does not recognize that as a '
                                        'valid destination address.', code=code)
+        elif code in ('151044', '151045'):
+            # UPS throttling us.
+            result = RateLimitedError(
+                u'{}'.format(error.Description), code=code)
         else:
             result = CarrierError('Webfault#%s: %s'
                                   % (error.Code, error.Description), code=code)
@@ -502,14 +503,10 @@ class UPSApi(Carrier):
 
         with self.logger.lock:
             self.logger.debug_header('Commercial Invoice')
-        try:
-            return self._PaperlessDocumentAPI.service.ProcessUploading(
-                req, self.shipper_number, [form]
-            ).FormsHistoryDocumentID.DocumentID[0]
-        except WebFault as err:
-            raise self._convert_webfault(err)
-        finally:
-            self.log_transmission(self._PaperlessDocumentAPI)
+        return self._call(
+            self._PaperlessDocumentAPI.service.ProcessUploading,
+            req, self.shipper_number, [form]
+        ).FormsHistoryDocumentID.DocumentID[0]
 
     def _convert_alert(self, alert):
         if alert.Code == 120023:
@@ -540,7 +537,11 @@ class UPSApi(Carrier):
             return
         api_shipment.ShipmentServiceOptions.SaturdayDeliveryIndicator = True
 
-    def track(self, identifier):
+    def track_shipment(self, identifier):
+        """
+        Gets the ShipmentType UPS has for identifier, with all of its
+        activity.
+        """
         request = self._Track.factory.create('ns0:RequestType')
         request.RequestOption = 15
 
@@ -552,40 +553,53 @@ class UPSApi(Carrier):
         finally:
             self.log_transmission(self._Track)
 
-        shipment = response.Shipment[0]
+        return response.Shipment[0]
+
+    def track(self, identifier):
+        shipment = self.track_shipment(identifier)
         if hasattr(shipment, 'Package'):
             return self.get_track_information_from_package_activity(shipment)
         else:
             return self.get_track_information_from_shipment_activity(shipment)
 
-    def get_track_information_from_package_activity(self, shipment):
+    def track_events(self, identifier):
+        shipment = self.track_shipment(identifier)
+        # UPS lists activity newest first.
+        if hasattr(shipment, 'Package'):
+            # Packages of one shipment often share scans, which are only
+            # listed once.
+            events = []
+            seen = set()
+            for package in shipment.Package:
+                for event in self.package_events(shipment, package):
+                    key = digest(event)
+                    if key not in seen:
+                        seen.add(key)
+                        events.append(event)
+            events.sort(key=lambda event: event['event_time'])
+            return events
+        return [self.shipment_activity_event(activity)
+                for activity in reversed(shipment.Activity)]
+
+    def package_activity_event(self, details, reason=None):
         """
-        In usual case flow we should retrieve a track information from package activity.
-        Args:
-            shipment: ShipmentRequest object
-
-        Returns: dict with track information
+        Converts one package activity into the dictionary track() returns.
+        reason is an earlier activity explaining an exception status, whose
+        description and location are reported instead.
         """
-        result = {}
-        details = shipment.Package[0].Activity[0]
         status = details.Status
-        result['delivered'] = status.Type == 'D'
-        result['finalized'] = status.Code == 'D'
-        result['status_code'] = u'{}'.format(status.Type)
-        try:
-            result['description'] = u'{}'.format(status.Description)
-        except AttributeError:
-            result['description'] = ''
-            self.logger.exception("Empty Description received for shipment: {}".format(shipment))
-        result['event_time'] = self.get_event_time(details)
-        address = getattr(details, 'ActivityLocation')
-        if status.Type == 'X':
-            # Backtrack to find the real reason for the odd status.
-            for activity in shipment.Package[0].Activity:
-                if not hasattr(activity.Status, 'Type'):
-                    result['description'] = u'{}'.format(activity.Status.Description)
-                    address = getattr(activity, 'ActivityLocation', address)
-                    break
+        status_type = getattr(status, 'Type', '')
+        described = details if reason is None else reason
+        result = {
+            'delivered': status_type == 'D',
+            'finalized': getattr(status, 'Code', None) == 'D',
+            'status_code': u'{}'.format(status_type),
+            'description': u'{}'.format(
+                getattr(described.Status, 'Description', '')),
+            'event_time': self.get_event_time(details)}
+        address = getattr(details, 'ActivityLocation', None)
+        if reason is not None:
+            address = getattr(reason, 'ActivityLocation', address)
         if address and hasattr(address, 'Address'):
             address = address.Address
         location = self.get_event_location(address)
@@ -593,6 +607,43 @@ class UPSApi(Carrier):
             result['location'] = location
         return result
 
+    def get_track_information_from_package_activity(self, shipment):
+        """
+        In usual case flow we should retrieve a track information from package activity.
+        A shipment of several packages is only as far along as its least
+        advanced package, so until all of them are finalized the latest
+        activity of the one still moving that was updated longest ago is
+        used.
+        Args:
+            shipment: ShipmentRequest object
+
+        Returns: dict with track information
+        """
+        results = [self.package_events(shipment, package)[-1]
+                   for package in shipment.Package]
+        moving = [result for result in results if not result['finalized']]
+        return min(moving or results, key=lambda result: result['event_time'])
+
+    def package_events(self, shipment, package):
+        """
+        The events of one package of shipment, oldest first.
+        """
+        events = []
+        for index, details in enumerate(package.Activity):
+            if index == 0 and not hasattr(details.Status, 'Description'):
+                self.logger.exception("Empty Description received for shipment: {}".format(shipment))
+            reason = None
+            if getattr(details.Status, 'Type', '') == 'X':
+                # Backtrack to find the real reason for the odd status.
+                for activity in package.Activity:
+                    if not hasattr(activity.Status, 'Type'):
+                        reason = activity
+                        break
+            events.append(self.package_activity_event(details, reason))
+        # UPS lists activity newest first.
+        events.reverse()
+        return events
+
     def get_track_information_from_shipment_activity(self, shipment):
         """
         Sometimes we do not have package object in ShipmentRequest.
@@ -602,12 +653,17 @@ class UPSApi(Carrier):
 
         Returns: dict with track information
         """
+        return self.shipment_activity_event(shipment.Activity[0])
+
+    def shipment_activity_event(self, details):
+        """
+        Converts one shipment activity into the dictionary track() returns.
+        """
         result = {
             'delivered': False,
             'finalized': False,
             'status_code': 'X'
         }
-        details = shipment.Activity[0]
         if hasattr(details, 'Description'):
             result['description'] = details.Description
             if details.Description == 'Delivered':
@@ -818,13 +874,9 @@ class UPSApi(Carrier):
             self.logger.debug_header('Shipment')
             self.logger.debug(service)
             self.logger.debug(request)
-        try:
-            response = self._Ship.service.ProcessShipment(
-                api_request, api_shipment, label_spec, receipt_spec)
-        except WebFault as err:
-            raise self._convert_webfault(err)
-        finally:
-            self.log_transmission(self._Ship)
+        response = self._call(
+            self._Ship.service.ProcessShipment,
+            api_request, api_shipment, label_spec, receipt_spec)
 
         negotiated_rate = self._get_price(
             response.ShipmentResults
@@ -869,29 +921,24 @@ class UPSApi(Carrier):
 
         return result
 
-    def _task(self, request, rated_shipment, shipment_info):
+    def _task(self, request, rated_shipment):
         """
         Because the delivery datetime check must be done on a separate web
         request, we break this down into tasks so the requests run in parallel.
         """
-        try:
-            service = self.get_service(rated_shipment.Service.Code)
-            retail = request.extra_params.get('retail_rate')
-            info = {'price': self._get_price(rated_shipment, retail=retail),
-                    'alerts': [a.Description
-                               for a in rated_shipment.RatedShipmentAlert],
-                    'trackable': True}
-
-            if self.auto_time_in_transit:
-                info['delivery_datetime'] = self.delivery_datetime(service, request)
-            else:
-                info['delivery_datetime'] = None
-
-            shipment_info.put((service, info))
+        service = self.get_service(rated_shipment.Service.Code)
+        retail = request.extra_params.get('retail_rate')
+        info = {'price': self._get_price(rated_shipment, retail=retail),
+                'alerts': [a.Description
+                           for a in rated_shipment.RatedShipmentAlert],
+                'trackable': True}
+
+        if self.auto_time_in_transit:
+            info['delivery_datetime'] = self.delivery_datetime(service, request)
+        else:
+            info['delivery_datetime'] = None
 
-        except Exception as err:
-            err.traceback = sys.exc_info()[2]
-            shipment_info.put(err)
+        return service, info
 
     def get_services(self, request):
         self._ensure_request_supported(request)
@@ -900,22 +947,12 @@ class UPSApi(Carrier):
             self.logger.debug_with_header('GetServicesRequest', request)
         rates = self._request_rates(request, 'Shop')
 
-        shipment_info = Queue()
-        # Each request takes multiple web service calls.
-        # We thread for efficiency.
-        for rated_shipment in rates.RatedShipment:
-            thread = Thread(target=self._task,
-                            args=(request, rated_shipment, shipment_info))
-            thread.start()
-
-        result = {}
-        for _ in rates.RatedShipment:
-            info = shipment_info.get()
-            if isinstance(info, Exception):
-                raise info
-            else:
-                service, rates = info
-                result[service] = rates
+        # Each request takes multiple web service calls, so they're spread
+        # over the shared executor.
+        rated_shipments = list(rates.RatedShipment)
+        result = dict(self.executor.map(
+            self.name, self._task, [request] * len(rated_shipments),
+            rated_shipments))
 
         with self.logger.lock:
             self.logger.debug_with_header('GetServicesResponse', pformat(result, width=9999))
@@ -981,12 +1018,9 @@ class UPSApi(Carrier):
 
         self._set_signature(request, shipment)
 
-        try:
-            rates = self._RateWS.service.ProcessRate(
-                api_request, _pickup_type, _customer_classification, shipment)
-            self.log_transmission(self._RateWS)
-        except WebFault as err:
-            raise self._convert_webfault(err)
+        rates = self._call(
+            self._RateWS.service.ProcessRate,
+            api_request, _pickup_type, _customer_classification, shipment)
 
         # 1 = Success
         if rates.Response.ResponseStatus.Code != '1':
@@ -1009,15 +1043,12 @@ class UPSApi(Carrier):
         with self.logger.lock:
             self.logger.debug_with_header('ValidateAddressRequest', address)
 
-        try:
-            response = self._XAV.service.ProcessXAV(
-                request,
-                None,  # missing tag = street-level validation
-                1,  # candidate list size
-                address_key)
-
-        except WebFault as err:
-            raise self._convert_webfault(err)
+        response = self._call(
+            self._XAV.service.ProcessXAV,
+            request,
+            None,  # missing tag = street-level validation
+            1,  # candidate list size
+            address_key)
 
         if response.Response.ResponseStatus.Code != '1':
             self._on_unknown_error()
@@ -1116,24 +1147,23 @@ class UPSApi(Carrier):
         with self.logger.lock:
             self.logger.debug_header('TimeInTransitRequest', '%r,%r' % (service, request))
         try:
-            response = self._TNTWS.service.ProcessTimeInTransit(
+            response = self._call(
+                self._TNTWS.service.ProcessTimeInTransit,
                 api_request, req_ship_from, req_ship_to, sticks, weight,
                 num_packages, invoice, documents, bill_type, max_list,
                 sat_morn, drop_off, hold_pickup)
-
-        except WebFault as err:
-            code = err.fault.detail.Errors.ErrorDetail.PrimaryErrorCode.Code
-            if code == '270037':  # no TiT information available
+        except CarrierError as err:
+            if err.code == '270037':  # no TiT information available
                 with self.logger.lock:
                     self.logger.debug_with_header('TimeInTransitResponse', 'No TiT information available.')
                 return None
-            elif code == '270019':  # TiT service is not available
+            elif err.code == '270019':  # TiT service is not available
                 with self.logger.lock:
                     self.logger.debug_header('TimeInTransitResponse')
                     self.logger.warning('TiT service is not available.')
-                    self.logger.warning(response)
+                    self.logger.warning(err)
                 return None  # It's not essential information
-            raise self._convert_webfault(err)
+            raise
 
         if response.Response.ResponseStatus.Code != '1':
             self._on_unknown_error()
@@ -1240,22 +1270,43 @@ class UPSApi(Carrier):
 
         return api_package
 
+    def _call(self, method, *args, **kwargs):
+        """
+        Calls method, a suds service method, under the rate limit and
+        circuit breaker, and logs the exchange. WebFaults are raised as what
+        convert returns for them, _convert_webfault() by default.
+        """
+        convert = kwargs.pop('convert', self._convert_webfault)
+        with self.circuit() as call, self.throttle():
+            try:
+                return method(*args, **kwargs)
+            except WebFault as err:
+                raise convert(err)
+            except Exception as err:
+                if self.unanswered(err):
+                    call.fail()
+                raise
+            finally:
+                self.log_transmission(method.client)
+
+    def _service_fault(self, err):
+        try:
+            err_code = err.fault.detail.Errors.ErrorDetail.PrimaryErrorCode.Code
+            err_description = err.fault.detail.Errors.ErrorDetail.PrimaryErrorCode.Description
+        except AttributeError:
+            return CarrierError(u"{}".format(err.document))
+        if err_code in ['151044', '151045']:
+            # UPS throttling us.
+            return RateLimitedError(u"{}".format(err_description))
+        elif err_code == '155002':
+            return SoftCarrierError(u"{}".format(err_description))
+        return CarrierError(u"{}".format(err_description))
+
     def service_call(self, func, *args, **kwargs):
         try:
-            return func(*args, **kwargs)
+            return self._call(func, *args, convert=self._service_fault,
+                              **kwargs)
+        except PostalError:
+            raise
         except Exception as err:
-            try:
-                err_code = err.fault.detail.Errors.ErrorDetail.PrimaryErrorCode.Code
-                err_description = err.fault.detail.Errors.ErrorDetail.PrimaryErrorCode.Description
-                if err_code in ['151044', '151045', '155002']:
-                    raise SoftCarrierError(u"{}".format(err_description))
-                else:
-                    raise CarrierError(u"{}".format(err_description))
-            except AttributeError:
-                pass
-
-            if hasattr(err, 'document'):
-                raise CarrierError(u"{}".format(err.document))
             raise CarrierError(repr(err))
-        finally:
-            self.log_transmission(func.client)
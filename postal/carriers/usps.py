@@ -29,7 +29,7 @@ from PyPDF2 import PdfFileReader, PdfFileWriter
 from money import Money
 from suds.client import Client
 
-from base import Carrier, ClearEmpty, PY3, PostalLogger
+from base import Carrier, ClearEmpty, PY3, PostalLogger, lazy_client
 from ..exceptions import CarrierError, NotSupportedError
 from ..data import Shipment, sigfig, TWOPLACES, Declaration, subdivision_map
 
@@ -37,6 +37,12 @@ class USPSApi(Carrier):
     name = 'USPS'
     address_validation = False
     atomic_multiship = False
+    # Endicia can be slow to answer, so unless a timeout is configured, allow
+    # it longer than most.
+    default_timeout = 20
+    # Endicia rates one package at a time, so packages are rated and cached
+    # on their own.
+    rate_granularity = 'package'
     _code_to_description = {
         'PriorityExpress': 'Priority Mail Express',
         'First': 'First-Class Mail',
@@ -103,7 +109,11 @@ class USPSApi(Carrier):
                   'EwsLabelService.asmx?WSDL'
         self.url = url
 
-        self.client = Client(url, plugins=[ClearEmpty(), self.log_service], timeout=20)
+    @lazy_client
+    def client(self):
+        return Client(
+            self.url, plugins=[ClearEmpty(), self.log_service],
+            transport=self.transport())
 
     def service_call(self, func, *args, **kwargs):
         self.logger.debug("Sending request to %s" % self.url)
@@ -184,8 +194,10 @@ class USPSApi(Carrier):
         for rate in response.PostagePrice:
             if not rate.MailClass in self._code_to_description:
                 continue
+            # Keyed by service ID rather than Service so the table can be
+            # stored in any cache backend.
             service = self.get_service(rate.MailClass)
-            table[service] = {
+            table[rate.MailClass] = {
                 'price': self._get_price(rate),
                 'delivery_datetime': self._get_arrival_date(
                     request, int(rate.DeliveryTimeDays)),
@@ -565,15 +577,19 @@ class USPSApi(Carrier):
         # force a rate check before doing anything else. This should raise
         # an exception if there's a problem with any of the packages.
         self.quote(service, request)
-        responses = []
-        for package in request.packages:
+
+        def ship_package(package):
             try:
-                responses.append(self.ship_package(request, service, package))
+                return self.ship_package(request, service, package)
             except CarrierError as err:
                 # One of the packages didn't ship correctly.
-                responses.append({
+                return {
                     'packages': {
-                        package: {'label': None, 'tracking_number': None}}})
+                        package: {'label': None, 'tracking_number': None}}}
+        # Labels don't depend on each other, so they're bought concurrently.
+        responses = self.executor.map(
+            self.name, ship_package, request.packages,
+            limit=self.ship_concurrency)
         result = self.compile_shipments(responses)
 
         with self.logger.lock:
@@ -590,7 +606,7 @@ class USPSApi(Carrier):
         refill_request.RequestID = self.ref_number()
         self._set_creds(refill_request, inset=True)
         refill_request.RecreditAmount = dollar_amount.amount
-        self.client.service.BuyPostage(refill_request)
+        self.service_call(self.client.service.BuyPostage, refill_request)
 
     def change_passphrase(self, new_passphrase):
         """
@@ -614,21 +630,18 @@ class USPSApi(Carrier):
             raise CarrierError(error)
         self.passphrase = new_passphrase
 
-    @staticmethod
-    def total_price(prices):
-        """
-        Gets the total price from a set of prices.
-        """
-        total = sum([price['total'] for price in prices])
-        base_price = sum([price['base_price'] for price in prices])
-        fees = total - base_price
+    def compile_options(self, request, response_list):
         return {
-            'total': total,
-            'base_price': base_price,
-            'fees': fees,
-        }
+            self.get_service(service_id): value
+            for service_id, value in self.compile_table(
+                request, response_list).items()}
 
-    def compile_options(self, request, response_list):
+    def compile_table(self, request, response_list):
+        """
+        Merges the rates for each package in response_list into the rates
+        for the whole request, keyed by service ID. Only services available
+        for every package are kept.
+        """
         service_sets = [
             {service for service in response.keys()}
             for response in response_list]
@@ -638,67 +651,106 @@ class USPSApi(Carrier):
         except TypeError:
             return {}
         final_response = {}
-        for service in services:
-            price = self.total_price([response[service]['price'] for response in response_list])
+        for service_id in services:
+            service = self.get_service(service_id)
+            price = self.total_price([response[service_id]['price'] for response in response_list])
 
             # The latest delivery date will be our estimate.
             datetimes = []
             trackable = self.is_trackable(request, service)
             for response in response_list:
-                delivery = response[service]['delivery_datetime']
+                delivery = response[service_id]['delivery_datetime']
                 if delivery is not None:
                     datetimes.append(delivery)
-                trackable = response[service]['trackable']
+                trackable = trackable and response[service_id]['trackable']
             if not datetimes:
                 delivery_datetime = None
             else:
                 delivery_datetime = max(datetimes)
-            final_response[service] = {
+            final_response[service_id] = {
                 'price': price, 'delivery_datetime': delivery_datetime,
                 'trackable': trackable}
         return final_response
 
+    def rate_signature(self, request):
+        def postal_code(address):
+            if address.country.alpha2 == 'US':
+                return [address.country.alpha2, address.postal_code[:5]]
+            return [address.country.alpha2, address.postal_code]
+
+        return {
+            'origin': postal_code(self.get_origin(request)),
+            'destination': postal_code(request.destination),
+            # USPS is sent dimensions longest first, so their order
+            # doesn't matter here.
+            'packages': [
+                [sorted([package.length, package.width, package.height]),
+                 package.weight, package.package_type,
+                 package.carrier_conversion,
+                 package.get_total_insured_value()]
+                for package in request.packages],
+            'ship_datetime': request.ship_datetime,
+            'signature_required': request.extra_params.get(
+                'signature_required', '')}
+
+    def fetch_rates(self, request):
+        """
+        Rates request with Endicia, which takes a call for each package.
+        """
+        responses = []
+        for package in request.packages:
+            postage_request = self.client.factory.create('PostageRatesRequest')
+            self._set_dims(postage_request, package, softpack_convert=False)
+            self._set_address_info(postage_request, request, short=True)
+            self._set_creds(postage_request, inset=True)
+            self._signature_params(postage_request, request)
+            self._insurance_params(postage_request, package)
+            postage_request.DeliveryTimeDays = "TRUE"
+            response = self.service_call(
+                self.client.service.CalculatePostageRates, postage_request)
+            responses.append(self._request_response_table(request, response))
+        return self.compile_table(request, responses)
+
+    def combine_rates(self, request, tables):
+        return self.compile_table(request, tables)
+
+    def rate_table(self, request):
+        """
+        USPS's rates for the whole of request, keyed by service ID. The
+        table is cached next to the rates for each package, so that pricing
+        services one at a time doesn't compile it again for each.
+        """
+        self._sanity_check(request)
+        return self.granular_rates(request, 'usps', self.fetch_rates)
+
     def get_services(self, request):
         self._sanity_check(request)
 
-        with self.logger.lock:
-            self.logger.debug_with_header('GetServicesRequest', pformat(request, width=9999))
+        if self.logger.debugging():
+            with self.logger.lock:
+                self.logger.debug_with_header('GetServicesRequest', pformat(request, width=9999))
 
         try:
-            responses = self.get_from_cache(request, 'usps')
-            if not responses:
-                responses = []
-                for package in request.packages:
-                    postage_request = self.client.factory.create('PostageRatesRequest')
-                    self._set_dims(postage_request, package, softpack_convert=False)
-                    self._set_address_info(postage_request, request, short=True)
-                    self._set_creds(postage_request, inset=True)
-                    self._signature_params(postage_request, request)
-                    self._insurance_params(postage_request, package)
-                    postage_request.DeliveryTimeDays = "TRUE"
-                    response = self.service_call(
-                        self.client.service.CalculatePostageRates, postage_request)
-
-                    response_dict = self._request_response_table(request, response)
-                    responses.append(response_dict)
-                self.cache_results(request, responses, 'usps')
-            responses = self.compile_options(request, responses)
+            responses = {
+                self.get_service(service_id): value
+                for service_id, value in self.rate_table(request).items()}
 
-            with self.logger.lock:
-                self.logger.debug_with_header('GetServicesResponse', pformat(responses, width=9999))
+            if self.logger.debugging():
+                with self.logger.lock:
+                    self.logger.debug_with_header('GetServicesResponse', pformat(responses, width=9999))
 
             return responses
         except Exception as ex:
             self.logger.exception("In USPS.get_services")
 
-    def delivery_datetime(self, service, request):
-        data = self.get_services(request).get(service, None)
+    def service_rate(self, service, request):
+        data = self.rate_table(request).get(service.service_id, None)
         if not data:
             raise NotSupportedError("USPS does not support shipment of that package on this service.")
-        return data['delivery_datetime']
+        return data
+
+    def delivery_datetime(self, service, request):
+        return self.service_rate(service, request)['delivery_datetime']
 
     def quote(self, service, request):
-        data = self.get_services(request).get(service, None)
-        if not data:
-            raise NotSupportedError("USPS does not support shipment of that package on this service.")
-        return data['price']
+        return self.service_rate(service, request)['price']
@@ -7,6 +7,90 @@ from carriers.aramex import AramexApi
 base_postal_configuration = {
     'timeout': None,
 
+    # Rates fetched from carriers are kept in a cache shared by all carriers.
+    # backend is 'memory' for a cache local to this process, or 'sqlite' for
+    # one kept in the file at path, which every worker process on the machine
+    # opening the same path will share. A CacheBackend instance may also be
+    # given. max_size caps the number of entries held. Once it's reached,
+    # entries are evicted by either 'lru' (least recently used) or 'lfu'
+    # (least frequently used). The memory backend spreads entries over a
+    # number of separately locked stripes so that concurrent lookups don't
+    # contend. ttl is the number of seconds a rate stays valid, keyed by
+    # carrier name, with 'default' applying to any carrier not listed.
+    'cache': {
+        'backend': 'memory',
+        'path': None,
+        'max_size': 10000,
+        'eviction': 'lru',
+        'stripes': 16,
+        'ttl': {
+            'default': 1800,
+            'DHL': 1800,
+            'FedEx': 1800,
+            'USPS': 1800}},
+
+    # Results of Postal.track() and track_many() can be cached too, by
+    # giving a dictionary here in place of None. It takes the same backend
+    # settings as 'cache' above, and these, in seconds: results for
+    # shipments still moving are kept for age_factor times the age of their
+    # latest event, but no less than min_ttl and no more than max_ttl.
+    # Finalized results are kept until evicted. Numbers a carrier doesn't
+    # know yet aren't asked about again for negative_ttl, doubling with each
+    # miss in a row up to max_negative_ttl. See postal.tracking.
+    #
+    # 'tracking_cache': {
+    #     'backend': 'memory', 'max_size': 100000,
+    #     'min_ttl': 300, 'max_ttl': 21600, 'age_factor': 0.1,
+    #     'negative_ttl': 600, 'max_negative_ttl': 86400},
+    'tracking_cache': None,
+
+    # Postal.track_updates() remembers which events of each shipment it has
+    # returned, so that it only returns new ones. None keeps them in memory
+    # for this Postal instance, with no limit on the number of shipments but
+    # forgetting each 30 days after its last new event, so long running
+    # pollers should give it a persistent backend. Otherwise, this takes the
+    # same backend settings as 'cache' above, and ttl, the seconds a shipment
+    # is remembered after its last new event. A shipment evicted or expired
+    # from the backend has its whole history returned again, so max_size
+    # should cover every shipment being followed.
+    #
+    # 'tracking_history': {
+    #     'backend': 'sqlite', 'path': '/var/lib/postal/history.db',
+    #     'max_size': 1000000, 'ttl': 2592000},
+    'tracking_history': None,
+
+    # Concurrent calls to carriers, like those made by Postal.options(), run
+    # on a pool of threads shared by all Postal instances with the same
+    # settings. max_workers caps the number of threads. carrier_limits caps
+    # the calls in flight to each named carrier, and default_limit does the
+    # same for carriers not named there (None for no limit).
+    'executor': {
+        'max_workers': 32,
+        'carrier_limits': {},
+        'default_limit': None},
+
+    # Calls to carriers go over connections kept open in a pool shared by all
+    # Postal instances with the same settings. pool_size caps the connections
+    # kept open to each host, and pool_connections the number of hosts
+    # they're kept for. Failures to connect are retried max_retries times,
+    # with a delay growing from backoff_factor seconds.
+    'http_pool': {
+        'pool_size': 10,
+        'pool_connections': 10,
+        'max_retries': 2,
+        'backoff_factor': 0.1},
+
+    # Parsed copies of the WSDL files bundled with carriers are kept in this
+    # directory, so that constructing carriers doesn't reparse them. None
+    # uses a directory under the system's temporary directory, and False
+    # disables the cache. See postal.warm_wsdl_cache.
+    'wsdl_cache': None,
+
+    # Carriers build their web service clients the first time each is used.
+    # Set this to build them all in background threads as soon as Postal is
+    # constructed instead, so that the first requests don't wait on them.
+    'prewarm_clients': False,
+
     # Any carriers you don't want to include should be removed from this list.
     # Any extra carriers you create or import should be added to this list.
     'enabled_carriers': [USPSApi, FedExApi, UPSApi, DHLApi, AramexApi],
@@ -44,7 +128,27 @@ base_postal_configuration = {
 
     # The following are options for setting up the default carriers. Each
     # carrier's options are paired with their key, which is their name
-    # property.
+    # property. Besides the options for its constructor, any carrier can be
+    # given a 'soft_timeout', the number of seconds Postal.options() will
+    # wait on it before reporting a CarrierTimeoutError in its place, and a
+    # 'timeout', the number of seconds each HTTP call to it may take, which
+    # overrides the 'timeout' above, and a 'rate_granularity'. That's
+    # 'request' to rate and cache each request as a whole, or 'package' to
+    # rate and cache each package on its own, so that requests sharing
+    # packages reuse each other's rates. 'package' is only accurate for
+    # carriers that price packages independently, like USPS, which uses it
+    # by default. 'ship_concurrency' caps how many packages of a shipment are
+    # labelled at once by carriers that make a call for each (4 by default),
+    # and 'track_concurrency' how many tracking calls Postal.track_many()
+    # makes to it at once (8 by default). A 'rate_limit' holds every call to
+    # the carrier to a 'rate' a second, with a 'burst' allowed after a quiet
+    # spell, and to 'max_in_flight' at once. Calls wait up to 'max_wait'
+    # seconds for room (as long as it takes if it's None, or not at all if
+    # it's 0) before failing with a RateLimitedError. See postal.limits. A
+    # 'circuit_breaker' stops calls to the carrier for a 'cooldown' once an
+    # 'error_rate' of its recent calls got no answer, so that Postal.options()
+    # reports a CarrierUnavailableError for it right away instead of waiting
+    # on it. See postal.breakers.
     'carrier_inits': {
         # You can sign up for a FedEx API key here:
         # https://www.fedex.com/us/developer/web-services/process.html?tab=tab2
@@ -3,7 +3,10 @@ These are the data structures used by Postal in order to represent things like
 shipments.
 """
 from decimal import Decimal
-from datetime import datetime
+from datetime import date, datetime
+import hashlib
+import json
+
 from money import Money
 from pycountry import countries, subdivisions
 
@@ -58,6 +61,75 @@ def sigfig(amount):
     return Decimal(amount).quantize(TWOPLACES)
 
 
+def canonical(value):
+    """
+    Converts value into plain lists, dictionaries and strings such that
+    equivalent values always convert the same way. Numbers are normalized, so
+    2, 2.0 and Decimal('2.00') are all the same number, and byte strings that
+    aren't text (like invoice PDFs) are reduced to a digest of their contents.
+    """
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, (int, long, float, Decimal)):
+        if isinstance(value, float):
+            value = Decimal(repr(value))
+        return {'#n': str(Decimal(value).normalize())}
+    if isinstance(value, Money):
+        return {'#m': [canonical(value.amount), value.currency.code]}
+    if isinstance(value, (datetime, date)):
+        return {'#t': value.isoformat()}
+    if isinstance(value, str):
+        try:
+            return value.decode('utf8')
+        except UnicodeDecodeError:
+            return {'#b': hashlib.sha1(value).hexdigest()}
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(canonical(item) for item in value)
+    if isinstance(value, dict):
+        return {unicode(key): canonical(item) for key, item in value.items()}
+    if hasattr(value, 'fingerprint_fields'):
+        return {'#o': [type(value).__name__,
+                       canonical(value.fingerprint_fields())]}
+    if hasattr(value, 'alpha2'):
+        return value.alpha2
+    if hasattr(value, '__dict__'):
+        return {'#o': [type(value).__name__, canonical(vars(value))]}
+    return repr(value)
+
+
+def _snapshot(value):
+    """
+    A copy of value that compares equal to a later snapshot only while value
+    is unchanged. It's much cheaper to take than a digest, so a memoized
+    digest can be checked against it before each use.
+    """
+    if isinstance(value, (list, tuple)):
+        return [_snapshot(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    if isinstance(value, dict):
+        return {key: _snapshot(item) for key, item in value.items()}
+    if hasattr(value, '__dict__') and not isinstance(value, Money) and \
+            not hasattr(value, 'alpha2'):
+        return (type(value), _snapshot(vars(value)))
+    # The type keeps values like True and 1, which compare equal but digest
+    # differently, apart.
+    return (type(value), value)
+
+
+def digest(value):
+    """
+    A stable digest of the canonical form of value. Unlike hash(), it's the
+    same in every process, so it can key shared and persistent caches.
+    """
+    return hashlib.sha1(json.dumps(
+        canonical(value), sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
 class Address(object):
     """
     Addresses for shipping. Many services have address validation, which can
@@ -159,12 +231,11 @@ class Address(object):
             residential=self.residential
         )
 
+    def fingerprint_fields(self):
+        return self.to_primitive()
+
     def cache_hash(self):
-        address = 'x'.join(map(str, sorted([
-            self.contact_name, self.phone_number, self.street_lines, self.city,
-            self.subdivision, self.postal_code, self.country.alpha2, self.residential
-        ])))
-        return hash(address)
+        return digest(self)
 
 
 class Request(object):
@@ -211,6 +282,46 @@ class Request(object):
             # opportunity.
             self.ship_datetime = None
 
+        # The fingerprints made by name, along with a snapshot of the fields
+        # they were made from. See fingerprint().
+        self._fingerprints = (None, {})
+        # Rates carriers have looked up for this request, by cache key. The
+        # key includes the request's fingerprint, so rates looked up before
+        # the request was changed aren't found again. See
+        # Carrier.cached_call.
+        self._rates = {}
+
+    def fingerprint_fields(self):
+        return {
+            'origin': self.origin,
+            'destination': self.destination,
+            'packages': self.packages,
+            'ship_datetime': self.ship_datetime,
+            'extra_params': self.extra_params}
+
+    def fingerprint(self, name='', signature=None):
+        """
+        Returns a digest identifying this request as it is now. signature is
+        a function returning the parts of the request to digest, so that
+        requests which only differ in ways a carrier ignores can share a
+        fingerprint. It defaults to the whole request.
+
+        The result is remembered under name, and forgotten once any of the
+        request's fields change.
+        """
+        state = _snapshot(self.fingerprint_fields())
+        made_from, fingerprints = self._fingerprints
+        if state != made_from:
+            fingerprints = {}
+            self._fingerprints = state, fingerprints
+        if name not in fingerprints:
+            if signature is None:
+                fields = self.fingerprint_fields()
+            else:
+                fields = signature()
+            fingerprints[name] = digest(fields)
+        return fingerprints[name]
+
     def get_total_declared_value(self):
         return stack_values(self.packages, 'get_total_declared_value')
 
@@ -299,6 +410,9 @@ class PackageType(object):
     def __hash__(self):
         return hash(self.code)
 
+    def fingerprint_fields(self):
+        return [getattr(self.carrier, 'name', None), self.code]
+
     def __str__(self):
         return "%s %s" % (getattr(self.carrier, 'name', 'Generic'), self.name)
 
@@ -358,10 +472,17 @@ class Package(object):
     def get_total_insured_value(self):
         return stack_values(self.declarations, 'get_insured_value')
 
+    def fingerprint_fields(self):
+        return {
+            'dimensions': [self.length, self.width, self.height],
+            'weight': self.weight,
+            'package_type': self.package_type,
+            'documents_only': self.documents_only,
+            'carrier_conversion': self.carrier_conversion,
+            'declarations': self.declarations}
+
     def cache_hash(self):
-        dimensions = 'x'.join(map(str, sorted(
-            [self.length, self.width, self.height, self.weight])))
-        return hash(dimensions)
+        return digest(self)
 
     @staticmethod
     def to_centimeters(number):
@@ -458,6 +579,10 @@ class Declaration(object):
     def get_total_value(self):
         return self.units * self.value
 
+    def fingerprint_fields(self):
+        return [self.description, self.value, self.units,
+                self.origin_country.alpha2, self.insure]
+
     def get_insured_value(self):
         if self.insure:
             return self.get_total_value()
@@ -37,7 +37,63 @@ class SoftCarrierError(PostalError):
     """
 
 
+class CarrierTimeoutError(SoftCarrierError):
+    """
+    Used when a carrier didn't answer within the time we were willing to wait.
+    """
+
+
+class RateLimitedError(SoftCarrierError):
+    """
+    Used when a call to a carrier was refused for going over a rate limit,
+    ours or the carrier's.
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        retry_after is the number of seconds until there should be room for
+        the call, if that's known.
+        """
+        self.retry_after = kwargs.pop('retry_after', None)
+        super(RateLimitedError, self).__init__(*args, **kwargs)
+
+
+class CarrierUnavailableError(SoftCarrierError):
+    """
+    Used when calls to a carrier are being refused without trying, because
+    recent calls to it kept failing.
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        retry_after is the number of seconds until calls will be tried again,
+        if that's known.
+        """
+        self.retry_after = kwargs.pop('retry_after', None)
+        super(CarrierUnavailableError, self).__init__(*args, **kwargs)
+
+
 class NotSupportedError(PostalError):
     """
     Used when a requested shipment exceeds the limits of a service.
-    """
\ No newline at end of file
+    """
+
+
+class ShipmentInDoubtError(PostalError):
+    """
+    Used when a shipment was started but we don't know whether the carrier
+    made it, so it shouldn't be tried again without checking.
+    """
+
+
+class PartialShipmentError(CarrierError):
+    """
+    Used when the carrier refused some of the packages in a shipment after
+    others were bought. The labels already bought still have to be used or
+    voided, so unlike other CarrierErrors the shipment isn't safe to retry.
+    """
+    def __init__(self, *args, **kwargs):
+        """
+        shipment is the shipment dict for what was bought, with a label and
+        tracking number of None for each package that failed.
+        """
+        self.shipment = kwargs.pop('shipment', None)
+        super(PartialShipmentError, self).__init__(*args, **kwargs)
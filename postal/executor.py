@@ -0,0 +1,420 @@
+"""
+A shared, bounded pool of threads for the calls Postal makes to carriers.
+
+Postal.options() and the carriers fanning out their own requests all submit
+work here instead of starting threads of their own. The pool caps the number
+of threads overall and, optionally, the number of calls in flight to each
+carrier.
+
+Work is often submitted from inside other work (a carrier rating several
+services while Postal rates several carriers), so waiting for results with
+gather() runs any submitted call that can't get a thread right away in the
+waiting thread itself. This keeps the pool from deadlocking with every thread
+waiting on calls that are stuck in the queue behind them.
+"""
+from collections import deque, OrderedDict
+from threading import Condition, RLock, Thread, local
+import atexit
+import heapq
+import logging
+import sys
+import time
+
+from concurrent import futures
+
+
+# Keys of the calls each thread is running, innermost last.
+_current = local()
+
+
+def _running_keys():
+    if not hasattr(_current, 'keys'):
+        _current.keys = []
+    return _current.keys
+
+
+class _WorkItem(object):
+    def __init__(self, key, fn, args, kwargs):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = futures.Future()
+        self.future.work_item = self
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        keys = _running_keys()
+        keys.append(self.key)
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except BaseException:
+            # Keep the traceback, so that result() shows where the error
+            # actually happened.
+            info = sys.exc_info()
+            self.future.set_exception_info(info[1], info[2])
+        else:
+            self.future.set_result(result)
+        finally:
+            keys.pop()
+
+
+class _Timer(object):
+    """
+    Handle for a call scheduled with call_later().
+    """
+    def __init__(self, when, fn):
+        self.when = when
+        self.fn = fn
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _Scheduler(object):
+    """
+    Runs short callbacks at given times on a single thread, so that waiting
+    on timeouts doesn't take a thread for each.
+    """
+    def __init__(self):
+        self._condition = Condition()
+        self._timers = []
+        self._thread = None
+        self._sequence = 0
+        self._stopped = False
+
+    def call_later(self, delay, fn):
+        timer = _Timer(time.time() + delay, fn)
+        with self._condition:
+            self._sequence += 1
+            heapq.heappush(self._timers, (timer.when, self._sequence, timer))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='postal-timers')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return timer
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._timers and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                when, _, timer = self._timers[0]
+                delay = when - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._timers)
+            if not timer.cancelled:
+                try:
+                    timer.fn()
+                except Exception:
+                    logging.getLogger('postal').exception(
+                        'In a scheduled callback')
+
+
+_scheduler = _Scheduler()
+
+
+def call_later(delay, fn):
+    """
+    Calls fn after delay seconds, on a thread shared by all such calls.
+    fn should return quickly. Returns a handle with a cancel() method.
+    """
+    return _scheduler.call_later(delay, fn)
+
+
+class SharedExecutor(object):
+    """
+    max_workers:int = the most threads the pool will start
+    carrier_limits:{string -> int} = the most calls in flight for each key
+        (usually a carrier name) at once
+    default_limit:int|None = the limit for keys not in carrier_limits, or None
+        for no limit beyond max_workers
+    """
+    def __init__(self, max_workers=32, carrier_limits=None,
+                 default_limit=None):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1.")
+        self.max_workers = max_workers
+        self.carrier_limits = dict(carrier_limits or {})
+        self.default_limit = default_limit
+        self._condition = Condition(RLock())
+        self._queues = OrderedDict()
+        self._running = {}
+        self._threads = []
+        self._idle = 0
+        self._shutdown = False
+        self.submitted = 0
+        self.completed = 0
+        self.ran_inline = 0
+        self.max_queue_depth = 0
+
+    def limit(self, key):
+        return self.carrier_limits.get(key, self.default_limit)
+
+    def _has_capacity(self, key):
+        limit = self.limit(key)
+        return limit is None or self._running.get(key, 0) < limit
+
+    def _queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def submit(self, fn, *args, **kwargs):
+        return self.submit_for(None, fn, *args, **kwargs)
+
+    def submit_for(self, key, fn, *args, **kwargs):
+        """
+        Schedules fn(*args, **kwargs), counting it against the limit for key,
+        and returns a Future for its result.
+        """
+        item = _WorkItem(key, fn, args, kwargs)
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError(
+                    "Can't schedule new calls after shutdown.")
+            self._queues.setdefault(key, deque()).append(item)
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._queued())
+            if not self._idle and len(self._threads) < self.max_workers:
+                thread = Thread(
+                    target=self._work, name='postal-%s' % len(self._threads))
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify_all()
+        return item.future
+
+    def _next_item(self):
+        for key, queue in self._queues.items():
+            if queue and self._has_capacity(key):
+                # Rotate keys, so that one busy carrier doesn't starve the
+                # others.
+                del self._queues[key]
+                self._queues[key] = queue
+                return queue.popleft()
+        return None
+
+    def _started(self, item):
+        self._running[item.key] = self._running.get(item.key, 0) + 1
+
+    def _finished(self, item):
+        with self._condition:
+            self._running[item.key] -= 1
+            self.completed += 1
+            self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                item = self._next_item()
+                while item is None:
+                    if self._shutdown and not self._queued():
+                        return
+                    self._idle += 1
+                    self._condition.wait()
+                    self._idle -= 1
+                    item = self._next_item()
+                self._started(item)
+                self._condition.notify_all()
+            try:
+                item.run()
+            finally:
+                self._finished(item)
+
+    def _claim(self, future):
+        """
+        Takes the call behind future off the queue if no thread can start it
+        right now, so that the caller can run it instead.
+        """
+        item = getattr(future, 'work_item', None)
+        if item is None or future.done():
+            return None
+        queue = self._queues.get(item.key)
+        if not queue or item not in queue:
+            return None
+        if self._has_capacity(item.key):
+            if self._idle or len(self._threads) < self.max_workers:
+                # A thread will pick it up.
+                return None
+        elif item.key not in _running_keys():
+            # Wait for one of the calls holding the limit to finish. Calls
+            # made from within a call for the same key are exempt, since that
+            # call is only waiting on them.
+            return None
+        queue.remove(item)
+        self._started(item)
+        self.ran_inline += 1
+        return item
+
+    def gather(self, futures_list, timeout=None,
+               return_when=futures.ALL_COMPLETED):
+        """
+        Waits for every future in futures_list to finish, running any of their
+        calls that are stuck in the queue in this thread, and returns them.
+        With return_when set to FIRST_COMPLETED, returns once any of them has
+        finished instead.
+
+        With a timeout, returns once that many seconds have passed even if
+        some futures haven't finished. Calls are never run in this thread then,
+        since the timeout couldn't be kept while running one.
+        """
+        futures_list = list(futures_list)
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            with self._condition:
+                pending = [future for future in futures_list
+                           if not future.done()]
+                if not pending or (
+                        return_when == futures.FIRST_COMPLETED and
+                        len(pending) < len(futures_list)):
+                    return futures_list
+                item = None
+                if end is None:
+                    for future in pending:
+                        item = self._claim(future)
+                        if item:
+                            break
+                if item is None:
+                    if end is None:
+                        self._condition.wait()
+                    else:
+                        remaining = end - time.time()
+                        if remaining <= 0:
+                            return futures_list
+                        self._condition.wait(remaining)
+                    continue
+            try:
+                item.run()
+            finally:
+                self._finished(item)
+
+    def map(self, key, fn, *iterables, **kwargs):
+        """
+        Like the built in map, but with the calls spread over the pool.
+        Raises the first error any call raised, in order.
+
+        With a limit, no more than that many of the calls are in flight at
+        once, whatever the limits for key.
+        """
+        limit = kwargs.pop('limit', None)
+        if kwargs:
+            raise TypeError("Unexpected arguments: %s" % ', '.join(kwargs))
+        arguments = zip(*iterables)
+        if limit is None:
+            submitted = [self.submit_for(key, fn, *args)
+                         for args in arguments]
+            return [future.result() for future in self.gather(submitted)]
+        submitted = []
+        pending = []
+        for args in arguments:
+            while len(pending) >= limit:
+                self.gather(pending, return_when=futures.FIRST_COMPLETED)
+                pending = [future for future in pending if not future.done()]
+            future = self.submit_for(key, fn, *args)
+            submitted.append(future)
+            pending.append(future)
+        self.gather(pending)
+        return [future.result() for future in submitted]
+
+    def stats(self):
+        """
+        Returns how busy the pool is, overall and for each key.
+        """
+        with self._condition:
+            keys = set(self._queues) | set(self._running)
+            return {
+                'max_workers': self.max_workers,
+                'threads': len(self._threads),
+                'idle': self._idle,
+                'queued': self._queued(),
+                'running': sum(self._running.values()),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'ran_inline': self.ran_inline,
+                'max_queue_depth': self.max_queue_depth,
+                'keys': {
+                    key: {
+                        'queued': len(self._queues.get(key, ())),
+                        'running': self._running.get(key, 0),
+                        'limit': self.limit(key)}
+                    for key in keys}}
+
+    @property
+    def is_shutdown(self):
+        return self._shutdown
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+        Stops accepting new calls. Calls already queued still run unless
+        cancel_pending is set. With wait set, returns once every thread has
+        finished.
+        """
+        with self._condition:
+            self._shutdown = True
+            if cancel_pending:
+                for queue in self._queues.values():
+                    for item in queue:
+                        item.future.cancel()
+                    queue.clear()
+            self._condition.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
+
+
+_executors = {}
+_executors_lock = RLock()
+
+
+def executor_from_configuration(settings=None):
+    """
+    Gets the executor described by the 'executor' section of a postal
+    configuration. Everything built from equivalent settings shares one
+    executor, which is replaced if it has been shut down.
+    """
+    settings = settings or {}
+    options = {
+        'max_workers': settings.get('max_workers', 32),
+        'carrier_limits': settings.get('carrier_limits') or {},
+        'default_limit': settings.get('default_limit')}
+    signature = (options['max_workers'],
+                 tuple(sorted(options['carrier_limits'].items())),
+                 options['default_limit'])
+    with _executors_lock:
+        executor = _executors.get(signature)
+        if executor is None or executor.is_shutdown:
+            executor = _executors[signature] = SharedExecutor(**options)
+        return executor
+
+
+@atexit.register
+def _shutdown_executors():
+    # Let calls in progress finish, like the standard library's executors
+    # do, rather than have them torn down mid call.
+    _scheduler.stop()
+    with _executors_lock:
+        executors = _executors.values()
+    for executor in executors:
+        executor.shutdown(wait=True, cancel_pending=True)
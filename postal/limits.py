@@ -0,0 +1,195 @@
+"""
+Rate limits for the calls Postal makes to carriers.
+
+Carriers throttle accounts that call them too often, so each carrier can be
+given a 'rate_limit' in its carrier_inits:
+
+    'rate_limit': {
+        'rate': 10,            # calls a second, on average
+        'burst': 20,           # calls allowed at once after a quiet spell
+        'max_in_flight': 4,    # calls waiting on the carrier at once
+        'max_wait': None}      # seconds a call may wait for room
+
+Every call to the carrier (its service_call(), or the equivalent for
+carriers that don't use suds) waits for a token from the carrier's bucket
+and a free slot before it is made. A max_wait of None waits as long as it
+takes, while a number fails any call that would have to wait longer than
+that with a RateLimitedError, without calling the carrier. 0 fails fast.
+
+Limiters are shared by every carrier built from equivalent settings, so that
+several Postal instances in a process draw on one budget.
+"""
+from contextlib import contextmanager
+from threading import Condition, RLock
+import time
+
+from .exceptions import RateLimitedError
+
+
+class TokenBucket(object):
+    """
+    rate:float = tokens added a second
+    burst:int = the most tokens the bucket holds
+    """
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive.")
+        self.rate = float(rate)
+        self.burst = max(burst or 1, 1)
+        self._lock = RLock()
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+
+    def _refill(self, now):
+        elapsed = max(now - self._updated, 0)
+        self._tokens = min(self._tokens + elapsed * self.rate, self.burst)
+        self._updated = now
+
+    def reserve(self, max_wait=None, now=None):
+        """
+        Takes a token, returning how many seconds to wait before it may be
+        used. Raises a RateLimitedError, and takes nothing, if that would be
+        longer than max_wait.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._refill(now)
+            wait = max((1 - self._tokens) / self.rate, 0)
+            if max_wait is not None and wait > max_wait:
+                raise RateLimitedError(
+                    "Rate limited for %.2f seconds." % wait, retry_after=wait)
+            # Tokens go negative while calls wait for them, which queues
+            # later calls behind the earlier ones.
+            self._tokens -= 1
+            return wait
+
+
+class Limiter(object):
+    """
+    Holds calls to one carrier to a rate and a number in flight at once,
+    and keeps count of how long they waited.
+
+    name:string = the carrier limited, for error messages
+    rate:float|None = calls a second, or None for no rate limit
+    burst:int|None = calls allowed at once after a quiet spell, or None to
+        allow one
+    max_in_flight:int|None = calls allowed in flight at once, or None for no
+        limit
+    """
+    def __init__(self, name, rate=None, burst=None, max_in_flight=None):
+        self.name = name
+        self.bucket = None if rate is None else TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self._condition = Condition(RLock())
+        self.in_flight = 0
+        self.calls = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.longest_wait = 0.0
+
+    def acquire(self, max_wait=None):
+        """
+        Waits for room for a call, for up to max_wait seconds, and returns
+        how long it waited. Raises a RateLimitedError instead if there's no
+        room in time. Every acquire() that returns needs a release().
+        """
+        start = time.time()
+        deadline = None if max_wait is None else start + max_wait
+        try:
+            if self.bucket is not None:
+                wait = self.bucket.reserve(max_wait, now=start)
+                if wait:
+                    time.sleep(wait)
+            self._take_slot(deadline)
+        except RateLimitedError:
+            with self._condition:
+                self.rejected += 1
+            raise
+        waited = time.time() - start
+        with self._condition:
+            self.calls += 1
+            if waited > 0.001:
+                self.delayed += 1
+            self.total_wait += waited
+            self.longest_wait = max(self.longest_wait, waited)
+        return waited
+
+    def _take_slot(self, deadline):
+        with self._condition:
+            if self.max_in_flight is not None:
+                while self.in_flight >= self.max_in_flight:
+                    if deadline is None:
+                        self._condition.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RateLimitedError(
+                            "Too many calls in flight to %s." % self.name)
+                    self._condition.wait(remaining)
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def limit(self, max_wait=None):
+        """
+        Holds a call for as long as the block runs.
+        """
+        self.acquire(max_wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """
+        Returns how many calls were made, delayed and rejected, and how long
+        they waited, in seconds.
+        """
+        with self._condition:
+            return {
+                'rate': self.bucket and self.bucket.rate,
+                'burst': self.bucket and self.bucket.burst,
+                'max_in_flight': self.max_in_flight,
+                'in_flight': self.in_flight,
+                'calls': self.calls,
+                'delayed': self.delayed,
+                'rejected': self.rejected,
+                'total_wait': self.total_wait,
+                'mean_wait': self.total_wait / self.calls if self.calls else 0,
+                'longest_wait': self.longest_wait}
+
+
+@contextmanager
+def unlimited():
+    """
+    Stands in for Limiter.limit() where there are no limits.
+    """
+    yield
+
+
+_limiters = {}
+_limiters_lock = RLock()
+
+
+def limiter_from_configuration(name, settings):
+    """
+    Gets the Limiter for carrier name described by its 'rate_limit' in
+    carrier_inits, or None if it has none. Carriers with the same name and
+    equivalent settings share a Limiter, whatever their max_wait.
+    """
+    if not settings:
+        return None
+    options = {
+        'rate': settings.get('rate'),
+        'burst': settings.get('burst'),
+        'max_in_flight': settings.get('max_in_flight')}
+    signature = (name,) + tuple(sorted(options.items()))
+    with _limiters_lock:
+        if signature not in _limiters:
+            _limiters[signature] = Limiter(name, **options)
+        return _limiters[signature]
@@ -2,36 +2,32 @@
 Front-end for the Postal Library.
 """
 import sys
+import time
 
+from collections import OrderedDict
 from copy import copy
+from functools import partial
+from threading import RLock
 
 from concurrent import futures
-from concurrent.futures import ThreadPoolExecutor
 
-from .exceptions import PostalError, NotSupportedError
+from . import batch
+from .exceptions import CarrierTimeoutError, CarrierUnavailableError, \
+    PostalError, NotSupportedError
+from .executor import call_later, executor_from_configuration
+from .tracking import tracking_cache_from_configuration, \
+    tracking_history_from_configuration
 from carriers import Carrier
 
 
-class ThreadPoolExecutorStackTraced(ThreadPoolExecutor):
-
-    def submit(self, fn, *args, **kwargs):
-        """
-        Submits the wrapped function instead of `fn`
-        """
-        return super(ThreadPoolExecutorStackTraced, self).submit(
-            self._function_wrapper, fn, *args, **kwargs)
-
-    def _function_wrapper(self, fn, *args, **kwargs):
-        """
-        Wraps `fn` in order to preserve the traceback of any kind of raised exception
-        """
-        try:
-            return fn(*args, **kwargs)
-        except Exception:
-            # Creates an exception of the same type and traceback before the futures library
-            # removes information that it should not.
-            info = sys.exc_info()
-            raise info[0], info[1], info[2]
+def warm_wsdl_cache(configuration_dict):
+    """
+    Parses the WSDL files of every enabled carrier into the WSDL cache. Run
+    this once before starting workers (during a deploy, for instance) so that
+    none of them has to parse WSDL files when constructing Postal.
+    """
+    for carrier in configuration_dict['enabled_carriers']:
+        carrier.warm_wsdl_cache(configuration_dict)
 
 
 class Postal:
@@ -51,23 +47,36 @@ class Postal:
         """
         # Give carriers a back reference to the main postal object.
         configuration_dict['postal'] = self
+        self.executor_settings = configuration_dict.get('executor')
+        self.tracking_cache = tracking_cache_from_configuration(
+            configuration_dict.get('tracking_cache'))
+        self.tracking_history = tracking_history_from_configuration(
+            configuration_dict.get('tracking_history'))
         self.carrier_country = configuration_dict['carrier_country']
         self.carriers = {carrier.name: carrier
                          for carrier in configuration_dict['enabled_carriers']}
         carrier_configs = configuration_dict['carrier_inits']
         for name, carrier in self.carriers.items():
             try:
-                self.carriers[name] = carrier(
-                    postal_configuration=configuration_dict,
-                    **carrier_configs[name])
+                self.carriers[name] = carrier.from_configuration(
+                    configuration_dict)
             except Exception:
                 print 'Error while constructing carrier ' + str(name)
                 print 'with these args: ' + str(carrier_configs[name])
                 raise
+            if configuration_dict.get('prewarm_clients'):
+                self.carriers[name].prewarm()
 
-    def options(self, request):
+    def options(self, request, deadline=None):
         """
-        Gets all service options from all carriers.
+        Gets all service options from all carriers. Carriers whose circuit
+        breakers are open aren't called, and get a CarrierUnavailableError
+        as their error right away.
+
+        deadline:float|None = the most seconds to wait on carriers. Carriers
+            that haven't answered by then, or by their own soft_timeout, get
+            a CarrierTimeoutError as their error. Their calls still finish in
+            the background, so their rates are cached for next time.
 
         returns:
         {
@@ -80,6 +89,235 @@ class Postal:
             ... = all loaded carriers represented exactly once
         }
         """
+        return dict(self.options_iter(request, deadline=deadline))
+
+    def options_iter(self, request, deadline=None):
+        """
+        Like options(), but yields (carrier, {'services', 'error'}) for each
+        carrier as soon as it has answered or timed out, so that the quickest
+        carriers' rates can be shown while the others are still working.
+        Problems with the request itself are raised when iteration starts.
+        """
+        self._check_packages(request)
+        carriers, unavailable = self._carrier_options(request)
+
+        start = time.time()
+        executor = self.executor
+        pending = {
+            executor.submit_for(carrier.name, _task, (carrier, request)):
+                carrier
+            for carrier in carriers.values()}
+        cutoffs = {}
+        for carrier in carriers.values():
+            timeout = _timeout(carrier, deadline)
+            cutoffs[carrier] = None if timeout is None else start + timeout
+        for carrier, entry in unavailable.items():
+            yield carrier, entry
+
+        while pending:
+            due = [cutoffs[carrier] for carrier in pending.values()
+                   if cutoffs[carrier] is not None]
+            timeout = max(min(due) - time.time(), 0) if due else None
+            executor.gather(
+                pending, timeout=timeout,
+                return_when=futures.FIRST_COMPLETED)
+            now = time.time()
+            for future, carrier in pending.items():
+                if future.done():
+                    entry = future.result()[1]
+                elif cutoffs[carrier] is not None and now >= cutoffs[carrier]:
+                    # Frees the executor if the call hasn't started yet.
+                    future.cancel()
+                    entry = _timed_out(carrier, cutoffs[carrier] - start)
+                else:
+                    continue
+                del pending[future]
+                yield carrier, entry
+
+    def options_many(self, requests, ordered=True, window=100):
+        """
+        Gets options() for each of many requests, yielding
+        (index, request, results) for each once all of its carriers have
+        answered. index is the request's position in requests, and results
+        is shaped as options() returns it.
+
+        Requests with the same fingerprint are rated once and share their
+        results, as long as they come while it's in flight or among the
+        window most recently finished fingerprints; older results are let go
+        so that memory stays bounded, and a later duplicate is rated again
+        (usually from the rate cache). Calls for every request go to the
+        shared executor, with no more than window requests in flight or
+        waiting to be yielded at once, so requests may be a long or lazily
+        built iterable. With ordered set,
+        results are yielded in the order of requests, otherwise in the order
+        they finish.
+
+        Carriers' soft_timeouts aren't applied, since a batch has no one
+        waiting on any single request. Invalid requests are reported with
+        their error for every carrier, like failed calls are.
+        """
+        executor = self.executor
+        source = enumerate(requests)
+        exhausted = False
+        flights = {}
+        # The results of the most recently finished fingerprints, oldest
+        # first.
+        finished = OrderedDict()
+        pending = {}
+        ready = {}
+        next_index = 0
+
+        while True:
+            while not exhausted and len(flights) + len(ready) < window:
+                try:
+                    index, request = next(source)
+                except StopIteration:
+                    exhausted = True
+                    break
+                carriers = self.carriers
+                unavailable = {}
+                try:
+                    carriers, unavailable = self._carrier_options(request)
+                    self._check_packages(request)
+                    key = request.fingerprint()
+                except Exception as err:
+                    if not hasattr(err, 'traceback'):
+                        err.traceback = sys.exc_info()[2]
+                    ready[index] = (request, {
+                        carrier: {'services': None, 'error': err}
+                        for carrier in carriers.values()})
+                    continue
+                if key in finished:
+                    finished[key] = finished.pop(key)
+                    ready[index] = (request, dict(finished[key]))
+                    continue
+                if key in flights:
+                    flights[key].waiting.append((index, request))
+                    continue
+                flight = _Flight(len(carriers) + len(unavailable))
+                flight.results.update(unavailable)
+                if not carriers:
+                    # Nothing to call, so it's finished as soon as it's made.
+                    _remember(finished, key, flight.results, window)
+                    ready[index] = (request, dict(flight.results))
+                    continue
+                flights[key] = flight
+                flight.waiting.append((index, request))
+                for carrier in carriers.values():
+                    future = executor.submit_for(
+                        carrier.name, _task, (carrier, request))
+                    pending[future] = key, carrier
+
+            if ordered:
+                while next_index in ready:
+                    request, results = ready.pop(next_index)
+                    yield next_index, request, results
+                    next_index += 1
+            else:
+                for index in sorted(ready):
+                    request, results = ready.pop(index)
+                    yield index, request, results
+
+            if not pending:
+                if exhausted:
+                    return
+                continue
+            done, _ = futures.wait(
+                list(pending), return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                key, carrier = pending.pop(future)
+                if future.cancelled():
+                    entry = _cancelled(carrier)
+                else:
+                    entry = future.result()[1]
+                flight = flights[key]
+                flight.results[carrier] = entry
+                if len(flight.results) < flight.carriers:
+                    continue
+                del flights[key]
+                _remember(finished, key, flight.results, window)
+                for index, request in flight.waiting:
+                    ready[index] = (request, dict(flight.results))
+
+    def ship_many(self, jobs, journal=None, sink=None, carrier_limits=None,
+                  default_limit=4, window=100):
+        """
+        Ships each (service, request) pair in jobs, yielding
+        (index, service, request, entry) for each as it finishes. Shipments
+        for each carrier are limited to carrier_limits[name], or
+        default_limit, at a time. A batch.ShipmentJournal lets a run that
+        stopped part way be resumed without shipping anything twice, and a
+        batch.LabelSink takes the labels as they come in. See
+        batch.ship_many() for details.
+        """
+        return batch.ship_many(
+            self.executor, jobs, journal=journal, sink=sink,
+            carrier_limits=carrier_limits, default_limit=default_limit,
+            window=window)
+
+    def options_async(self, request, deadline=None):
+        """
+        Like options(), but returns right away with a Future for the result
+        rather than waiting on carriers. No thread waits on the carriers in
+        the meantime. Callers running an asyncio loop can await it through
+        asyncio.wrap_future().
+        """
+        self._check_packages(request)
+        carriers, unavailable = self._carrier_options(request)
+        carriers = carriers.values()
+        result = futures.Future()
+        result.set_running_or_notify_cancel()
+        results = dict(unavailable)
+        timers = []
+        lock = RLock()
+
+        def finish(carrier, entry):
+            with lock:
+                if carrier in results:
+                    return
+                results[carrier] = entry
+                if len(results) < len(carriers) + len(unavailable):
+                    return
+            for timer in timers:
+                timer.cancel()
+            result.set_result(results)
+
+        def completed(carrier, future):
+            # Calls are cancelled when they time out, and when the executor
+            # is shut down before they start.
+            if future.cancelled():
+                finish(carrier, _cancelled(carrier))
+            else:
+                finish(carrier, future.result()[1])
+
+        def expired(carrier, future, timeout):
+            finish(carrier, _timed_out(carrier, timeout))
+            future.cancel()
+
+        if not carriers:
+            result.set_result(results)
+        for carrier in carriers:
+            future = self.executor.submit_for(
+                carrier.name, _task, (carrier, request))
+            timeout = _timeout(carrier, deadline)
+            if timeout is not None:
+                timers.append(call_later(
+                    timeout, partial(expired, carrier, future, timeout)))
+            future.add_done_callback(partial(completed, carrier))
+        return result
+
+    def track_async(self, carrier_name, tracking_number):
+        """
+        Like track(), but returns a Future for the result.
+        """
+        if carrier_name not in self.carriers:
+            raise PostalError(
+                "A carrier named '%s' does not exist." % carrier_name)
+        return self.executor.submit_for(
+            carrier_name, self.track, carrier_name, tracking_number)
+
+    @staticmethod
+    def _check_packages(request):
         if not request.packages:
             raise NotSupportedError('No packages in shipment.')
         for i, package in enumerate(request.packages, 1):
@@ -89,16 +327,40 @@ class Postal:
                 raise NotSupportedError('The dimensions of package #%s are '
                                         'invalid.' % i)
 
-        carriers = self.request_carrier_options(request)
+    @property
+    def executor(self):
+        """
+        The executor shared by Postal and its carriers for concurrent calls.
+        """
+        return executor_from_configuration(self.executor_settings)
+
+    def executor_stats(self):
+        return self.executor.stats()
+
+    def breaker_states(self):
+        """
+        Returns the state of each carrier's circuit breaker, by carrier name,
+        for carriers that have one.
+        """
+        return {name: carrier.breaker.stats()
+                for name, carrier in self.carriers.items()
+                if carrier.breaker is not None}
 
-        with ThreadPoolExecutorStackTraced(max_workers=len(carriers)) as executor:
-            futures_dict = {
-                executor.submit(_task, (carrier, request)): carrier.name for carrier in carriers.values()
-            }
-            results = []
-            for future in futures.as_completed(futures_dict):
-                results.append(future.result())
-        return dict(results)
+    def limiter_stats(self):
+        """
+        Returns how long calls have waited on each rate limited carrier's
+        Limiter, by carrier name.
+        """
+        return {name: carrier.limiter.stats()
+                for name, carrier in self.carriers.items()
+                if carrier.limiter is not None}
+
+    def shutdown(self, wait=True):
+        """
+        Shuts down the shared executor. Postal can still be used afterwards,
+        but it will start a new one.
+        """
+        self.executor.shutdown(wait=wait)
 
     def get_all_services(self):
         """
@@ -118,7 +380,77 @@ class Postal:
         if carrier_name not in self.carriers:
             raise PostalError(
                 "A carrier named '%s' does not exist." % carrier_name)
-        return self.carriers[carrier_name].track(tracking_number)
+        carrier = self.carriers[carrier_name]
+        if self.tracking_cache is not None:
+            return self.tracking_cache.track(carrier, tracking_number)
+        return carrier.track(tracking_number)
+
+    def track_history(self, carrier_name, tracking_number):
+        """
+        Gets every event in a shipment's history, oldest first, each shaped
+        like what track() returns.
+        """
+        if carrier_name not in self.carriers:
+            raise PostalError(
+                "A carrier named '%s' does not exist." % carrier_name)
+        return self.carriers[carrier_name].track_events(tracking_number)
+
+    def track_updates(self, carrier_name, tracking_number):
+        """
+        Like track_history(), but only returns the events that no earlier
+        call returned for the shipment, so that callers can handle each
+        event once. Which events have been returned is remembered by
+        tracking_history.
+        """
+        events = self.track_history(carrier_name, tracking_number)
+        return self.tracking_history.updates(
+            carrier_name, tracking_number, events)
+
+    def track_many(self, carrier_name, tracking_numbers):
+        """
+        Tracks each of tracking_numbers with one carrier, packing as many
+        into each call as the carrier takes. Returns an OrderedDict of each
+        tracking number to {'tracking': dict|None, 'error': Exception|None},
+        where 'tracking' is what track() returns.
+        """
+        if carrier_name not in self.carriers:
+            raise PostalError(
+                "A carrier named '%s' does not exist." % carrier_name)
+        carrier = self.carriers[carrier_name]
+        if self.tracking_cache is not None:
+            return self.tracking_cache.track_many(carrier, tracking_numbers)
+        return carrier.track_many(tracking_numbers)
+
+    def track_mixed(self, shipments):
+        """
+        Like track_many(), but for (carrier_name, tracking_number) pairs from
+        any mix of carriers, with every carrier tracked at once. Returns an
+        OrderedDict keyed by those pairs. Unknown carriers get a PostalError
+        as their error.
+        """
+        shipments = list(shipments)
+        numbers = OrderedDict()
+        for carrier_name, tracking_number in shipments:
+            numbers.setdefault(carrier_name, []).append(tracking_number)
+        submitted = {
+            carrier_name: self.executor.submit(
+                self.track_many, carrier_name, carrier_numbers)
+            for carrier_name, carrier_numbers in numbers.items()
+            if carrier_name in self.carriers}
+        self.executor.gather(submitted.values())
+        results = OrderedDict()
+        for carrier_name, tracking_number in shipments:
+            if carrier_name in submitted:
+                future = submitted[carrier_name]
+                if future.exception() is None:
+                    entry = future.result()[tracking_number]
+                else:
+                    entry = {'tracking': None, 'error': future.exception()}
+            else:
+                entry = {'tracking': None, 'error': PostalError(
+                    "A carrier named '%s' does not exist." % carrier_name)}
+            results[carrier_name, tracking_number] = entry
+        return results
 
     def get_package_type(self, carrier_name, code):
         if carrier_name not in self.carriers:
@@ -136,13 +468,28 @@ class Postal:
                 yield package_type
 
     def request_carrier_options(self, request):
+        """
+        The carriers to ask for options for request, by name: those serving
+        its destination whose circuit breakers aren't open.
+        """
+        return self._carrier_options(request)[0]
+
+    def _carrier_options(self, request):
+        """
+        Returns request_carrier_options(), and the options() entries for
+        carriers left out because their circuit breakers are open.
+        """
         # Check country white list
         carriers = dict(self.carriers)
+        unavailable = {}
         for carrier in carriers.values():
             served = get_served_country(carrier.name, request.destination.country.alpha2, self.carrier_country)
             if not served:
                 del carriers[carrier.name]
-        return carriers
+            elif not carrier.available():
+                del carriers[carrier.name]
+                unavailable[carrier] = _unavailable(carrier)
+        return carriers, unavailable
 
     def without(self, *args):
         """
@@ -158,6 +505,23 @@ class Postal:
         return result
 
 
+class _Flight(object):
+    """
+    The calls to carriers for one distinct request in options_many(), and
+    the requests waiting on them.
+    """
+    def __init__(self, carriers):
+        self.carriers = carriers
+        self.results = {}
+        self.waiting = []
+
+
+def _remember(finished, key, results, size):
+    finished[key] = results
+    while len(finished) > size:
+        finished.popitem(last=False)
+
+
 def _task(arg_list):
     carrier, request = arg_list
     data_dict = {'services': None, 'error': None}
@@ -171,6 +535,36 @@ def _task(arg_list):
     return carrier, data_dict
 
 
+def _timeout(carrier, deadline):
+    """
+    Seconds to wait on carrier, given the overall deadline.
+    """
+    timeouts = [timeout for timeout in (deadline, carrier.soft_timeout)
+                if timeout is not None]
+    return min(timeouts) if timeouts else None
+
+
+def _timed_out(carrier, timeout):
+    return {
+        'services': None,
+        'error': CarrierTimeoutError(
+            "%s didn't respond within %.2f seconds." % (carrier.name, timeout))}
+
+
+def _cancelled(carrier):
+    return {'services': None, 'error': PostalError(
+        "The call to %s was cancelled." % carrier.name)}
+
+
+def _unavailable(carrier):
+    retry_after = carrier.breaker.stats()['retry_after']
+    return {
+        'services': None,
+        'error': CarrierUnavailableError(
+            "%s is unavailable after repeated failures." % carrier.name,
+            retry_after=retry_after)}
+
+
 def get_served_country(carrier, dest_country, carrier_country):
     if carrier in carrier_country and not dest_country in carrier_country[carrier]:
         return False
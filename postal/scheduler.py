@@ -0,0 +1,345 @@
+"""
+Deciding when to track shipments again.
+
+TrackingScheduler keeps (carrier name, tracking number) pairs in a priority
+queue ordered by when each is next due, and polls the due ones through
+Postal.track() on the shared executor. After each poll the shipment is
+queued again after an interval that adapts to what came back:
+
+- A status code listed in status_intervals for the carrier sets the interval
+  outright (an out for delivery scan deserves a quicker look, say).
+- Otherwise the interval is age_factor times the age of the latest event,
+  between the carrier's min_interval and max_interval, so shipments that
+  haven't moved in days are polled less often.
+- Failed polls back off, doubling from min_interval with each failure in a
+  row.
+- Finalized shipments leave the queue.
+
+Intervals are jittered so that shipments added together drift apart, and
+polls to each carrier are spaced to stay under its rate, in polls a second.
+Shipments are taken up to a window's worth of polls ahead for each carrier,
+and each poll waits on its worker for its own start within the window, so
+a carrier is polled at its full rate however long its calls take.
+
+The queue is saved to a JSON file every save_interval seconds or
+save_changes changes, whichever comes first, and when run() stops. It's
+loaded from the file on construction, so that a restarted poller picks up
+each shipment's own schedule instead of polling everything at once.
+"""
+from concurrent import futures
+from threading import Event, RLock
+import heapq
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from .tracking import event_age
+
+
+class TrackingScheduler(object):
+    """
+    postal:Postal = used to track shipments, and for its executor
+    path:string|None = the file the queue is kept in, if any
+    rates:{string -> float} = the most polls a second to each carrier
+    default_rate:float|None = the rate for carriers not in rates, or None for
+        no limit
+    min_interval:float = the fewest seconds between polls of a shipment
+    max_interval:float = the most seconds between polls of a shipment
+    age_factor:float = the fraction of the age of a shipment's latest event
+        to wait before polling it again
+    carrier_intervals:{string -> (float, float)} = min_interval and
+        max_interval for particular carriers
+    status_intervals:{string -> {string -> float}} = seconds to wait after
+        particular status codes, by carrier name
+    jitter:float = the fraction intervals are randomly lengthened or
+        shortened by
+    workers:int = the most polls in flight at once
+    window:float = seconds of polls to each carrier taken in each run
+    save_interval:float = the most seconds between saves of the queue
+    save_changes:int = the most changes to the queue between saves
+    on_result:function|None = called with (carrier_name, tracking_number,
+        result, error) after each poll, on the thread that polled
+    """
+    def __init__(self, postal, path=None, rates=None, default_rate=None,
+                 min_interval=900, max_interval=86400, age_factor=0.25,
+                 carrier_intervals=None, status_intervals=None, jitter=0.1,
+                 workers=8, window=1.0, save_interval=60, save_changes=1000,
+                 on_result=None):
+        self.postal = postal
+        self.path = path
+        self.rates = dict(rates or {})
+        self.default_rate = default_rate
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.age_factor = age_factor
+        self.carrier_intervals = dict(carrier_intervals or {})
+        self.status_intervals = dict(status_intervals or {})
+        self.jitter = jitter
+        self.workers = workers
+        self.window = window
+        self.save_interval = save_interval
+        self.save_changes = save_changes
+        self.on_result = on_result
+        self._lock = RLock()
+        self._heap = []
+        # (carrier_name, tracking_number) -> [due, failures]. Heap entries
+        # whose due time doesn't match are stale and skipped.
+        self._entries = {}
+        self._next_allowed = {}
+        self._changes = 0
+        self._saved_at = None
+        self._stopped = Event()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, shipment):
+        return tuple(shipment) in self._entries
+
+    def add(self, carrier_name, tracking_number, due=None):
+        """
+        Queues a shipment to be polled at due (a timestamp), or right away.
+        Shipments already queued keep their place unless due is given.
+        """
+        key = (carrier_name, tracking_number)
+        with self._lock:
+            if key in self._entries and due is None:
+                return
+            failures = self._entries.get(key, [None, 0])[1]
+            self._push(key, time.time() if due is None else due, failures)
+
+    def remove(self, carrier_name, tracking_number):
+        with self._lock:
+            if self._entries.pop((carrier_name, tracking_number), None):
+                self._changes += 1
+
+    def due(self, carrier_name, tracking_number):
+        """
+        When the shipment is next due to be polled, or None if it isn't
+        queued.
+        """
+        entry = self._entries.get((carrier_name, tracking_number))
+        return entry and entry[0]
+
+    def next_due(self):
+        """
+        When the next shipment is due to be polled, or None if there are
+        none.
+        """
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def _push(self, key, due, failures):
+        self._entries[key] = [due, failures]
+        heapq.heappush(self._heap, (due, key))
+        self._changes += 1
+
+    def _drop_stale(self):
+        while self._heap:
+            due, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == due:
+                return
+            heapq.heappop(self._heap)
+
+    def rate(self, carrier_name):
+        return self.rates.get(carrier_name, self.default_rate)
+
+    def interval(self, carrier_name, result):
+        """
+        Seconds to wait before polling a shipment again, given what tracking
+        it last returned. Jitter isn't applied.
+        """
+        low, high = self.carrier_intervals.get(
+            carrier_name, (self.min_interval, self.max_interval))
+        code = result.get('status_code')
+        intervals = self.status_intervals.get(carrier_name, {})
+        if code in intervals:
+            return intervals[code]
+        age = event_age(result)
+        if age is None:
+            return low
+        return min(max(age * self.age_factor, low), high)
+
+    def backoff(self, carrier_name, failures):
+        low, high = self.carrier_intervals.get(
+            carrier_name, (self.min_interval, self.max_interval))
+        return min(low * 2 ** (failures - 1), high)
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def take_due(self, now=None, window=None, limit=None):
+        """
+        Takes the shipments due by now off the queue, as many as each
+        carrier's rate allows in the window seconds from now and no more than
+        limit, and returns (start, (carrier_name, tracking_number)) pairs,
+        start being when the shipment may be polled. Shipments held back by a
+        rate are queued again for when the carrier has room.
+        """
+        now = time.time() if now is None else now
+        window = self.window if window is None else window
+        taken = []
+        with self._lock:
+            while limit is None or len(taken) < limit:
+                self._drop_stale()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                due, key = heapq.heappop(self._heap)
+                carrier_name = key[0]
+                rate = self.rate(carrier_name)
+                start = now
+                if rate:
+                    start = max(self._next_allowed.get(carrier_name, now), now)
+                    if start >= now + window and start > now:
+                        self._push(key, start, self._entries[key][1])
+                        continue
+                    self._next_allowed[carrier_name] = start + 1.0 / rate
+                # Stays in _entries, so that add() leaves it alone, but
+                # can't come off the heap again until it's rescheduled.
+                self._entries[key][0] = None
+                taken.append((start, key))
+        return taken
+
+    def _poll(self, key, start=None, now=None):
+        """
+        Polls a taken shipment once its start comes, and queues it again.
+        """
+        wait = 0 if start is None else start - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        carrier_name, tracking_number = key
+        try:
+            result, error = self.postal.track(
+                carrier_name, tracking_number), None
+        except Exception as err:
+            if not hasattr(err, 'traceback'):
+                err.traceback = sys.exc_info()[2]
+            result, error = None, err
+        self.reschedule(carrier_name, tracking_number, result, error, now=now)
+        if self.on_result is not None:
+            self.on_result(carrier_name, tracking_number, result, error)
+
+    def reschedule(self, carrier_name, tracking_number, result, error,
+                   now=None):
+        """
+        Queues a polled shipment again, or drops it if it's finalized.
+        """
+        now = time.time() if now is None else now
+        key = (carrier_name, tracking_number)
+        with self._lock:
+            if key not in self._entries:
+                # Removed while it was being polled.
+                return
+            if error is not None or not isinstance(result, dict):
+                failures = self._entries[key][1] + 1
+                self._push(key, now + self._jittered(
+                    self.backoff(carrier_name, failures)), failures)
+            elif result.get('finalized'):
+                del self._entries[key]
+                self._changes += 1
+            else:
+                self._push(key, now + self._jittered(
+                    self.interval(carrier_name, result)), 0)
+
+    def run_once(self, now=None):
+        """
+        Polls every shipment that's due and that the carriers' rates allow
+        in the next window, each at its own start, queues them again, and
+        saves the queue if it's due to be. Returns how many were polled.
+        """
+        begun = time.time()
+        polled_at = begun if now is None else now
+        taken = self.take_due(polled_at)
+        if taken:
+            # Starts are on the clock now was given in.
+            self.postal.executor.map(
+                None, self._poll, [key for _, key in taken],
+                [begun + start - polled_at for start, _ in taken],
+                [now] * len(taken), limit=self.workers)
+        if self.path and self.save_due():
+            self.save()
+        return len(taken)
+
+    def save_due(self):
+        """
+        Whether the queue has gone save_interval seconds or save_changes
+        changes without being saved.
+        """
+        return self._changes > 0 and (
+            self._saved_at is None or self._changes >= self.save_changes or
+            time.time() - self._saved_at >= self.save_interval)
+
+    def run(self, idle=60):
+        """
+        Polls shipments as they come due until stop() is called, waiting at
+        most idle seconds at a time between runs. Unlike run_once(), shipments
+        are taken as workers come free rather than a run at a time, so slow
+        calls don't leave a carrier's rate unused.
+        """
+        self._stopped.clear()
+        executor = self.postal.executor
+        pending = []
+        while not self._stopped.is_set():
+            pending = [future for future in pending if not future.done()]
+            for start, key in self.take_due(
+                    limit=self.workers - len(pending)):
+                pending.append(executor.submit(self._poll, key, start))
+            if self.path and self.save_due():
+                self.save()
+            next_due = self.next_due()
+            wait = idle if next_due is None else next_due - time.time()
+            wait = min(max(wait, 0), idle)
+            if len(pending) < self.workers:
+                self._stopped.wait(wait)
+            else:
+                executor.gather(
+                    pending, timeout=wait,
+                    return_when=futures.FIRST_COMPLETED)
+        executor.gather(pending)
+        if self.path:
+            self.save()
+
+    def stop(self):
+        self._stopped.set()
+
+    def save(self):
+        """
+        Writes the queue to path, replacing the file in one step so that a
+        crash never leaves half of it.
+        """
+        with self._lock:
+            shipments = [
+                {'carrier': key[0], 'tracking_number': key[1],
+                 'due': entry[0], 'failures': entry[1]}
+                for key, entry in self._entries.items()]
+            self._changes = 0
+            self._saved_at = time.time()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'wb') as state_file:
+            json.dump({'shipments': shipments}, state_file)
+        os.rename(temp_path, self.path)
+
+    def load(self):
+        """
+        Reads the queue back from path. Shipments that were being polled
+        when it was saved are due right away.
+        """
+        with open(self.path, 'rb') as state_file:
+            state = json.load(state_file)
+        now = time.time()
+        with self._lock:
+            for shipment in state['shipments']:
+                due = shipment['due']
+                self._push(
+                    (shipment['carrier'], shipment['tracking_number']),
+                    now if due is None else due, shipment['failures'])
+            self._changes = 0
+            self._saved_at = now
@@ -0,0 +1,110 @@
+"""
+Pooled HTTP sessions for talking to carriers.
+
+Opening a connection to a carrier (TCP and TLS handshakes) often takes longer
+than the request itself, so carriers keep their connections open between
+calls and share them between threads through a pooled requests.Session.
+The SOAP carriers' suds clients do the same through SessionTransport.
+"""
+from StringIO import StringIO
+from threading import RLock
+import httplib
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from suds.properties import Unskin
+from suds.transport import Reply, TransportError
+from suds.transport.http import HttpTransport
+
+
+def pooled_session(pool_size=10, max_retries=2, backoff_factor=0.1,
+                   pool_connections=None):
+    """
+    Makes a Session that keeps up to pool_size connections open to each
+    host, for up to pool_connections hosts (by default, pool_size). Sessions
+    are safe to share between the threads Postal uses for carriers, as long
+    as they aren't reconfigured once in use.
+
+    Failures to connect are retried up to max_retries times, waiting
+    backoff_factor * 2 ** (attempt - 1) seconds in between. Requests that
+    reached the carrier are never retried, since shipping twice costs money.
+    """
+    retry = Retry(
+        total=max_retries, connect=max_retries, read=0, redirect=0,
+        backoff_factor=backoff_factor)
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections or pool_size,
+        pool_maxsize=pool_size, max_retries=retry)
+    session = Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_sessions = {}
+_sessions_lock = RLock()
+
+
+def session_from_configuration(settings=None):
+    """
+    Gets the session described by the 'http_pool' section of a postal
+    configuration. Everything built from equivalent settings shares one
+    session, and so one pool of connections.
+    """
+    settings = settings or {}
+    options = {
+        'pool_size': settings.get('pool_size', 10),
+        'pool_connections': settings.get('pool_connections', 10),
+        'max_retries': settings.get('max_retries', 2),
+        'backoff_factor': settings.get('backoff_factor', 0.1)}
+    signature = tuple(sorted(options.items()))
+    with _sessions_lock:
+        session = _sessions.get(signature)
+        if session is None:
+            session = _sessions[signature] = pooled_session(**options)
+        return session
+
+
+class SessionTransport(HttpTransport):
+    """
+    A suds transport that makes its calls through a pooled session, rather
+    than opening a new connection for each call as suds' own transports do.
+    Local files, like bundled WSDLs, are still opened by suds.
+    """
+    def __init__(self, session=None, **kwargs):
+        HttpTransport.__init__(self, **kwargs)
+        self.session = session or pooled_session()
+
+    def open(self, request):
+        if not request.url.lower().startswith(('http:', 'https:')):
+            return HttpTransport.open(self, request)
+        response = self._call('GET', request)
+        if response.status_code >= 400:
+            raise TransportError(
+                response.reason, response.status_code,
+                StringIO(response.content))
+        return StringIO(response.content)
+
+    def send(self, request):
+        response = self._call('POST', request)
+        if response.status_code in (httplib.ACCEPTED, httplib.NO_CONTENT):
+            return None
+        if response.status_code >= 400:
+            raise TransportError(
+                response.reason, response.status_code,
+                StringIO(response.content))
+        headers = {key.lower(): value
+                   for key, value in response.headers.items()}
+        return Reply(httplib.OK, headers, response.content)
+
+    def _call(self, method, request):
+        return self.session.request(
+            method, request.url, data=request.message,
+            headers=request.headers, timeout=self.options.timeout,
+            proxies=self.options.proxy or None)
+
+    def __deepcopy__(self, memo={}):
+        clone = self.__class__(self.session)
+        Unskin(clone.options).update(Unskin(self.options))
+        return clone
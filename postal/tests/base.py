@@ -103,9 +103,7 @@ class _AbstractTestCarrier(object):
     carrier_class = Carrier
 
     def init_carrier(self):
-        return self.carrier_class(
-            postal_configuration=config,
-            **config['carrier_inits'][self.carrier_class.name])
+        return self.carrier_class.from_configuration(config)
 
     def setUp(self):
         self.carrier = self.init_carrier()
@@ -313,6 +311,10 @@ class _AbstractTestCarrier(object):
         for service in services:
             self.assertIsInstance(service, Service)
 
+    def test_lazy_clients(self):
+        for name in self.carrier.lazy_clients():
+            self.assertNotIn('_lazy_' + name, vars(self.carrier))
+
     def test_no_etds(self):
         request = Request(
             self.test_from, Address(**test_no_etd),
@@ -4,13 +4,14 @@ import unittest
 
 import mock
 from money import Money
-from suds.transport.http import HttpTransport, Reply
+from suds.transport import Reply
 
 from postal.carriers.aramex import AramexApi
 from postal.carriers.base import Service
 from postal.data import PackageType
-from postal.exceptions import AddressError
+from postal.exceptions import AddressError, SoftCarrierError
 from postal.postal import Postal
+from postal.sessions import SessionTransport
 from postal.configuration_base import base_postal_configuration
 from postal.tests.fixtures.aramex import tracking_response, tracking_response_ascii
 
@@ -53,8 +54,7 @@ class TestAramex (unittest.TestCase):
             documents_only=True
         )
         self.international_package = Package(3, 4, 5, 6)
-        self.carrier = AramexApi(postal_configuration=config,
-            **config['carrier_inits']['Aramex'])
+        self.carrier = AramexApi.from_configuration(config)
 
         self.mock_response = mock.MagicMock(HasErrors=False, notifications=())
         self.mock_response.TotalAmount = mock.MagicMock(Value=34.5, CurrencyCode='USD')
@@ -195,7 +195,7 @@ class TestAramex (unittest.TestCase):
             })
             self.assertRaises(AddressError, self.carrier.quote, self.carrier.get_service('PPX'), request)
 
-    @mock.patch.object(HttpTransport, 'send')
+    @mock.patch.object(SessionTransport, 'send')
     def test_tracking(self, mock_send):
         mock_send.return_value = Reply(httplib.OK, {}, tracking_response)
         response = self.carrier.track('123456')
@@ -208,7 +208,41 @@ class TestAramex (unittest.TestCase):
         self.assertEqual(response['location'].country.alpha2, 'ZA')
         self.assertEqual(response['location'].city, 'JOHANNESBURG')
 
-    @mock.patch.object(HttpTransport, 'send')
+    @mock.patch.object(SessionTransport, 'send')
+    def test_track_many(self, mock_send):
+        mock_send.return_value = Reply(httplib.OK, {}, tracking_response)
+        results = self.carrier.track_many(['123456', '999'])
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(results.keys(), ['123456', '999'])
+        self.assertEqual(results['123456']['tracking']['status_code'], u'SH001')
+        self.assertIsNone(results['123456']['error'])
+        self.assertIsNone(results['999']['tracking'])
+        self.assertIsInstance(results['999']['error'], SoftCarrierError)
+
+    @mock.patch.object(SessionTransport, 'send')
+    def test_track_many_keeps_breaker_closed(self, mock_send):
+        # Suds can't read Aramex's replies, but they're still answers.
+        mock_send.return_value = Reply(httplib.OK, {}, tracking_response)
+        self.carrier.circuit_breaker = {
+            'window': 4, 'min_calls': 2, 'cooldown': 60}
+        self.carrier.breaker.reset()
+        for _ in range(3):
+            self.carrier.track_many(['123456'])
+        self.assertEqual(self.carrier.breaker.state, 'closed')
+        self.assertEqual(mock_send.call_count, 3)
+
+    @mock.patch.object(SessionTransport, 'send')
+    def test_track_events(self, mock_send):
+        mock_send.return_value = Reply(httplib.OK, {}, tracking_response)
+        events = self.carrier.track_events('123456')
+        self.assertIn('GetLastTrackingUpdateOnly>false',
+                      mock_send.call_args[0][0].message)
+        self.assertEqual([event['status_code'] for event in events],
+                         [u'SH001'])
+        self.assertRaises(
+            SoftCarrierError, self.carrier.track_events, '999')
+
+    @mock.patch.object(SessionTransport, 'send')
     def test_tracking_check_ascii(self, mock_send):
         mock_send.return_value = Reply(httplib.OK, {}, tracking_response_ascii.encode('utf-8'))
         response = self.carrier.track('30793916823')
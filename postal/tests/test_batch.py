@@ -0,0 +1,140 @@
+from threading import Lock
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from money import Money
+
+from postal import Address, Package, Postal, Request, Shipment
+from postal.batch import DirectorySink, ShipmentJournal, job_key
+from postal.carriers.base import Carrier, Service
+from postal.exceptions import CarrierError, PartialShipmentError, \
+    ShipmentInDoubtError
+
+
+class ShippingCarrier(Carrier):
+    name = 'Shipping'
+
+    def __init__(self, postal_configuration=None):
+        super(ShippingCarrier, self).__init__(postal_configuration)
+        self.lock = Lock()
+        self.shipped = []
+        self.running = 0
+        self.most_running = 0
+        self.refuse = set()
+        self.partial = set()
+
+    def ship(self, service, request):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.running, self.most_running)
+        time.sleep(.01)
+        with self.lock:
+            self.running -= 1
+        weight = request.packages[0].weight
+        if weight in self.refuse:
+            raise CarrierError('Refused.')
+        if weight in self.partial:
+            raise PartialShipmentError('Half shipped.')
+        with self.lock:
+            self.shipped.append(weight)
+        return {
+            'shipment': Shipment(self, 'T%s' % weight, transaction_id=weight),
+            'price': Money(weight, 'USD'),
+            'packages': {
+                package: {'tracking_number': 'T%s' % weight,
+                          'label': 'label %s' % weight}
+                for package in request.packages}}
+
+
+class TestShipMany(TestCase):
+    def setUp(self):
+        address = Address(
+            street_lines=['1 Main St'], city='Houston', country='US',
+            subdivision='TX', postal_code='77092')
+        self.postal = Postal({
+            'enabled_carriers': [ShippingCarrier],
+            'carrier_inits': {'Shipping': {}},
+            'carrier_country': {}})
+        self.carrier = self.postal.carriers['Shipping']
+        service = Service(self.carrier, 'ground', 'Ground')
+        self.jobs = [
+            (service, Request(address, address, [Package(1, 2, 3, weight)]))
+            for weight in range(1, 9)]
+        self.directory = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.directory, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def ship(self, **kwargs):
+        return {index: entry for index, service, request, entry
+                in self.postal.ship_many(self.jobs, **kwargs)}
+
+    def test_carrier_limit(self):
+        results = self.ship(carrier_limits={'Shipping': 2})
+        self.assertEqual(sorted(results), range(8))
+        self.assertLessEqual(self.carrier.most_running, 2)
+        shipped = results[3]['shipment']
+        self.assertEqual(shipped['shipment'].tracking_number, 'T4')
+        self.assertEqual(shipped['packages'].values()[0]['label'], 'label 4')
+        self.assertIsNone(results[3]['error'])
+
+    def test_labels_go_to_sink(self):
+        sink = DirectorySink(os.path.join(self.directory, 'labels'), '.txt')
+        results = self.ship(sink=sink)
+        path = results[0]['shipment']['packages'].values()[0]['label']
+        with open(path) as label_file:
+            self.assertEqual(label_file.read(), 'label 1')
+
+    def test_resume(self):
+        sink = DirectorySink(os.path.join(self.directory, 'labels'))
+        self.carrier.refuse = {2}
+        with ShipmentJournal(self.journal_path) as journal:
+            results = self.ship(journal=journal, sink=sink)
+        self.assertIsInstance(results[1]['error'], CarrierError)
+        self.assertEqual(sorted(self.carrier.shipped), [1, 3, 4, 5, 6, 7, 8])
+
+        # Leave the first job looking like the run crashed during it, and a
+        # record cut short after it.
+        in_doubt = job_key(0, *self.jobs[0])
+        with open(self.journal_path, 'ab') as journal_file:
+            journal_file.write(
+                '{"key":"%s","state":"started"}\n{"key":' % in_doubt)
+        self.carrier.refuse = set()
+        self.carrier.shipped = []
+        with ShipmentJournal(self.journal_path) as journal:
+            self.assertEqual(journal.get(in_doubt)['state'], 'started')
+            resumed = self.ship(journal=journal, sink=sink)
+        self.assertEqual(self.carrier.shipped, [2])
+        self.assertFalse(resumed[1]['resumed'])
+        self.assertIsInstance(resumed[0]['error'], ShipmentInDoubtError)
+        entry = resumed[4]
+        self.assertTrue(entry['resumed'])
+        shipped = entry['shipment']
+        self.assertEqual(shipped['shipment'].tracking_number, 'T5')
+        self.assertEqual(shipped['price'], Money(5, 'USD'))
+        self.assertEqual(shipped['packages'].keys(), self.jobs[4][1].packages)
+        with open(shipped['packages'].values()[0]['label']) as label_file:
+            self.assertEqual(label_file.read(), 'label 5')
+
+    def test_journal_needs_sink(self):
+        with ShipmentJournal(self.journal_path) as journal:
+            with self.assertRaises(ValueError):
+                self.ship(journal=journal)
+
+    def test_partial_shipment_in_doubt(self):
+        # Part of the shipment was bought, so it mustn't be bought again.
+        sink = DirectorySink(os.path.join(self.directory, 'labels'))
+        self.carrier.partial = {2}
+        with ShipmentJournal(self.journal_path) as journal:
+            results = self.ship(journal=journal, sink=sink)
+            self.assertIsInstance(results[1]['error'], CarrierError)
+            self.assertEqual(
+                journal.get(job_key(1, *self.jobs[1]))['state'], 'started')
+        self.carrier.partial = set()
+        with ShipmentJournal(self.journal_path) as journal:
+            resumed = self.ship(journal=journal, sink=sink)
+        self.assertIsInstance(resumed[1]['error'], ShipmentInDoubtError)
@@ -0,0 +1,129 @@
+import socket
+from unittest import TestCase
+
+from mock import Mock, patch
+from requests.exceptions import HTTPError
+from suds import TypeNotFound
+
+from postal import Address, Package, Postal, Request
+from postal.breakers import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from postal.carriers.base import Carrier
+from postal.exceptions import CarrierError, CarrierUnavailableError
+
+
+class Fault(Exception):
+    document = 'Bad request.'
+
+
+class FlakyCarrier(Carrier):
+    name = 'Flaky'
+
+    def __init__(self, postal_configuration=None):
+        super(FlakyCarrier, self).__init__(postal_configuration)
+        self.calls = 0
+        self.error = None
+
+    def log_transmission(self, client):
+        pass
+
+    def get_services(self, request):
+        def call():
+            self.calls += 1
+            if self.error is not None:
+                raise self.error
+            return {}
+        call.client = None
+        return self.service_call(call)
+
+
+class TestCircuitBreaker(TestCase):
+    def test_states(self):
+        now = [1000.0]
+        breaker = CircuitBreaker('Flaky', window=4, min_calls=4,
+                                 error_rate=.5, cooldown=30)
+        with patch('postal.breakers.time.time', lambda: now[0]):
+            for succeeded in (True, True, False):
+                breaker.record(breaker.allow(), succeeded)
+            self.assertEqual(breaker.state, CLOSED)
+            breaker.record(breaker.allow(), False)
+            self.assertEqual(breaker.state, OPEN)
+            with self.assertRaises(CarrierUnavailableError) as context:
+                breaker.allow()
+            self.assertEqual(context.exception.retry_after, 30)
+
+            now[0] += 30
+            self.assertEqual(breaker.state, HALF_OPEN)
+            probe = breaker.allow()
+            self.assertFalse(breaker.available())
+            breaker.record(probe, False)
+            self.assertEqual(breaker.state, OPEN)
+
+            now[0] += 30
+            breaker.record(breaker.allow(), True)
+            self.assertEqual(breaker.state, CLOSED)
+            stats = breaker.stats()
+        self.assertEqual((stats['calls'], stats['trips']), (0, 2))
+        self.assertEqual(stats['rejected'], 1)
+
+
+class TestCarrierBreaker(TestCase):
+    def setUp(self):
+        self.postal = Postal({
+            'enabled_carriers': [FlakyCarrier],
+            'carrier_inits': {'Flaky': {'circuit_breaker': {
+                'window': 4, 'min_calls': 2, 'cooldown': 60}}},
+            'carrier_country': {}})
+        self.carrier = self.postal.carriers['Flaky']
+        self.carrier.breaker.reset()
+        address = Address(
+            street_lines=['1 Main St'], city='Houston', country='US',
+            subdivision='TX', postal_code='77092')
+        self.request = Request(address, address, [Package(1, 2, 3, 4)])
+
+    def test_refusals_dont_trip(self):
+        self.carrier.error = Fault()
+        for _ in range(4):
+            entry = self.postal.options(self.request)[self.carrier]
+            self.assertIsInstance(entry['error'], CarrierError)
+        self.assertEqual(self.carrier.calls, 4)
+        self.assertEqual(self.postal.breaker_states()['Flaky']['state'],
+                         CLOSED)
+
+    def test_open_carriers_skipped(self):
+        self.carrier.error = socket.error('Connection refused')
+        for _ in range(2):
+            self.postal.options(self.request)
+        self.assertEqual(self.postal.breaker_states()['Flaky']['state'], OPEN)
+        self.assertEqual(self.postal.request_carrier_options(self.request), {})
+
+        entry = self.postal.options(self.request)[self.carrier]
+        self.assertIsInstance(entry['error'], CarrierUnavailableError)
+        entry = self.postal.options_async(self.request).result(1)[
+            self.carrier]
+        self.assertIsInstance(entry['error'], CarrierUnavailableError)
+        (_, _, results), = self.postal.options_many([self.request])
+        self.assertIsInstance(
+            results[self.carrier]['error'], CarrierUnavailableError)
+        with self.assertRaises(CarrierUnavailableError):
+            self.carrier.get_services(self.request)
+        self.assertEqual(self.carrier.calls, 2)
+
+    def test_unreadable_replies_dont_trip(self):
+        # The carrier answered, even if its reply couldn't be read.
+        self.carrier.error = TypeNotFound('ArrayOfstring')
+        for _ in range(4):
+            self.postal.options(self.request)
+        self.assertEqual(self.postal.breaker_states()['Flaky']['state'],
+                         CLOSED)
+        self.assertEqual(self.carrier.calls, 4)
+
+    def test_server_errors_trip(self):
+        self.carrier.error = HTTPError(response=Mock(status_code=400))
+        for _ in range(2):
+            self.postal.options(self.request)
+        self.assertEqual(self.postal.breaker_states()['Flaky']['state'],
+                         CLOSED)
+        self.carrier.error = HTTPError(response=Mock(status_code=503))
+        for _ in range(2):
+            self.postal.options(self.request)
+        self.assertEqual(self.postal.breaker_states()['Flaky']['state'], OPEN)
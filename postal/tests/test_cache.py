@@ -0,0 +1,340 @@
+from datetime import date, datetime
+from decimal import Decimal
+from threading import Event, Thread
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from mock import patch
+from money import Money
+
+from postal.cache import MemoryCache, SingleFlight, SqliteCache, \
+    cache_from_configuration, dumps, loads, wsdl_cache, _FixedOffset
+from postal.carriers.fedex import FedExApi
+from postal.data import Address, Package, Request
+from postal.tests.test_postal import FastCarrier
+
+
+class TestMemoryCache(TestCase):
+    def test_get_and_set(self):
+        cache = MemoryCache()
+        self.assertIsNone(cache.get('missing'))
+        cache.set('key', {'a': 1})
+        self.assertEqual(cache.get('key'), {'a': 1})
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    @patch('postal.cache.time.time')
+    def test_ttl(self, mock_time):
+        mock_time.return_value = 1000.0
+        cache = MemoryCache()
+        cache.set('key', 'value', ttl=60)
+        mock_time.return_value = 1059.0
+        self.assertEqual(cache.get('key'), 'value')
+        mock_time.return_value = 1060.0
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_lru_eviction(self):
+        cache = MemoryCache(max_size=2, stripes=1)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_lfu_eviction(self):
+        cache = MemoryCache(max_size=2, eviction='lfu', stripes=1)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    @patch('postal.cache.time.time')
+    def test_expired_evicted_first(self, mock_time):
+        mock_time.return_value = 1000.0
+        cache = MemoryCache(max_size=2, stripes=1)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=10)
+        mock_time.return_value = 1020.0
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 0)
+
+    def test_lfu_eviction_after_deletes(self):
+        cache = MemoryCache(max_size=3, eviction='lfu', stripes=1)
+        for key in 'abc':
+            cache.set(key, key)
+        for _ in range(2):
+            cache.get('b')
+        cache.get('c')
+        cache.delete('a')
+        cache.set('d', 'd')
+        cache.get('d')
+        cache.get('d')
+        cache.set('e', 'e')
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get('b'), 'b')
+        self.assertEqual(cache.get('d'), 'd')
+
+    @patch('postal.cache.time.time')
+    def test_expiries_compacted(self, mock_time):
+        mock_time.return_value = 1000.0
+        cache = MemoryCache(max_size=10, stripes=1)
+        for _ in range(1000):
+            cache.set('a', 1, ttl=60)
+        self.assertLess(len(cache._stripes[0].expiries), 100)
+        mock_time.return_value = 1100.0
+        self.assertIsNone(cache.get('a'))
+
+    @patch('postal.cache.time.time')
+    def test_unbounded_expiries_dropped(self, mock_time):
+        # With no max_size nothing is evicted, so expired entries have to be
+        # dropped as new ones come in.
+        mock_time.return_value = 1000.0
+        cache = MemoryCache(max_size=None, stripes=1)
+        for index in range(2000):
+            cache.set(index, index, ttl=60)
+        mock_time.return_value = 1100.0
+        cache.set('new', 1, ttl=60)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats()['expirations'], 2000)
+
+    def test_size_must_be_positive(self):
+        for max_size in (0, -1):
+            with self.assertRaises(ValueError):
+                MemoryCache(max_size=max_size)
+        cache = MemoryCache(max_size=None, eviction='lfu')
+        for index in range(100):
+            cache.set(index, index)
+        self.assertEqual(len(cache), 100)
+
+    def test_bounded_across_stripes(self):
+        cache = MemoryCache(max_size=50, stripes=8)
+        for index in range(500):
+            cache.set(index, index)
+        self.assertLessEqual(len(cache), 50)
+
+    def test_shared_from_configuration(self):
+        settings = {'max_size': 123, 'eviction': 'lfu', 'ttl': {'DHL': 5}}
+        cache = cache_from_configuration(settings)
+        self.assertIs(cache, cache_from_configuration(dict(settings)))
+        self.assertEqual(cache.max_size, 123)
+        self.assertEqual(cache.eviction, 'lfu')
+
+
+class TestSerializer(TestCase):
+    def test_round_trip(self):
+        value = [{
+            'price': Money(Decimal('12.50'), 'USD'),
+            'delivery_datetime': datetime(2017, 3, 4, 17, 30, 5, 120),
+            'aware': datetime(2017, 3, 4, 17, 30, tzinfo=_FixedOffset(-18000)),
+            'ship_date': date(2017, 3, 1),
+            'weight': Decimal('1.5000'),
+            'codes': ('01', '02'),
+            'name': u'Next Day Air',
+            'count': 3,
+        }]
+        result = loads(dumps(value))
+        self.assertEqual(result, value)
+        self.assertEqual(str(result[0]['price'].amount), '12.50')
+        self.assertEqual(result[0]['price'].currency.code, 'USD')
+        self.assertEqual(
+            result[0]['aware'].utcoffset(), value[0]['aware'].utcoffset())
+
+    def test_unsupported(self):
+        self.assertRaises(TypeError, dumps, object())
+
+
+class TestSqliteCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'rates.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared_between_instances(self):
+        SqliteCache(self.path).set('key', {'price': Money('4.20', 'USD')})
+        other = SqliteCache(self.path)
+        self.assertEqual(other.get('key'), {'price': Money('4.20', 'USD')})
+        self.assertEqual(other.stats()['hits'], 1)
+
+    @patch('postal.cache.time.time')
+    def test_ttl(self, mock_time):
+        mock_time.return_value = 1000.0
+        cache = SqliteCache(self.path)
+        cache.set('key', 'value', ttl=60)
+        mock_time.return_value = 1060.0
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(cache), 0)
+
+    def test_trim(self):
+        cache = SqliteCache(self.path, max_size=5, trim_interval=1)
+        for index in range(20):
+            cache.set(index, index)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.get(19), 19)
+        self.assertEqual(cache.stats()['evictions'], 15)
+
+    def test_from_configuration(self):
+        cache = cache_from_configuration(
+            {'backend': 'sqlite', 'path': self.path})
+        self.assertIsInstance(cache, SqliteCache)
+        self.assertIs(cache, cache_from_configuration(
+            {'backend': 'sqlite', 'path': self.path}))
+
+
+class TestSingleFlight(TestCase):
+    def coalesce(self, flights, fn, callers=4):
+        results = []
+
+        def call():
+            try:
+                results.append(flights.do('key', fn))
+            except Exception as err:
+                results.append(err)
+        threads = [Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_shared_result(self):
+        flights = SingleFlight()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(.1)
+            return {'rates': 1}
+        results = self.coalesce(flights, fetch)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'rates': 1}] * 4)
+        self.assertEqual(
+            flights.stats(), {'calls': 1, 'shared': 3, 'in_flight': 0})
+
+    def test_shared_error(self):
+        flights = SingleFlight()
+
+        def fetch():
+            time.sleep(.1)
+            raise ValueError('upstream')
+        results = self.coalesce(flights, fetch)
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+        # Errors aren't remembered once the call has landed.
+        self.assertEqual(flights.do('key', lambda: 'retried'), 'retried')
+
+    def test_rates_kept_on_request(self):
+        carrier = FastCarrier({'carrier_inits': {}})
+        carrier.cache = MemoryCache()
+        address = Address(
+            street_lines=['1 Main St'], city='Houston', country='US',
+            subdivision='TX', postal_code='77092')
+        request = Request(address, address, [Package(1, 2, 3, 4)])
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return {'01': {'price': Money('1.00', 'USD')}}
+        table = carrier.cached_call(request, 'fast', fetch)
+        with patch.object(carrier.cache, 'get') as mock_get:
+            self.assertIs(carrier.cached_call(request, 'fast', fetch), table)
+        self.assertFalse(mock_get.called)
+        self.assertEqual(
+            carrier.cached_call(request.shallow_copy(), 'fast', fetch), table)
+        self.assertEqual(len(calls), 1)
+
+    def test_changed_request_rated_again(self):
+        carrier = FastCarrier({'carrier_inits': {}})
+        carrier.cache = MemoryCache()
+        address = Address(
+            street_lines=['1 Main St'], city='Houston', country='US',
+            subdivision='TX', postal_code='77092')
+        request = Request(address, address, [Package(1, 2, 3, 4)])
+        calls = []
+
+        def fetch():
+            calls.append(len(request.packages))
+            return {'01': {'packages': len(request.packages)}}
+        carrier.cached_call(request, 'fast', fetch)
+        request.packages.append(Package(5, 6, 7, 8))
+        self.assertEqual(carrier.cached_call(request, 'fast', fetch),
+                         {'01': {'packages': 2}})
+        request.packages[1].weight = 9
+        carrier.cached_call(request, 'fast', fetch)
+        self.assertEqual(calls, [1, 2, 2])
+
+    def test_cached_call(self):
+        carrier = FastCarrier({'carrier_inits': {}})
+        carrier.cache = MemoryCache()
+        carrier.flights = SingleFlight()
+        request = object()
+        carrier.cache_key = lambda request, provider: 'fast:key'
+        started = Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            time.sleep(.1)
+            return {'rates': 1}
+        leader = Thread(
+            target=carrier.cached_call, args=(request, 'fast', fetch))
+        leader.start()
+        started.wait()
+        self.assertEqual(
+            carrier.cached_call(request, 'fast', fetch), {'rates': 1})
+        leader.join()
+        self.assertEqual(
+            carrier.cached_call(request, 'fast', fetch), {'rates': 1})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(carrier.flights.stats()['shared'], 1)
+
+
+class TestWsdlCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_warm(self):
+        configuration = {'wsdl_cache': self.directory}
+        FedExApi.warm_wsdl_cache(configuration)
+        cache = wsdl_cache(FedExApi.wsdl_directory(), self.directory)
+        entries = [name for name in os.listdir(cache.location)
+                   if name.endswith('.px')]
+        self.assertEqual(len(entries), len(FedExApi.wsdl_files))
+        options = FedExApi.wsdl_cache_options(configuration)
+        self.assertIs(options['cache'], cache)
+        self.assertEqual(options['cachingpolicy'], 1)
+
+    def test_entries_written_whole(self):
+        cache = wsdl_cache(FedExApi.wsdl_directory(), self.directory)
+        cache.put('entry', {'definitions': range(3)})
+        self.assertEqual(cache.get('entry'), {'definitions': range(3)})
+        with patch('postal.cache.pickle.dumps', return_value=None):
+            cache.put('broken', {})
+        self.assertIsNone(cache.get('broken'))
+        self.assertEqual(
+            sorted(name.split('.')[-1] for name in os.listdir(cache.location)
+                   if name != 'version'), ['px'])
+
+    def test_disabled(self):
+        options = FedExApi.wsdl_cache_options({'wsdl_cache': False})
+        self.assertNotIn('cachingpolicy', options)
@@ -1,6 +1,8 @@
+from decimal import Decimal
 from unittest import TestCase
 
 from postal import Address
+from postal.data import Package, Request, digest
 
 
 class TestData(TestCase):
@@ -30,3 +32,65 @@ class TestData(TestCase):
                 'residential': False
             }
         )
+
+    def make_request(self, packages, extra_params=None):
+        address = Address(
+            street_lines=['1 Main St'], city='Houston', country='US',
+            subdivision='TX', postal_code='77092')
+        return Request(address, address.copy(), packages,
+                       extra_params=extra_params)
+
+    def test_fingerprint_stable(self):
+        first = self.make_request([Package(4, 5, 6, 2)])
+        second = self.make_request([Package(4, 5, 6, Decimal('2.0'))])
+        self.assertEqual(first.fingerprint(), second.fingerprint())
+        self.assertEqual(first.fingerprint(), digest(first.fingerprint_fields()))
+
+    def test_fingerprint_collisions(self):
+        self.assertNotEqual(
+            self.make_request([Package(4, 5, 6, 2)]).fingerprint(),
+            self.make_request([Package(6, 5, 4, 2)]).fingerprint())
+        self.assertNotEqual(
+            self.make_request([Package(4, 5, 6, 2)],
+                              {'a': 'b:c'}).fingerprint(),
+            self.make_request([Package(4, 5, 6, 2)],
+                              {'a:b': 'c'}).fingerprint())
+
+    def test_fingerprint_signature(self):
+        request = self.make_request([Package(4, 5, 6, 2)])
+        other = self.make_request([Package(1, 2, 3, 4)])
+
+        def signature(request):
+            return lambda: request.destination.postal_code
+
+        self.assertEqual(request.fingerprint('zip', signature(request)),
+                         other.fingerprint('zip', signature(other)))
+        self.assertNotEqual(request.fingerprint('zip', signature(request)),
+                            request.fingerprint())
+
+    def test_fingerprint_memoized(self):
+        request = self.make_request([Package(4, 5, 6, 2)])
+        calls = []
+
+        def signature():
+            calls.append(request.packages[0].weight)
+            return request.packages
+        first = request.fingerprint('packages', signature)
+        self.assertEqual(request.fingerprint('packages', signature), first)
+        self.assertEqual(calls, [2])
+        request.packages[0].weight = True
+        self.assertNotEqual(request.fingerprint('packages', signature), first)
+        request.packages[0].weight = 1
+        request.fingerprint('packages', signature)
+        request.destination.street_lines.append('Suite 2')
+        request.fingerprint('packages', signature)
+        self.assertEqual(calls, [2, True, 1, 1])
+
+    def test_fingerprint_follows_changes(self):
+        request = self.make_request([Package(4, 5, 6, 2)])
+        before = request.fingerprint()
+        request.packages.append(Package(1, 2, 3, 4))
+        self.assertNotEqual(request.fingerprint(), before)
+        changed = request.fingerprint()
+        request.extra_params['retail_rate'] = True
+        self.assertNotEqual(request.fingerprint(), changed)
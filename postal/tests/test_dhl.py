@@ -7,6 +7,7 @@ from mock import Mock, patch
 from base import _AbstractTestCarrier
 from postal.tests.fixtures.dhl import tracking_response, tracking_response_not_found
 from postal.carriers.dhl import DHLApi
+from postal.sessions import session_from_configuration
 
 
 @ddt
@@ -25,9 +26,10 @@ class TestDHL(_AbstractTestCarrier, unittest.TestCase):
         else:
             self.assertIn('<PaymentAccountNumber>{}</PaymentAccountNumber>'.format(self.carrier.account_number), req)
 
-    @patch('postal.carriers.dhl.post')
-    def test_tracking(self, mock_post):
+    def test_tracking(self):
         response = Mock()
+        mock_post = patch.object(self.carrier.session, 'post').start()
+        self.addCleanup(patch.stopall)
         mock_post.return_value = response
         response.text = tracking_response
         result = self.carrier.track('9679741411')
@@ -39,9 +41,10 @@ class TestDHL(_AbstractTestCarrier, unittest.TestCase):
         self.assertTrue(result['finalized'])
         self.assertEqual(result['event_time'], datetime(2010, 7, 22, 12, 25))
 
-    @patch('postal.carriers.dhl.post')
-    def test_tracking_not_found(self, mock_post):
+    def test_tracking_not_found(self):
         response = Mock()
+        mock_post = patch.object(self.carrier.session, 'post').start()
+        self.addCleanup(patch.stopall)
         mock_post.return_value = response
         response.text = tracking_response_not_found
         result = self.carrier.track('1670466965')
@@ -50,3 +53,16 @@ class TestDHL(_AbstractTestCarrier, unittest.TestCase):
         self.assertFalse(result['location'])
         self.assertFalse(result['delivered'])
         self.assertFalse(result['finalized'])
+
+    def test_pooled_session(self):
+        configuration = dict(
+            self.carrier.postal_configuration, http_pool={
+                'pool_size': 3, 'max_retries': 4, 'backoff_factor': 0.5})
+        carrier = DHLApi.from_configuration(configuration)
+        self.assertIs(carrier.session, session_from_configuration(
+            configuration['http_pool']))
+        adapter = carrier.session.get_adapter(carrier.url)
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter.max_retries.connect, 4)
+        self.assertEqual(adapter.max_retries.read, 0)
+        self.assertEqual(adapter.max_retries.backoff_factor, 0.5)
@@ -0,0 +1,122 @@
+from threading import Event, Lock
+import time
+import traceback
+from unittest import TestCase
+
+from concurrent.futures import FIRST_COMPLETED
+
+from postal.executor import SharedExecutor, executor_from_configuration
+
+
+def fail():
+    raise ValueError('failed')
+
+
+class TestSharedExecutor(TestCase):
+    def setUp(self):
+        self.executor = SharedExecutor(max_workers=4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_map(self):
+        self.assertEqual(
+            self.executor.map('key', lambda x, y: x * y, [1, 2, 3], [4, 5, 6]),
+            [4, 10, 18])
+        stats = self.executor.stats()
+        self.assertEqual(stats['submitted'], 3)
+        self.assertEqual(stats['completed'], 3)
+        self.assertEqual(stats['queued'], 0)
+
+    def test_map_limit(self):
+        lock = Lock()
+        running = [0, 0]
+
+        def call(value):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(.01)
+            with lock:
+                running[0] -= 1
+            return value
+
+        self.assertEqual(
+            self.executor.map('key', call, range(8), limit=2), range(8))
+        self.assertLessEqual(running[1], 2)
+
+    def test_traceback_kept(self):
+        future = self.executor.submit(fail)
+        self.executor.gather([future])
+        try:
+            future.result()
+        except ValueError:
+            frames = traceback.extract_tb(__import__('sys').exc_info()[2])
+            self.assertEqual(frames[-1][2], 'fail')
+        else:
+            self.fail('No error raised.')
+
+    def test_carrier_limit(self):
+        executor = SharedExecutor(max_workers=8, carrier_limits={'UPS': 2})
+        lock = Lock()
+        running = [0, 0]
+
+        def call():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(.02)
+            with lock:
+                running[0] -= 1
+
+        submitted = [executor.submit_for('UPS', call) for _ in range(8)]
+        executor.gather(submitted)
+        executor.shutdown()
+        self.assertLessEqual(running[1], 2)
+
+    def test_gather_first_completed(self):
+        release = Event()
+        slow = self.executor.submit(release.wait)
+        fast = self.executor.submit(lambda: 'fast')
+        self.executor.gather(
+            [slow, fast], return_when=FIRST_COMPLETED)
+        self.assertTrue(fast.done())
+        self.assertFalse(slow.done())
+        release.set()
+
+    def test_nested_does_not_deadlock(self):
+        executor = SharedExecutor(max_workers=1, carrier_limits={'UPS': 1})
+
+        def parent():
+            return sum(executor.map('UPS', lambda x: x * 2, range(5)))
+
+        futures = [executor.submit_for('UPS', parent) for _ in range(3)]
+        self.assertEqual(
+            [future.result() for future in executor.gather(futures)],
+            [20, 20, 20])
+        self.assertGreater(executor.stats()['ran_inline'], 0)
+        executor.shutdown()
+
+    def test_shutdown(self):
+        started = Event()
+        release = Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        executor = SharedExecutor(max_workers=1)
+        executor.submit(block)
+        started.wait()
+        pending = executor.submit(block)
+        executor.shutdown(wait=False, cancel_pending=True)
+        self.assertTrue(pending.cancelled())
+        self.assertRaises(RuntimeError, executor.submit, block)
+        release.set()
+
+    def test_shared_from_configuration(self):
+        settings = {'max_workers': 3, 'carrier_limits': {'DHL': 1}}
+        executor = executor_from_configuration(settings)
+        self.assertIs(executor, executor_from_configuration(dict(settings)))
+        executor.shutdown()
+        self.assertIsNot(executor, executor_from_configuration(settings))
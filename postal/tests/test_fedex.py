@@ -1,14 +1,19 @@
+import traceback
 import unittest
+from base64 import b64encode
 import httplib
 from datetime import datetime
 from ddt import data, ddt, unpack
 from mock import Mock, patch
 from base import _AbstractTestCarrier, test_from, test_to
 from postal.carriers.fedex import FedExApi
+from postal.cache import MemoryCache
 from postal.carriers.base import Carrier
 from postal.data import Request, Address, Package, Declaration, Shipment
+from postal.exceptions import CarrierError, PartialShipmentError
+from postal.sessions import SessionTransport, session_from_configuration
 from money import Money
-from suds.transport.http import HttpTransport, Reply
+from suds.transport import Reply
 from postal.tests.fixtures.fedex import tracking_response, tracking_response_StateOrProvinceCode, \
     tracking_response_unique_identifier, tracking_response_duplicate_way_bill
 
@@ -171,7 +176,7 @@ class TestFedEx(_AbstractTestCarrier, unittest.TestCase):
         self.assertEqual(price_dict['base_price'], Money('15.00', 'USD'))
         self.assertEqual(price_dict['total'], Money('15.00', 'USD'))
 
-    @patch.object(HttpTransport, 'send')
+    @patch.object(SessionTransport, 'send')
     def test_tracking(self, mock_send):
         mock_send.return_value = Reply(httplib.OK, {}, tracking_response)
         result = self.carrier.track('785568835233')
@@ -184,7 +189,7 @@ class TestFedEx(_AbstractTestCarrier, unittest.TestCase):
         self.assertEqual(result['status_code'], u'DL')
         self.assertEqual(result['event_time'], datetime(2017, 2, 14, 0, 0))
 
-    @patch.object(HttpTransport, 'send')
+    @patch.object(SessionTransport, 'send')
     def test_tracking_StateOrProvinceCode(self, mock_send):
         mock_send.return_value = Reply(httplib.OK, {}, tracking_response_StateOrProvinceCode)
         result = self.carrier.track('785968343776')
@@ -194,9 +199,149 @@ class TestFedEx(_AbstractTestCarrier, unittest.TestCase):
         self.assertEqual(result['description'], u'Delivered')
         self.assertEqual(result['finalized'], True)
 
-    @patch.object(HttpTransport, 'send')
+    @patch.object(SessionTransport, 'send')
     def test_tracking_duplicate_waybill_returns_info(self, mock_send):
         mock_send.side_effect = (Reply(httplib.OK, {}, tracking_response_duplicate_way_bill),
                                  Reply(httplib.OK, {}, tracking_response_unique_identifier))
         result = self.carrier.track('783796503059')
         self.assertIn("event_time", result.keys())
+
+    @patch.object(SessionTransport, 'send')
+    def test_track_many(self, mock_send):
+        # One reply answering both numbers, in the order they were asked.
+        second = tracking_response_StateOrProvinceCode[
+            tracking_response_StateOrProvinceCode.index(
+                '<CompletedTrackDetails>'):
+            tracking_response_StateOrProvinceCode.index(
+                '</CompletedTrackDetails>')]
+        end = tracking_response.index('</CompletedTrackDetails>')
+        end += len('</CompletedTrackDetails>')
+        response = (tracking_response[:end] + second +
+                    '</CompletedTrackDetails>' + tracking_response[end:])
+        mock_send.return_value = Reply(httplib.OK, {}, response)
+        results = self.carrier.track_many(['785568835233', '785968343776'])
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(
+            results['785568835233']['tracking']['location'].city, u'LAGOS')
+        self.assertEqual(
+            results['785968343776']['tracking']['location'].city, u'ACCRA')
+        self.assertIsNone(results['785968343776']['error'])
+
+    @patch.object(SessionTransport, 'send')
+    def test_track_events(self, mock_send):
+        mock_send.return_value = Reply(httplib.OK, {}, tracking_response)
+        events = self.carrier.track_events('785568835233')
+        self.assertIn('INCLUDE_DETAILED_SCANS',
+                      mock_send.call_args[0][0].message)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['status_code'], u'DL')
+        self.assertTrue(events[0]['finalized'])
+        self.assertEqual(events[0]['location'].city, u'LAGOS')
+        self.assertEqual(events[0]['location'].subdivision, u'LA')
+
+    def test_pooled_transport(self):
+        transport = self.carrier.tracking_client.options.transport
+        self.assertIsInstance(transport, SessionTransport)
+        session = session_from_configuration(
+            self.carrier.postal_configuration.get('http_pool'))
+        self.assertIs(transport.session, session)
+        response = Mock(
+            status_code=httplib.OK, headers={'Content-Type': 'text/xml'},
+            content=tracking_response)
+        with patch.object(session, 'request', return_value=response) \
+                as mock_request:
+            result = self.carrier.track('785568835233')
+        self.assertEqual(result['status_code'], u'DL')
+        method, url = mock_request.call_args[0]
+        self.assertEqual(method, 'POST')
+        self.assertEqual(
+            mock_request.call_args[1]['timeout'], transport.options.timeout)
+
+    def test_quote_reads_rate_table(self):
+        self.carrier.cache = MemoryCache()
+        table = {'FEDEX_GROUND': {
+            'price': Money('9.50', 'USD'),
+            'delivery_datetime': datetime(2017, 3, 6, 17, 0)}}
+        service = self.carrier.get_service('FEDEX_GROUND')
+        with patch.object(self.carrier, 'service_call') as mock_call, \
+                patch.object(self.carrier, 'log_transmission'), \
+                patch.object(FedExApi, 'rate_response_dict',
+                             return_value=table):
+            self.assertEqual(
+                service.price(self.domestic_request), Money('9.50', 'USD'))
+            self.assertEqual(
+                service.delivery_datetime(self.domestic_request),
+                datetime(2017, 3, 6, 17, 0))
+            self.assertEqual(
+                self.carrier.get_services(self.domestic_request)[service][
+                    'price'], Money('9.50', 'USD'))
+        self.assertEqual(mock_call.call_count, 1)
+
+    def test_per_package_granularity(self):
+        self.carrier.cache = MemoryCache()
+        self.carrier.rate_granularity = 'package'
+        fetched = []
+
+        def fetch_rates(request):
+            weight = request.packages[0].weight
+            fetched.append(weight)
+            return {'FEDEX_GROUND': {
+                'price': {'total': Money(weight, 'USD'),
+                          'base_price': Money(weight, 'USD')},
+                'delivery_datetime': datetime(2017, 3, weight, 17, 0)}}
+        first = Request(self.test_from, self.test_to, [
+            Package(2, 3, 4, 1), Package(2, 3, 4, 2)])
+        second = Request(self.test_from, self.test_to, [
+            Package(2, 3, 4, 2), Package(2, 3, 4, 3)])
+        service = self.carrier.get_service('FEDEX_GROUND')
+        with patch.object(self.carrier, 'fetch_rates',
+                          side_effect=fetch_rates):
+            self.assertEqual(service.price(first)['total'], Money(3, 'USD'))
+            self.assertEqual(service.price(second)['total'], Money(5, 'USD'))
+            self.assertEqual(
+                service.delivery_datetime(second), datetime(2017, 3, 3, 17, 0))
+        self.assertEqual(sorted(fetched), [1, 2, 3])
+
+    def test_partial_multipiece_shipment(self):
+        # A child that fails doesn't hide the labels bought alongside it.
+        def reply(tracking_number):
+            detail = Mock()
+            detail.TrackingIds = [Mock(TrackingNumber=tracking_number)]
+            detail.Label.Parts = [Mock(Image=b64encode(tracking_number))]
+            result = Mock()
+            result.CompletedShipmentDetail.MasterTrackingId = Mock(
+                TrackingNumber='1000')
+            result.CompletedShipmentDetail.CompletedPackageDetails = [detail]
+            return result
+
+        def ship(func, *args):
+            sequence_num = args[-1].sequence_num
+            if sequence_num == 3:
+                raise CarrierError('No label.')
+            return reply(str(1000 + sequence_num))
+
+        def requested_shipment(service, request, package, sequence_num=1,
+                               tracking_number=None):
+            return Mock(sequence_num=sequence_num)
+
+        packages = [Package(2, 3, 4, weight) for weight in range(1, 5)]
+        request = Request(self.test_from, self.test_to, packages)
+        with patch.object(self.carrier, 'service_call', side_effect=ship), \
+                patch.object(self.carrier, 'requested_shipment',
+                             side_effect=requested_shipment), \
+                patch.object(self.carrier, 'upload_commercial_invoice',
+                             return_value=None):
+            with self.assertRaises(PartialShipmentError) as context:
+                self.carrier.ship(
+                    self.carrier.get_service('FEDEX_GROUND'), request)
+        # Still a CarrierError, pointing at the child that failed.
+        self.assertIsInstance(context.exception, CarrierError)
+        self.assertEqual(
+            traceback.extract_tb(context.exception.traceback)[-1][2], 'ship')
+        shipment = context.exception.shipment
+        self.assertEqual(shipment['shipment'].tracking_number, '1000')
+        self.assertEqual(
+            [details['tracking_number']
+             for details in shipment['packages'].values()],
+            ['1000', '1002', None, '1004'])
+        self.assertIn('No label.', shipment['alerts'][-1])
@@ -0,0 +1,118 @@
+from threading import Lock, Thread
+import time
+from unittest import TestCase
+
+from postal import Postal
+from postal.carriers.base import Carrier
+from postal.exceptions import RateLimitedError
+from postal.limits import Limiter, TokenBucket, limiter_from_configuration
+
+
+class LimitedCarrier(Carrier):
+    name = 'Limited'
+
+    def __init__(self, postal_configuration=None):
+        super(LimitedCarrier, self).__init__(postal_configuration)
+        self.calls = 0
+
+    def log_transmission(self, client):
+        pass
+
+    def track(self, identifier):
+        def call():
+            self.calls += 1
+            return {'finalized': True}
+        call.client = None
+        return self.service_call(call)
+
+
+class TestTokenBucket(TestCase):
+    def test_reserve(self):
+        bucket = TokenBucket(2, burst=2)
+        now = bucket._updated
+        self.assertEqual(bucket.reserve(now=now), 0)
+        self.assertEqual(bucket.reserve(now=now), 0)
+        self.assertAlmostEqual(bucket.reserve(now=now), .5)
+        self.assertAlmostEqual(bucket.reserve(now=now), 1)
+        with self.assertRaises(RateLimitedError) as context:
+            bucket.reserve(max_wait=1, now=now)
+        self.assertAlmostEqual(context.exception.retry_after, 1.5)
+        # Refused calls take nothing.
+        self.assertAlmostEqual(bucket.reserve(now=now + 1.5), 0)
+
+
+class TestLimiter(TestCase):
+    def test_max_in_flight(self):
+        limiter = Limiter('Limited', max_in_flight=2)
+        lock = Lock()
+        running = [0, 0]
+
+        def call():
+            with limiter.limit():
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(.02)
+                with lock:
+                    running[0] -= 1
+
+        threads = [Thread(target=call) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(running[1], 2)
+        stats = limiter.stats()
+        self.assertEqual(stats['calls'], 6)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertGreater(stats['delayed'], 0)
+        self.assertGreater(stats['longest_wait'], .01)
+
+    def test_fail_fast(self):
+        limiter = Limiter('Limited', max_in_flight=1)
+        limiter.acquire()
+        with self.assertRaises(RateLimitedError):
+            limiter.acquire(max_wait=0)
+        limiter.release()
+        limiter.acquire(max_wait=0)
+        self.assertEqual(limiter.stats()['rejected'], 1)
+
+    def test_shared(self):
+        settings = {'rate': 5, 'max_wait': 0}
+        limiter = limiter_from_configuration('Shared', settings)
+        self.assertIs(limiter, limiter_from_configuration(
+            'Shared', {'rate': 5, 'max_wait': 1}))
+        self.assertIsNot(limiter, limiter_from_configuration(
+            'Other', settings))
+        self.assertIsNone(limiter_from_configuration('Shared', None))
+
+
+class TestCarrierRateLimit(TestCase):
+    def postal(self, rate_limit):
+        return Postal({
+            'enabled_carriers': [LimitedCarrier],
+            'carrier_inits': {'Limited': {'rate_limit': rate_limit}},
+            'carrier_country': {},
+            'tracking_cache': {'backend': 'memory', 'max_size': 7}})
+
+    def test_service_call_limited(self):
+        postal = self.postal({'rate': .01, 'burst': 2, 'max_wait': 0})
+        carrier = postal.carriers['Limited']
+        postal.track('Limited', '1')
+        postal.track('Limited', '2')
+        for _ in range(2):
+            with self.assertRaises(RateLimitedError):
+                postal.track('Limited', '3')
+        # Refusals aren't cached as if the number were unknown.
+        self.assertIsNone(postal.tracking_cache.lookup('Limited', '3'))
+        self.assertEqual(carrier.calls, 2)
+        stats = postal.limiter_stats()['Limited']
+        self.assertEqual((stats['calls'], stats['rejected']), (2, 2))
+        with self.assertRaises(RateLimitedError):
+            with carrier.throttle(max_wait=.01):
+                pass
+
+    def test_unlimited(self):
+        postal = self.postal(None)
+        postal.track('Limited', '1')
+        self.assertEqual(postal.limiter_stats(), {})
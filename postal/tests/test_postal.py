@@ -0,0 +1,212 @@
+import time
+from unittest import TestCase
+
+from postal import Address, Package, Postal, Request
+from postal.carriers.base import Carrier
+from postal.exceptions import CarrierError, CarrierTimeoutError, \
+    NotSupportedError, PostalError
+
+
+class FakeCarrier(Carrier):
+    delay = 0
+
+    def __init__(self, postal_configuration=None):
+        super(FakeCarrier, self).__init__(postal_configuration)
+        self.calls = []
+
+    def get_services(self, request):
+        self.calls.append(request)
+        time.sleep(self.delay)
+        return {'service': self.name}
+
+
+class FastCarrier(FakeCarrier):
+    name = 'Fast'
+
+
+class SlowCarrier(FakeCarrier):
+    name = 'Slow'
+    delay = .5
+
+
+def make_postal(carrier_country=None, **carrier_inits):
+    inits = {'Fast': {}, 'Slow': {}}
+    inits.update(carrier_inits)
+    return Postal({
+        'enabled_carriers': [FastCarrier, SlowCarrier],
+        'carrier_inits': inits,
+        'carrier_country': carrier_country or {}})
+
+
+class TestPostal(TestCase):
+    def setUp(self):
+        address = Address(
+            street_lines=['1 Main St'], city='Houston', country='US',
+            subdivision='TX', postal_code='77092')
+        self.address = address
+        self.request = Request(address, address, [Package(1, 2, 3, 4)])
+
+    def results(self, options):
+        return {carrier.name: result for carrier, result in options.items()}
+
+    def test_options(self):
+        results = self.results(make_postal().options(self.request))
+        self.assertEqual(results['Slow']['services'], {'service': 'Slow'})
+        self.assertIsNone(results['Fast']['error'])
+
+    def test_deadline(self):
+        start = time.time()
+        results = self.results(
+            make_postal().options(self.request, deadline=.1))
+        self.assertLess(time.time() - start, .4)
+        self.assertEqual(results['Fast']['services'], {'service': 'Fast'})
+        self.assertIsNone(results['Slow']['services'])
+        self.assertIsInstance(results['Slow']['error'], CarrierTimeoutError)
+
+    def test_soft_timeout(self):
+        postal = make_postal(Slow={'soft_timeout': .1})
+        self.assertEqual(postal.carriers['Slow'].soft_timeout, .1)
+        results = self.results(postal.options(self.request, deadline=5))
+        self.assertIsInstance(results['Slow']['error'], CarrierTimeoutError)
+        self.assertIsNone(results['Fast']['error'])
+
+    def test_options_iter(self):
+        results = list(make_postal().options_iter(self.request, deadline=5))
+        self.assertEqual(
+            [carrier.name for carrier, result in results], ['Fast', 'Slow'])
+        self.assertEqual(results[1][1]['services'], {'service': 'Slow'})
+
+    def test_options_async(self):
+        future = make_postal().options_async(self.request, deadline=.1)
+        results = self.results(future.result(timeout=1))
+        self.assertEqual(results['Fast']['services'], {'service': 'Fast'})
+        self.assertIsInstance(results['Slow']['error'], CarrierTimeoutError)
+
+    def test_options_async_cancelled(self):
+        postal = make_postal()
+        postal.executor_settings = {'max_workers': 1}
+        postal.carriers['Slow'].delay = .1
+        future = postal.options_async(self.request)
+        # At least one carrier's call is still queued, and is cancelled.
+        postal.executor.shutdown(wait=False, cancel_pending=True)
+        results = self.results(future.result(timeout=1))
+        errors = filter(None, [result['error'] for result in results.values()])
+        self.assertTrue(errors)
+        for error in errors:
+            self.assertIn('cancelled', str(error))
+
+    def test_track_async(self):
+        postal = make_postal()
+        postal.carriers['Fast'].track = lambda number: {'number': number}
+        self.assertEqual(
+            postal.track_async('Fast', '1Z').result(timeout=1),
+            {'number': '1Z'})
+
+    def test_track_many(self):
+        postal = make_postal()
+        carrier = postal.carriers['Fast']
+        carrier.track_batch_size = 2
+        batches = []
+
+        def track_batch(numbers):
+            batches.append(numbers)
+            return {number: {'number': number} for number in numbers
+                    if number != 'lost'}
+        carrier.track_batch = track_batch
+        results = postal.track_many('Fast', ['1', '2', '3', 'lost', '1'])
+        self.assertEqual(results.keys(), ['1', '2', '3', 'lost'])
+        self.assertEqual(sorted(batches), [['1', '2'], ['3', 'lost']])
+        self.assertEqual(results['3'], {'tracking': {'number': '3'},
+                                        'error': None})
+        self.assertIsInstance(results['lost']['error'], CarrierError)
+
+    def test_track_mixed(self):
+        postal = make_postal()
+        postal.carriers['Fast'].track = lambda number: {'number': number}
+
+        def track(number):
+            raise CarrierError('Unknown')
+        postal.carriers['Slow'].track = track
+        results = postal.track_mixed(
+            [('Slow', '2'), ('Fast', '1'), ('Other', '3')])
+        self.assertEqual(
+            results.keys(), [('Slow', '2'), ('Fast', '1'), ('Other', '3')])
+        self.assertEqual(results['Fast', '1']['tracking'], {'number': '1'})
+        self.assertIsInstance(results['Slow', '2']['error'], CarrierError)
+        self.assertIsInstance(results['Other', '3']['error'], PostalError)
+
+    def test_call_timeout(self):
+        carrier = FastCarrier({'carrier_inits': {}})
+        self.assertIsNone(carrier.call_timeout)
+        carrier.default_timeout = 20
+        self.assertEqual(carrier.call_timeout, 20)
+        carrier = FastCarrier({'carrier_inits': {}, 'timeout': 5})
+        carrier.default_timeout = 20
+        self.assertEqual(carrier.call_timeout, 5)
+        carrier.timeout = 8
+        self.assertEqual(carrier.call_timeout, 8)
+
+    def test_options_many(self):
+        other = Request(
+            self.address, self.address, [Package(5, 6, 7, 8)])
+        requests = [self.request, other, self.request, other, self.request]
+        postal = make_postal()
+        postal.carriers['Slow'].delay = .05
+        batch = list(postal.options_many(iter(requests), window=2))
+        self.assertEqual([index for index, _, _ in batch], range(5))
+        self.assertEqual(len(postal.carriers['Fast'].calls), 2)
+        self.assertEqual(len(postal.carriers['Slow'].calls), 2)
+        for index, request, options in batch:
+            self.assertIs(request, requests[index])
+            results = self.results(options)
+            self.assertEqual(results['Slow']['services'], {'service': 'Slow'})
+            self.assertIsNone(results['Fast']['error'])
+
+    def test_options_many_forgets_old_results(self):
+        requests = [
+            Request(self.address, self.address, [Package(1, 2, 3, weight)])
+            for weight in (1, 2, 3, 1)]
+        postal = make_postal()
+        postal.carriers['Slow'].delay = 0
+        batch = list(postal.options_many(iter(requests), window=1))
+        self.assertEqual([index for index, _, _ in batch], range(4))
+        # The first request's results were let go before its duplicate.
+        self.assertEqual(len(postal.carriers['Fast'].calls), 4)
+
+    def test_options_many_duplicate_of_flight_without_carriers(self):
+        postal = make_postal(
+            carrier_country={'Fast': ['CA']},
+            Slow={'circuit_breaker': {'window': 4}})
+        slow = postal.carriers['Slow']
+        slow.breaker.reset()
+        slow.delay = .05
+        # The breaker opens after the first request goes out, leaving its
+        # duplicate with no carrier to call.
+        answers = iter([True, False])
+        slow.available = lambda: next(answers)
+        batch = list(postal.options_many([self.request, self.request]))
+        self.assertEqual([index for index, _, _ in batch], [0, 1])
+        self.assertEqual(len(slow.calls), 1)
+        for index, request, options in batch:
+            self.assertEqual(
+                self.results(options)['Slow']['services'],
+                {'service': 'Slow'})
+
+    def test_options_many_errors_and_whitelist(self):
+        invalid = Request(
+            self.address, self.address, [Package(1, -2, 3, 4)])
+        postal = make_postal(carrier_country={'Slow': ['CA']})
+        batch = list(postal.options_many(
+            [invalid, self.request], ordered=False))
+        self.assertEqual(
+            sorted(index for index, _, _ in batch), [0, 1])
+        for index, request, options in batch:
+            results = self.results(options)
+            self.assertEqual(results.keys(), ['Fast'])
+            if index == 0:
+                self.assertIsInstance(
+                    results['Fast']['error'], NotSupportedError)
+            else:
+                self.assertEqual(
+                    results['Fast']['services'], {'service': 'Fast'})
+        self.assertEqual(postal.carriers['Slow'].calls, [])
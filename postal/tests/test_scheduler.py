@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from postal import Postal
+from postal.carriers.base import Carrier
+from postal.exceptions import SoftCarrierError
+from postal.scheduler import TrackingScheduler
+
+
+class PolledCarrier(Carrier):
+    name = 'Polled'
+
+    def __init__(self, postal_configuration=None):
+        super(PolledCarrier, self).__init__(postal_configuration)
+        self.calls = []
+        self.called_at = []
+        self.results = {}
+        self.delay = 0
+
+    def track(self, identifier):
+        self.calls.append(identifier)
+        self.called_at.append(time.time())
+        time.sleep(self.delay)
+        result = self.results.get(identifier, {'status_code': u'IT'})
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def moving(age, code=u'IT'):
+    return {'finalized': False, 'status_code': code,
+            'event_time': datetime.now() - timedelta(seconds=age)}
+
+
+class TestTrackingScheduler(TestCase):
+    def setUp(self):
+        self.postal = Postal({
+            'enabled_carriers': [PolledCarrier],
+            'carrier_inits': {'Polled': {}},
+            'carrier_country': {}})
+        self.carrier = self.postal.carriers['Polled']
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'schedule.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def scheduler(self, **kwargs):
+        options = {'min_interval': 100, 'max_interval': 10000,
+                   'age_factor': .5, 'jitter': 0}
+        options.update(kwargs)
+        return TrackingScheduler(self.postal, **options)
+
+    def test_intervals(self):
+        scheduler = self.scheduler(
+            status_intervals={'Polled': {u'OD': 30}},
+            carrier_intervals={'Other': (5, 50)})
+        self.assertEqual(scheduler.interval('Polled', moving(10)), 100)
+        self.assertAlmostEqual(
+            scheduler.interval('Polled', moving(1000)), 500, delta=1)
+        self.assertEqual(scheduler.interval('Polled', moving(10 ** 6)), 10000)
+        self.assertEqual(
+            scheduler.interval('Polled', moving(1000, u'OD')), 30)
+        self.assertEqual(scheduler.interval('Other', moving(1000)), 50)
+        self.assertEqual(scheduler.backoff('Polled', 3), 400)
+
+    def test_run_once(self):
+        scheduler = self.scheduler()
+        self.carrier.results.update({
+            '1': {'finalized': True}, '2': moving(1000),
+            '3': SoftCarrierError('Not yet')})
+        for number in '123':
+            scheduler.add('Polled', number, due=0)
+        scheduler.add('Polled', '4', due=5000)
+        seen = []
+        scheduler.on_result = lambda *args: seen.append(args[1])
+        self.assertEqual(scheduler.run_once(now=1000), 3)
+        self.assertEqual(sorted(self.carrier.calls), ['1', '2', '3'])
+        self.assertEqual(sorted(seen), ['1', '2', '3'])
+        self.assertNotIn(('Polled', '1'), scheduler)
+        self.assertAlmostEqual(scheduler.due('Polled', '2'), 1500, delta=1)
+        self.assertEqual(scheduler.due('Polled', '3'), 1100)
+        self.assertEqual(scheduler.next_due(), 1100)
+        self.assertEqual(scheduler.run_once(now=1100), 1)
+        self.assertEqual(scheduler.due('Polled', '3'), 1300)
+
+    def test_rate_limit(self):
+        scheduler = self.scheduler(rates={'Polled': 2})
+        for number in range(6):
+            scheduler.add('Polled', str(number), due=0)
+        starts = [start for start, _ in scheduler.take_due(now=10)]
+        self.assertEqual(starts, [10, 10.5])
+        self.assertEqual(scheduler.take_due(now=10), [])
+        # The rest are due again once the carrier has room.
+        self.assertEqual(scheduler.due('Polled', '2'), 11)
+        starts = [start for start, _ in scheduler.take_due(now=11.2)]
+        self.assertEqual(starts, [11.2, 11.7])
+        self.assertEqual(len(scheduler.take_due(now=13, window=0)), 1)
+
+    def test_polls_at_rate(self):
+        # Slow calls don't hold a carrier to one poll a run.
+        scheduler = self.scheduler(rates={'Polled': 20})
+        self.carrier.delay = .1
+        for number in range(10):
+            scheduler.add('Polled', str(number), due=0)
+        begun = time.time()
+        self.assertEqual(scheduler.run_once(), 10)
+        self.assertLess(time.time() - begun, 1)
+        # None of them started before its slot.
+        for slot, called_at in enumerate(sorted(self.carrier.called_at)):
+            self.assertGreater(called_at - begun, slot * .05 - .005)
+
+    def test_state_persists(self):
+        scheduler = self.scheduler(path=self.path)
+        scheduler.add('Polled', '1', due=0)
+        scheduler.add('Polled', '2', due=10 ** 10)
+        scheduler.run_once(now=1000)
+        restarted = self.scheduler(path=self.path)
+        self.assertEqual(len(restarted), 2)
+        self.assertEqual(restarted.due('Polled', '1'),
+                         scheduler.due('Polled', '1'))
+        self.assertEqual(restarted.due('Polled', '2'), 10 ** 10)
+        self.assertEqual(restarted.run_once(now=1050), 0)
+
+    def test_saves_batched(self):
+        scheduler = self.scheduler(
+            path=self.path, save_interval=3600, save_changes=3)
+        scheduler.add('Polled', '1', due=10 ** 10)
+        scheduler.run_once(now=1000)
+        scheduler.add('Polled', '2', due=10 ** 10)
+        scheduler.run_once(now=1000)
+        self.assertEqual(len(self.scheduler(path=self.path)), 1)
+        scheduler.add('Polled', '3', due=10 ** 10)
+        scheduler.add('Polled', '4', due=10 ** 10)
+        scheduler.run_once(now=1000)
+        self.assertEqual(len(self.scheduler(path=self.path)), 4)
+
+    def test_run(self):
+        scheduler = self.scheduler(path=self.path, workers=2)
+        self.carrier.results['1'] = {'finalized': True}
+        for number in '123':
+            scheduler.add('Polled', number, due=0)
+        seen = []
+
+        def on_result(carrier_name, tracking_number, result, error):
+            seen.append(tracking_number)
+            if len(seen) == 3:
+                scheduler.stop()
+        scheduler.on_result = on_result
+        scheduler.run(idle=1)
+        self.assertEqual(sorted(seen), ['1', '2', '3'])
+        self.assertEqual(len(self.scheduler(path=self.path)), 2)
@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mock import patch
+
+from postal import Address, Postal
+from postal.cache import MemoryCache, SqliteCache
+from postal.carriers.base import Carrier
+from postal.exceptions import CarrierTimeoutError, SoftCarrierError
+from postal.tracking import TrackingCache, TrackingHistory
+
+
+class TrackedCarrier(Carrier):
+    name = 'Tracked'
+
+    def __init__(self, postal_configuration=None):
+        super(TrackedCarrier, self).__init__(postal_configuration)
+        self.calls = []
+        self.results = {}
+
+    def track_events(self, identifier):
+        return self.results[identifier]
+
+    def track(self, identifier):
+        self.calls.append(identifier)
+        result = self.results[identifier]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def moving(age):
+    return {
+        'delivered': False, 'finalized': False, 'status_code': u'IT',
+        'description': u'In transit',
+        'event_time': datetime.now() - timedelta(seconds=age),
+        'location': Address(street_lines=[' '], city=u'Houston',
+                            country='US', subdivision='TX')}
+
+
+class TestTrackingCache(TestCase):
+    def setUp(self):
+        self.postal = Postal({
+            'enabled_carriers': [TrackedCarrier],
+            'carrier_inits': {'Tracked': {}},
+            'carrier_country': {},
+            'tracking_cache': {'backend': MemoryCache()}})
+        self.carrier = self.postal.carriers['Tracked']
+
+    def test_ttl(self):
+        cache = TrackingCache(MemoryCache(), min_ttl=300, max_ttl=21600,
+                              age_factor=.1)
+        self.assertIsNone(cache.ttl({'finalized': True}))
+        self.assertEqual(cache.ttl(moving(60)), 300)
+        self.assertAlmostEqual(cache.ttl(moving(36000)), 3600, delta=1)
+        self.assertEqual(cache.ttl(moving(86400 * 30)), 21600)
+        self.assertEqual(cache.ttl({'finalized': False}), 300)
+
+    def test_results_cached(self):
+        self.carrier.results['1'] = moving(3600)
+        first = self.postal.track('Tracked', '1')
+        second = self.postal.track('Tracked', '1')
+        self.assertEqual(self.carrier.calls, ['1'])
+        self.assertEqual(second['location'].city, u'Houston')
+        self.assertEqual(second['event_time'], first['event_time'])
+
+    def test_not_found_backs_off(self):
+        self.carrier.results['1'] = SoftCarrierError('Not found')
+        cache = self.postal.tracking_cache
+        now = 1000000.0
+        with patch('postal.tracking.time.time', lambda: now):
+            for _ in range(2):
+                with self.assertRaises(SoftCarrierError):
+                    self.postal.track('Tracked', '1')
+            self.assertEqual(self.carrier.calls, ['1'])
+            now += cache.negative_ttl + 1
+            with self.assertRaises(SoftCarrierError):
+                self.postal.track('Tracked', '1')
+            self.assertEqual(self.carrier.calls, ['1', '1'])
+            # The second miss in a row waits twice as long.
+            now += cache.negative_ttl + 1
+            with self.assertRaises(SoftCarrierError):
+                self.postal.track('Tracked', '1')
+            self.assertEqual(len(self.carrier.calls), 2)
+            now += cache.negative_ttl
+            self.carrier.results['1'] = {'finalized': True}
+            self.assertEqual(
+                self.postal.track('Tracked', '1'), {'finalized': True})
+        self.assertEqual(len(self.carrier.calls), 3)
+
+    def test_timeouts_not_cached(self):
+        self.carrier.results['1'] = CarrierTimeoutError('Slow')
+        for _ in range(2):
+            with self.assertRaises(CarrierTimeoutError):
+                self.postal.track('Tracked', '1')
+        self.assertEqual(self.carrier.calls, ['1', '1'])
+
+    def test_track_many_asks_for_misses(self):
+        self.carrier.results.update({
+            '1': {'finalized': True}, '2': moving(60),
+            '3': SoftCarrierError('Not found')})
+        self.postal.track('Tracked', '1')
+        results = self.postal.track_many('Tracked', ['3', '1', '2'])
+        self.assertEqual(results.keys(), ['3', '1', '2'])
+        self.assertEqual(sorted(self.carrier.calls), ['1', '2', '3'])
+        self.assertEqual(results['1']['tracking'], {'finalized': True})
+        self.assertIsInstance(results['3']['error'], SoftCarrierError)
+        self.postal.track_many('Tracked', ['1', '2', '3'])
+        self.assertEqual(len(self.carrier.calls), 3)
+
+    def test_sqlite_backend(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = TrackingCache(
+                SqliteCache(os.path.join(directory, 'tracking.db')))
+            self.carrier.results['1'] = moving(3600)
+            first = cache.track(self.carrier, '1')
+            second = cache.track(self.carrier, '1')
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(self.carrier.calls, ['1'])
+        self.assertEqual(second['event_time'], first['event_time'])
+        self.assertEqual(second['location'].country.alpha2, 'US')
+
+
+class TestTrackingHistory(TestCase):
+    def test_updates(self):
+        history = TrackingHistory(MemoryCache())
+        first, second, third = moving(300), moving(200), {'finalized': True}
+        self.assertEqual(history.updates('UPS', '1', [first]), [first])
+        self.assertEqual(history.updates('UPS', '1', [first]), [])
+        self.assertEqual(
+            history.updates('UPS', '1', [first, second, third]),
+            [second, third])
+        self.assertEqual(history.updates('UPS', '2', [first]), [first])
+        history.forget('UPS', '1')
+        self.assertEqual(len(history.updates('UPS', '1', [first, second])), 2)
+
+    def test_track_updates(self):
+        postal = Postal({
+            'enabled_carriers': [TrackedCarrier],
+            'carrier_inits': {'Tracked': {}},
+            'carrier_country': {}})
+        carrier = postal.carriers['Tracked']
+        events = [moving(300)]
+        carrier.results['1'] = events
+        self.assertEqual(postal.track_history('Tracked', '1'), events)
+        self.assertEqual(postal.track_updates('Tracked', '1'), events)
+        self.assertEqual(postal.track_updates('Tracked', '1'), [])
+        events.append({'finalized': True})
+        self.assertEqual(
+            postal.track_updates('Tracked', '1'), [{'finalized': True}])
+        # Forgetting a shipment would report its history again, so the
+        # default history never evicts.
+        self.assertIsNone(postal.tracking_history.backend.max_size)
@@ -1,15 +1,40 @@
 from unittest import SkipTest
 import unittest
+from io import BytesIO
 
 from datetime import datetime
 from ddt import data, ddt
-from mock import Mock
+from mock import Mock, patch
+from requests.exceptions import ConnectionError
+from suds.transport import TransportError
 from money.Money import Money
 
 from ..carriers.ups import UPSApi
 from base import _AbstractTestCarrier
-from ..data import Request, Address, Package, Declaration
+from ..data import Request, Address, Package, Declaration, digest
 from ..carriers.base import Carrier
+from ..exceptions import CarrierUnavailableError, RateLimitedError
+from ..sessions import SessionTransport
+
+
+def fault(code, description):
+    """
+    A SOAP fault as UPS sends it, for error code.
+    """
+    return TransportError('Internal Server Error', 500, BytesIO(
+        '<soapenv:Envelope '
+        'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+        '<soapenv:Header/><soapenv:Body><soapenv:Fault>'
+        '<faultcode>Client</faultcode>'
+        '<faultstring>An exception has been raised as a result of client '
+        'data.</faultstring><detail>'
+        '<err:Errors xmlns:err="http://www.ups.com/XMLSchema/XOLTWS/Error/v1.1">'
+        '<err:ErrorDetail><err:Severity>Hard</err:Severity>'
+        '<err:PrimaryErrorCode><err:Code>%s</err:Code>'
+        '<err:Description>%s</err:Description></err:PrimaryErrorCode>'
+        '</err:ErrorDetail></err:Errors></detail>'
+        '</soapenv:Fault></soapenv:Body></soapenv:Envelope>'
+        % (code, description)))
 
 
 @ddt
@@ -68,6 +93,97 @@ class TestUPS(_AbstractTestCarrier, unittest.TestCase):
         self.assertEqual(price_dict['fees'], Money('0.00', 'USD'))
         self.assertEqual(price_dict['base_price'], Money('2.00', 'USD'))
 
+    @staticmethod
+    def activity(day, status_type, code, description, city=None):
+        fields = ('Status', 'Date', 'Time')
+        if city is not None:
+            fields += ('ActivityLocation',)
+        activity = Mock(spec=fields)
+        if status_type is None:
+            activity.Status = Mock(spec=('Description',))
+        else:
+            activity.Status = Mock(spec=('Type', 'Code', 'Description'))
+            activity.Status.Type = status_type
+            activity.Status.Code = code
+        activity.Status.Description = description
+        activity.Date = '201703%02d' % day
+        activity.Time = '120000'
+        if city is not None:
+            activity.ActivityLocation = Mock(spec=('Address',))
+            activity.ActivityLocation.Address = Mock(
+                spec=('City', 'StateProvinceCode', 'CountryCode'),
+                City=city, StateProvinceCode='GA', CountryCode='US')
+        return activity
+
+    def test_multipackage_tracking(self):
+        # Activity is listed newest first, package by package, and scans
+        # the packages share come back once for each.
+        def picked_up():
+            return self.activity(1, 'I', 'OR', 'Origin Scan', 'ATLANTA')
+        first = Mock(Activity=[
+            self.activity(4, 'D', 'D', 'Delivered', 'ANYTOWN'), picked_up()])
+        second = Mock(Activity=[
+            self.activity(3, 'I', 'AR', 'Arrival Scan', 'MACON'),
+            picked_up()])
+        third = Mock(Activity=[
+            self.activity(2, 'I', 'DP', 'Departure Scan', 'ATLANTA'),
+            picked_up()])
+        shipment = Mock(
+            spec=('Package',), Package=[first, second, third])
+        with patch.object(self.carrier, 'track_shipment',
+                          return_value=shipment):
+            result = self.carrier.track('1Z12345E6205277936')
+            events = self.carrier.track_events('1Z12345E6205277936')
+        # The third package is the least far along, so the shipment is only
+        # that far along too.
+        self.assertFalse(result['finalized'])
+        self.assertEqual(result['description'], u'Departure Scan')
+        self.assertEqual(
+            [event['description'] for event in events],
+            [u'Origin Scan', u'Departure Scan', u'Arrival Scan',
+             u'Delivered'])
+        self.assertEqual(events[0]['location'].city, u'ATLANTA')
+
+    def test_exception_events(self):
+        # An exception status is explained by the activity without a type,
+        # the same way for track() and track_events().
+        package = Mock(Activity=[
+            self.activity(3, 'X', 'RS', 'Exception', 'MACON'),
+            self.activity(2, None, None, 'Receiver moved', 'SAVANNAH'),
+            self.activity(1, 'I', 'OR', 'Origin Scan', 'ATLANTA')])
+        shipment = Mock(spec=('Package',), Package=[package])
+        with patch.object(self.carrier, 'track_shipment',
+                          return_value=shipment):
+            result = self.carrier.track('1Z12345E6205277936')
+            events = self.carrier.track_events('1Z12345E6205277936')
+        self.assertEqual(result['description'], u'Receiver moved')
+        self.assertEqual(result['location'].city, u'SAVANNAH')
+        self.assertEqual(digest(events[-1]), digest(result))
+
+    @patch.object(SessionTransport, 'send')
+    def test_rates_limited(self, mock_send):
+        # Rating goes straight to its suds client, but still waits on the
+        # rate limit, and UPS throttling us comes back as a RateLimitedError.
+        mock_send.side_effect = fault('151044', 'Rate limit exceeded.')
+        self.carrier.rate_limit = {'rate': .01, 'burst': 1, 'max_wait': 0}
+        for _ in range(2):
+            with self.assertRaises(RateLimitedError):
+                self.carrier.get_services(self.domestic_request)
+        self.assertEqual(mock_send.call_count, 1)
+
+    @patch.object(SessionTransport, 'send')
+    def test_rates_trip_breaker(self, mock_send):
+        mock_send.side_effect = ConnectionError('Connection refused')
+        self.carrier.circuit_breaker = {
+            'window': 4, 'min_calls': 2, 'cooldown': 60}
+        self.carrier.breaker.reset()
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.carrier.get_services(self.domestic_request)
+        with self.assertRaises(CarrierUnavailableError):
+            self.carrier.get_services(self.domestic_request)
+        self.assertEqual(mock_send.call_count, 2)
+
     def test_tracking(self):
         result = self.carrier.track('1Z12345E6205277936')
         self.assertEqual(result['delivered'], False)
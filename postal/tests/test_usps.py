@@ -1,11 +1,17 @@
 # coding=utf-8
+from threading import Lock
+import time
 import unittest
 from unittest import SkipTest
 
+from mock import patch
 from money import Money
 from base import _AbstractTestCarrier, domestic, international
 from ..carriers.usps import USPSApi
-from postal import Address
+from postal import Address, Package, Request
+from postal.data import Shipment
+from postal.exceptions import CarrierError, NotSupportedError
+from postal.cache import MemoryCache
 from postal.carriers import Carrier
 
 
@@ -20,6 +26,111 @@ class TestUSPS(_AbstractTestCarrier, unittest.TestCase):
         raise SkipTest(
             "USPS does not charge extra for domestic shipments.")
 
+    def test_rate_table_compiled_once(self):
+        self.carrier.cache = MemoryCache()
+
+        def price(amount):
+            return {'total': Money(amount, 'USD'),
+                    'base_price': Money(amount, 'USD')}
+        package_rates = {
+            1: {'PriorityExpress': {
+                    'price': price('20.00'), 'delivery_datetime': None,
+                    'trackable': True},
+                'Priority': {
+                    'price': price('7.00'), 'delivery_datetime': None,
+                    'trackable': True}},
+            2: {'Priority': {
+                'price': price('8.00'), 'delivery_datetime': None,
+                'trackable': True}}}
+        request = Request(self.test_from, self.test_to, [
+            Package(2, 3, 4, 1), Package(2, 3, 4, 2)])
+        with patch.object(USPSApi, 'client'), \
+                patch.object(self.carrier, 'service_call'), \
+                patch.object(
+                    self.carrier, '_request_response_table',
+                    side_effect=lambda request, response: package_rates[
+                        request.packages[0].weight]), \
+                patch.object(self.carrier, 'compile_table',
+                             wraps=self.carrier.compile_table) as compile:
+            priority = self.carrier.get_service('Priority')
+            self.assertEqual(
+                priority.price(request)['total'], Money('15.00', 'USD'))
+            compiled = compile.call_count
+            self.assertIsNone(priority.delivery_datetime(request))
+            self.assertEqual(
+                self.carrier.get_services(request).keys(), [priority])
+            self.assertRaises(
+                NotSupportedError, self.carrier.get_service(
+                    'PriorityExpress').price, request)
+        self.assertEqual(compile.call_count, compiled)
+
+    def test_packages_rated_separately(self):
+        self.carrier.cache = MemoryCache()
+        rated = []
+
+        def response_table(request, response):
+            package = request.packages[0]
+            rated.append(package.weight)
+            return {'Priority': {
+                'price': {'total': Money(package.weight, 'USD'),
+                          'base_price': Money(package.weight, 'USD')},
+                'delivery_datetime': None, 'trackable': True}}
+        first = Request(self.test_from, self.test_to, [
+            Package(2, 3, 4, 1), Package(2, 3, 4, 2), Package(2, 3, 4, 1)])
+        second = Request(self.test_from, self.test_to, [
+            Package(2, 3, 4, 2), Package(2, 3, 4, 3)])
+        with patch.object(USPSApi, 'client'), \
+                patch.object(self.carrier, 'service_call'), \
+                patch.object(self.carrier, '_request_response_table',
+                             side_effect=response_table):
+            priority = self.carrier.get_service('Priority')
+            self.assertEqual(
+                priority.price(first)['total'], Money(4, 'USD'))
+            self.assertEqual(sorted(rated), [1, 2])
+            self.assertEqual(
+                priority.price(second)['total'], Money(5, 'USD'))
+        self.assertEqual(sorted(rated), [1, 2, 3])
+
+    def test_packages_shipped_concurrently(self):
+        lock = Lock()
+        running = [0, 0]
+        packages = [Package(2, 3, 4, weight) for weight in range(1, 7)]
+
+        def ship_package(request, service, package):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(.01)
+            with lock:
+                running[0] -= 1
+            if package.weight == 3:
+                raise CarrierError('No label.')
+            price = Money(package.weight, 'USD')
+            return {
+                'shipment': Shipment(
+                    self.carrier, str(package.weight),
+                    transaction_id=str(package.weight)),
+                'price': {'total': price, 'fees': Money(0, 'USD'),
+                          'base_price': price},
+                'packages': {package: {
+                    'tracking_number': str(package.weight),
+                    'label': None}}}
+        self.carrier.ship_concurrency = 3
+        request = Request(self.test_from, self.test_to, packages)
+        with patch.object(self.carrier, 'quote'), \
+                patch.object(self.carrier, 'ship_package',
+                             side_effect=ship_package):
+            result = self.carrier.ship(
+                self.carrier.get_service('Priority'), request)
+        self.assertEqual(result['packages'].keys(), packages)
+        self.assertEqual(
+            [details['tracking_number']
+             for details in result['packages'].values()],
+            ['1', '2', None, '4', '5', '6'])
+        self.assertEqual(result['price']['total'], Money(18, 'USD'))
+        self.assertGreater(running[1], 1)
+        self.assertLessEqual(running[1], 3)
+
     def test_refill(self):
         self.carrier.refill(Money('50.00', 'USD'))
 
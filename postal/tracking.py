@@ -0,0 +1,256 @@
+"""
+Caching for tracking results.
+
+Tracking changes slowly, and once a carrier reports a shipment finalized it
+doesn't change at all, yet pollers ask after the same shipments over and
+over. TrackingCache remembers what carriers' track() returned, on any
+CacheBackend, for as long as each result is likely to stay current:
+
+- Finalized results are kept until the backend evicts them.
+- Results for shipments still moving are kept for a time that grows with the
+  age of their latest event, between min_ttl and max_ttl seconds, since a
+  shipment that hasn't moved in days is unlikely to move in the next minute.
+- A SoftCarrierError, which carriers raise for numbers they don't know about
+  yet, is remembered too and raised again without asking the carrier. The
+  wait before asking again starts at negative_ttl seconds and doubles with
+  each miss in a row, up to max_negative_ttl. Timeouts, rate limits and
+  open circuit breakers say nothing about the number, so they aren't
+  remembered.
+
+TrackingHistory remembers which events of each shipment's history have been
+reported, so that Postal.track_updates() only returns the new ones. A
+shipment its backend forgets, by eviction or by its ttl running out, has its
+whole history reported again, so the backend should be large enough for
+every shipment being followed.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from threading import RLock
+import time
+
+from .cache import MemoryCache, cache_from_configuration
+from .data import Address, digest
+from .exceptions import CarrierTimeoutError, CarrierUnavailableError, \
+    RateLimitedError, SoftCarrierError
+
+
+def event_age(result):
+    """
+    Seconds since the event a tracking result describes, or None if it
+    doesn't say when that was.
+    """
+    event_time = result.get('event_time')
+    if not isinstance(event_time, datetime):
+        return None
+    age = datetime.now(event_time.tzinfo) - event_time
+    return age.days * 86400 + age.seconds
+
+
+class TrackingCache(object):
+    """
+    backend:CacheBackend = where results are kept
+    min_ttl:float = the fewest seconds a result for a moving shipment is kept
+    max_ttl:float = the most seconds a result for a moving shipment is kept
+    age_factor:float = the fraction of the age of a shipment's latest event
+        its result is kept for, within min_ttl and max_ttl
+    negative_ttl:float = the seconds to wait before asking again about a
+        number the carrier didn't know
+    max_negative_ttl:float = the most seconds to wait before asking again
+    """
+    def __init__(self, backend, min_ttl=300, max_ttl=21600, age_factor=0.1,
+                 negative_ttl=600, max_negative_ttl=86400):
+        self.backend = backend
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.age_factor = age_factor
+        self.negative_ttl = negative_ttl
+        self.max_negative_ttl = max_negative_ttl
+
+    @staticmethod
+    def key(carrier_name, identifier):
+        return 'tracking|%s|%s' % (carrier_name, identifier)
+
+    def ttl(self, result):
+        """
+        Seconds to keep result for, or None to keep it for good.
+        """
+        if result.get('finalized'):
+            return None
+        age = event_age(result)
+        if age is None:
+            return self.min_ttl
+        return min(max(age * self.age_factor, self.min_ttl), self.max_ttl)
+
+    def lookup(self, carrier_name, identifier):
+        """
+        Returns the cached result for identifier, raises the cached error for
+        it, or returns None if the carrier needs to be asked.
+        """
+        entry = self.backend.get(self.key(carrier_name, identifier))
+        if entry is None:
+            return None
+        if 'error' in entry:
+            if entry['retry_at'] > time.time():
+                raise SoftCarrierError(entry['error'])
+            return None
+        return _load(entry['tracking'])
+
+    def store(self, carrier_name, identifier, result):
+        """
+        Remembers what tracking identifier came to: the dictionary track()
+        returned or the error it raised. Anything else isn't kept.
+        """
+        key = self.key(carrier_name, identifier)
+        if isinstance(result, dict):
+            self.backend.set(
+                key, {'tracking': _dump(result)}, ttl=self.ttl(result))
+        elif isinstance(result, SoftCarrierError) and not isinstance(
+                result, (CarrierTimeoutError, CarrierUnavailableError,
+                         RateLimitedError)):
+            previous = self.backend.get(key)
+            misses = 0
+            if previous is not None and 'error' in previous:
+                misses = previous['misses'] + 1
+            wait = min(self.negative_ttl * 2 ** misses, self.max_negative_ttl)
+            # Kept past the wait so that the next miss backs off further.
+            self.backend.set(key, {
+                'error': unicode(result), 'misses': misses,
+                'retry_at': time.time() + wait},
+                ttl=wait + self.max_negative_ttl)
+
+    def invalidate(self, carrier_name, identifier):
+        self.backend.delete(self.key(carrier_name, identifier))
+
+    def track(self, carrier, identifier):
+        """
+        Like carrier.track(identifier), but answered from the cache when it
+        can be.
+        """
+        result = self.lookup(carrier.name, identifier)
+        if result is not None:
+            return result
+        try:
+            result = carrier.track(identifier)
+        except SoftCarrierError as err:
+            self.store(carrier.name, identifier, err)
+            raise
+        self.store(carrier.name, identifier, result)
+        return result
+
+    def track_many(self, carrier, identifiers):
+        """
+        Like carrier.track_many(identifiers), but only asking the carrier
+        about identifiers the cache can't answer for.
+        """
+        entries = {}
+        missing = []
+        for identifier in identifiers:
+            if identifier in entries:
+                continue
+            try:
+                result = self.lookup(carrier.name, identifier)
+            except SoftCarrierError as err:
+                entries[identifier] = {'tracking': None, 'error': err}
+                continue
+            if result is None:
+                missing.append(identifier)
+                entries[identifier] = None
+            else:
+                entries[identifier] = {'tracking': result, 'error': None}
+        if missing:
+            for identifier, entry in carrier.track_many(missing).items():
+                self.store(carrier.name, identifier,
+                           entry['error'] or entry['tracking'])
+                entries[identifier] = entry
+        return OrderedDict(
+            (identifier, entries[identifier]) for identifier in identifiers)
+
+
+class TrackingHistory(object):
+    """
+    Remembers which events of each shipment's history have already been
+    reported, so that each poll of a shipment only reports what's new.
+
+    backend:CacheBackend = where the events seen for each shipment are kept
+    ttl:float|None = seconds to remember a shipment after its last new event
+    """
+    def __init__(self, backend, ttl=2592000):
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = RLock()
+
+    @staticmethod
+    def key(carrier_name, identifier):
+        return 'history|%s|%s' % (carrier_name, identifier)
+
+    @staticmethod
+    def event_key(event):
+        return digest(event)[:16]
+
+    def updates(self, carrier_name, identifier, events):
+        """
+        Returns the events not seen for identifier before, in their order,
+        and remembers them as seen.
+        """
+        key = self.key(carrier_name, identifier)
+        with self._lock:
+            seen = list(self.backend.get(key) or [])
+            known = set(seen)
+            new = []
+            for event in events:
+                event_key = self.event_key(event)
+                if event_key not in known:
+                    known.add(event_key)
+                    seen.append(event_key)
+                    new.append(event)
+            if new:
+                self.backend.set(key, seen, ttl=self.ttl)
+        return new
+
+    def forget(self, carrier_name, identifier):
+        self.backend.delete(self.key(carrier_name, identifier))
+
+
+def _dump(result):
+    result = dict(result)
+    if isinstance(result.get('location'), Address):
+        result['location'] = result['location'].to_primitive()
+    return result
+
+
+def _load(result):
+    result = dict(result)
+    if isinstance(result.get('location'), dict):
+        result['location'] = Address(**result['location'])
+    return result
+
+
+def tracking_cache_from_configuration(settings):
+    """
+    Gets the TrackingCache described by the 'tracking_cache' section of a
+    postal configuration, or None if there isn't one. The backend is chosen
+    with the same settings as the 'cache' section, and shared with anything
+    else built from the same ones.
+    """
+    if not settings:
+        return None
+    options = {
+        name: settings[name] for name in (
+            'min_ttl', 'max_ttl', 'age_factor', 'negative_ttl',
+            'max_negative_ttl')
+        if name in settings}
+    return TrackingCache(cache_from_configuration(settings), **options)
+
+
+def tracking_history_from_configuration(settings):
+    """
+    Gets the TrackingHistory described by the 'tracking_history' section of
+    a postal configuration. Without one, seen events are kept in memory with
+    no limit on the number of shipments, since a shipment dropped to make
+    room would have its whole history reported again. Each shipment is still
+    forgotten once its ttl runs out.
+    """
+    if not settings:
+        return TrackingHistory(MemoryCache(max_size=None))
+    options = {'ttl': settings['ttl']} if 'ttl' in settings else {}
+    return TrackingHistory(cache_from_configuration(settings), **options)